@@ -0,0 +1,51 @@
+"""
+夢酒館 RAG 品牌大使 ASGI App
+
+與 app.py 相同的 API，改用 asyncio + AsyncOpenAI：
+
+    uvicorn asgi_app:app --port 8080
+"""
+import os
+from dotenv import load_dotenv
+
+from mojo_rag.metrics import startup_phase
+from mojo_rag.prefork import in_each_worker, preloading
+
+# 冷啟動各階段的耗時與 RSS 見 /metrics 的 mojo_rag_startup_*（bench/startup_profile.py）
+with startup_phase("import"):
+    from mojo_rag.asgi import create_asgi_app
+    from mojo_rag.pipeline import RAGPipeline
+    from mojo_rag.reloader import IndexWatcher
+
+# 載入環境變數
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 載入 FAISS 向量資料庫
+print("載入向量資料庫...")
+FAISS_PATH = os.path.join(BASE_DIR, "faiss_db")
+pipeline = RAGPipeline.from_env(FAISS_PATH)
+print("向量資料庫載入完成")
+
+# 知識庫更新後在背景換上新索引，不需重啟（INDEX_RELOAD_INTERVAL=0 停用）
+watcher = IndexWatcher.from_env(pipeline, FAISS_PATH)
+if watcher is not None:
+    if preloading():
+        # gunicorn preload：master 不輪詢，由 post_fork 在每個 worker 啟動
+        in_each_worker(watcher.start)
+    else:
+        watcher.start()
+
+app = create_asgi_app(
+    pipeline,
+    static_folder=os.path.join(BASE_DIR, 'static'),
+    template_folder=os.path.join(BASE_DIR, 'templates'),
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv('PORT', 8080))
+    uvicorn.run(app, host='0.0.0.0', port=port)
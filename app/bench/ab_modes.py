@@ -0,0 +1,224 @@
+"""
+full / fast 模式的 A/B 比較
+
+以同一份固定問題集（bench/questions.json）逐題、依序對 /api/chat/stream 送出兩種模式的請求
+（每題交替先後順序，避免暖機與供應商端 prompt 快取只偏袒其中一邊），比較：
+
+- 延遲：總延遲與第一個 token 的 p50 / p95
+- LLM 呼叫：每個請求的成功呼叫次數與 token 數（/metrics 的差值）、fast 模式要求補充檢索的比例
+- 回答重疊：兩種模式回答的字元 bigram Jaccard，以及檢索到的 chunk id 的 Jaccard
+
+    python bench/ab_modes.py --output bench/results/ab_modes.json
+    # mock 的回答是罐頭文字，回答重疊只有接上真的模型才有意義
+    python bench/ab_modes.py --openai
+    python bench/ab_modes.py --base-url http://127.0.0.1:8080
+
+需在 app/ 目錄下執行。預設啟動 mock 與 app（uvicorn）並關閉各種快取，兩種模式才不會共用回答。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+from e2e import DECOMPOSITIONS_PATH, QUESTIONS_PATH, app_env, git_commit, metrics_delta, percentiles, scrape_metrics
+from load_test import SERVER_COMMANDS, _spawn, _wait_ready
+
+MODES = ('full', 'fast')
+
+
+def bigrams(text):
+    text = "".join(text.split())
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return round(len(a & b) / len(a | b), 4)
+
+
+async def ask(client, base_url, question, mode):
+    """送出一個串流請求，回傳延遲、回答、檢索到的 chunk id 與這個請求的 LLM 呼叫統計"""
+    before = await scrape_metrics(client, base_url)
+    start = time.perf_counter()
+    result = {'ok': False, 'first_token': None, 'answer': '', 'ids': set(), 'sub_queries': [], 'extra': False}
+    async with client.stream('POST', f"{base_url}/api/chat/stream",
+                             json={'message': question, 'mode': mode}) as resp:
+        async for line in resp.aiter_lines():
+            if not line.startswith('data: '):
+                continue
+            event = json.loads(line[6:])
+            if event['type'] == 'stage1':
+                result['sub_queries'] = event['data']['sub_queries']
+            elif event['type'] == 'stage2':
+                result['extra'] = result['extra'] or bool(event.get('extra'))
+                for retrieval in event['data']:
+                    result['ids'].update(retrieval['ids'])
+            elif event['type'] == 'answer_delta':
+                if result['first_token'] is None:
+                    result['first_token'] = (time.perf_counter() - start) * 1000
+                result['answer'] += event['data']
+            elif event['type'] == 'error':
+                break
+            elif event['type'] == 'done':
+                result['ok'] = resp.status_code == 200
+                break
+    result['total'] = (time.perf_counter() - start) * 1000
+    _, tokens, upstream = metrics_delta(before, await scrape_metrics(client, base_url), 1)
+    result['llm_calls'] = sum(count for key, count in upstream.items() if key.endswith('.ok'))
+    result['tokens'] = sum(count for key, count in tokens.items() if not key.endswith('.cached_prompt'))
+    return result
+
+
+async def run_ab(base_url, questions, rounds):
+    runs = {mode: [] for mode in MODES}
+    pairs = []
+    async with httpx.AsyncClient(timeout=None) as client:
+        # 暖機：模型、索引頁面與連線
+        for mode in MODES:
+            await ask(client, base_url, questions[0], mode)
+        for round_index in range(rounds):
+            for i, question in enumerate(questions):
+                order = MODES if (i + round_index) % 2 == 0 else MODES[::-1]
+                answers = {}
+                for mode in order:
+                    answers[mode] = await ask(client, base_url, question, mode)
+                    runs[mode].append(answers[mode])
+                full, fast = answers['full'], answers['fast']
+                if full['ok'] and fast['ok']:
+                    pairs.append({
+                        'question': question,
+                        'answer_overlap': jaccard(bigrams(full['answer']), bigrams(fast['answer'])),
+                        'chunk_overlap': jaccard(full['ids'], fast['ids']),
+                        'full_sub_queries': full['sub_queries'],
+                        'fast_sub_queries': fast['sub_queries'],
+                        'fast_extra_retrieval': fast['extra'],
+                    })
+    return summarize(runs, pairs)
+
+
+def summarize(runs, pairs):
+    modes = {}
+    for mode, results in runs.items():
+        ok = [r for r in results if r['ok']]
+        modes[mode] = {
+            'requests': len(results),
+            'ok': len(ok),
+            'latency_ms': percentiles([r['total'] for r in ok]),
+            'first_token_ms': percentiles([r['first_token'] for r in ok if r['first_token'] is not None]),
+            'llm_calls_per_request': round(sum(r['llm_calls'] for r in ok) / len(ok), 2) if ok else None,
+            'tokens_per_request': round(sum(r['tokens'] for r in ok) / len(ok), 1) if ok else None,
+            'extra_retrieval_rate': round(sum(r['extra'] for r in ok) / len(ok), 3) if ok else None,
+        }
+    overlap = {
+        'answer_bigram_jaccard': percentiles([p['answer_overlap'] * 100 for p in pairs]),
+        'chunk_id_jaccard': percentiles([p['chunk_overlap'] * 100 for p in pairs]),
+    }
+    return {'modes': modes, 'overlap_pct': overlap, 'pairs': pairs}
+
+
+def print_report(report):
+    for mode, r in report['modes'].items():
+        latency, first = r['latency_ms'] or {}, r['first_token_ms'] or {}
+        print(f"{mode:<5} ok={r['ok']}/{r['requests']}  total p50={latency.get('p50')}ms p95={latency.get('p95')}ms  "
+              f"first token p50={first.get('p50')}ms p95={first.get('p95')}ms  "
+              f"llm calls={r['llm_calls_per_request']} tokens={r['tokens_per_request']} "
+              f"extra retrieval={r['extra_retrieval_rate']}")
+    answer, chunks = report['overlap_pct']['answer_bigram_jaccard'], report['overlap_pct']['chunk_id_jaccard']
+    if answer and chunks:
+        print(f"overlap (%): answer bigram p50={answer['p50']} mean={answer['mean']}  "
+              f"chunk ids p50={chunks['p50']} mean={chunks['mean']}")
+    for pair in sorted(report['pairs'], key=lambda p: p['answer_overlap'])[:3]:
+        print(f"  lowest overlap {pair['answer_overlap']:.2f} / chunks {pair['chunk_overlap']:.2f}: {pair['question']}")
+
+
+async def main_async(args, questions):
+    if args.base_url:
+        return await run_ab(args.base_url, questions, args.rounds)
+
+    env = app_env(args)
+    mock = None
+    if args.openai:
+        # 使用 .env / 環境變數中的 OpenAI 設定
+        for key in ('OPENAI_BASE_URL', 'OPENAI_API_KEY'):
+            env.pop(key, None)
+            if key in os.environ:
+                env[key] = os.environ[key]
+    else:
+        mock_cmd = [
+            sys.executable, os.path.join('bench', 'mock_openai.py'), '--port', str(args.mock_port),
+            '--latency', str(args.latency), '--tokens-per-sec', str(args.tokens_per_sec),
+            '--tool-call-rate', str(args.tool_call_rate), '--seed', '0',
+        ]
+        if args.decompositions:
+            mock_cmd += ['--decompositions', args.decompositions]
+        mock = _spawn(mock_cmd)
+
+    try:
+        if mock is not None:
+            await _wait_ready(f"http://127.0.0.1:{args.mock_port}/stats")
+        cmd = [part.format(port=args.app_port) for part in SERVER_COMMANDS['asgi']]
+        server = _spawn(cmd, env=env)
+        try:
+            base_url = f"http://127.0.0.1:{args.app_port}"
+            await _wait_ready(base_url)
+            return await run_ab(base_url, questions, args.rounds)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        if mock is not None:
+            mock.terminate()
+            mock.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A/B comparison of the full and fast pipeline modes')
+    parser.add_argument('--questions', default=QUESTIONS_PATH)
+    parser.add_argument('--rounds', type=int, default=1, help='times to replay the question set')
+    parser.add_argument('--latency', type=float, default=0.8, help='mock OpenAI latency before the first token (s)')
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0, help='mock OpenAI token rate')
+    parser.add_argument('--tool-call-rate', type=float, default=0.2,
+                        help='fraction of fast-mode generations where the mock asks for extra retrieval')
+    parser.add_argument('--decompositions', default=DECOMPOSITIONS_PATH,
+                        help='canned decomposition JSON for the mock server (empty string to disable)')
+    parser.add_argument('--openai', action='store_true', help='use the real OpenAI API instead of the mock')
+    parser.add_argument('--cache', action='store_true', help='keep the cache settings from the environment')
+    parser.add_argument('--base-url', help='compare modes on an already running server')
+    parser.add_argument('--mock-port', type=int, default=9100)
+    parser.add_argument('--app-port', type=int, default=8090)
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    with open(args.questions, encoding='utf-8') as f:
+        questions = json.load(f)
+
+    report = asyncio.run(main_async(args, questions))
+    print_report(report)
+    report.update({
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {
+            'questions': len(questions),
+            'rounds': args.rounds,
+            'backend': 'external' if args.base_url else 'openai' if args.openai else 'mock',
+            'mock_latency_s': args.latency,
+            'mock_tokens_per_sec': args.tokens_per_sec,
+            'mock_tool_call_rate': args.tool_call_rate,
+            'cache': args.cache,
+        },
+    })
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nresults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
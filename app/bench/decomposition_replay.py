@@ -0,0 +1,113 @@
+"""
+本地語意拆解路由 vs LLM 拆解的重播比較
+
+對重播集中的每個問題同時跑 LLM 拆解（作為標準答案）與 DecompositionRouter，
+統計本地路徑省下的延遲與 token，以及是否漏拆（LLM 拆成多個子問題、
+路由卻判定為單句）。需在 app/ 目錄下執行：
+
+    python bench/decomposition_replay.py --mode rules
+    python bench/decomposition_replay.py --mode hybrid --output replay.json
+
+可搭配 bench/mock_openai.py（OPENAI_BASE_URL）離線執行，但標準答案只有在
+真實模型下才有意義。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from dotenv import load_dotenv  # noqa: E402
+from openai import OpenAI  # noqa: E402
+
+from mojo_rag.decomposition import DecompositionRouter, EmbeddingDecompositionClassifier  # noqa: E402
+from mojo_rag.pipeline import RAGPipeline  # noqa: E402
+
+
+def llm_decompose(client, model, question):
+    start = time.perf_counter()
+    response = client.chat.completions.create(
+        model=model,
+        messages=RAGPipeline._separate_messages(question)
+    )
+    latency = time.perf_counter() - start
+    result, _ = RAGPipeline._parse_sub_queries(question, response.choices[0].message.content)
+    tokens = response.usage.total_tokens if response.usage else 0
+    return result["sub_queries"], latency, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay questions through the local decomposition router and the LLM')
+    parser.add_argument('--questions', default=os.path.join(APP_DIR, 'bench', 'questions.json'))
+    parser.add_argument('--mode', choices=['rules', 'hybrid'], default='rules')
+    parser.add_argument('--output', help='write per-question results as JSON')
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(APP_DIR, '.env'))
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    model = os.getenv("OPENAI_MODEL", "gpt-4.1-nano")
+
+    classifier = None
+    if args.mode == 'hybrid':
+        from mojo_rag.embeddings import CustomE5Embedding
+        embedding_model = CustomE5Embedding(
+            model_name=os.getenv("EMBEDDING_MODEL", "intfloat/multilingual-e5-small"))
+        classifier = EmbeddingDecompositionClassifier(embedding_model)
+    router = DecompositionRouter(args.mode, classifier)
+
+    with open(args.questions, encoding='utf-8') as f:
+        questions = json.load(f)
+
+    rows = []
+    for question in questions:
+        start = time.perf_counter()
+        needs_llm, reason = router.decide(question)
+        router_latency = time.perf_counter() - start
+
+        sub_queries, llm_latency, tokens = llm_decompose(client, model, question)
+        compound = isinstance(sub_queries, list) and len(sub_queries) > 1
+        rows.append({
+            'question': question,
+            'llm_sub_queries': sub_queries,
+            'llm_compound': compound,
+            'llm_latency': llm_latency,
+            'llm_tokens': tokens,
+            'route': 'llm' if needs_llm else 'local',
+            'reason': reason,
+            'router_latency': router_latency,
+            'missed': compound and not needs_llm,
+        })
+        flag = 'MISSED' if rows[-1]['missed'] else ''
+        print(f"{rows[-1]['route']:<5} llm_split={len(sub_queries) if isinstance(sub_queries, list) else '?'} "
+              f"{llm_latency * 1000:7.0f}ms {flag:<6} {question[:40]}")
+
+    local_rows = [r for r in rows if r['route'] == 'local']
+    compound_rows = [r for r in rows if r['llm_compound']]
+    summary = {
+        'mode': args.mode,
+        'model': model,
+        'questions': len(rows),
+        'routed_local': len(local_rows),
+        'local_rate': len(local_rows) / len(rows) if rows else 0.0,
+        'llm_compound': len(compound_rows),
+        'missed': sum(1 for r in rows if r['missed']),
+        'recall': (sum(1 for r in compound_rows if r['route'] == 'llm') / len(compound_rows)
+                   if compound_rows else 1.0),
+        'saved_latency_s': sum(r['llm_latency'] for r in local_rows),
+        'saved_latency_per_request_ms': (sum(r['llm_latency'] for r in local_rows) / len(rows) * 1000
+                                         if rows else 0.0),
+        'saved_tokens': sum(r['llm_tokens'] for r in local_rows),
+        'router_latency_p50_ms': sorted(r['router_latency'] for r in rows)[len(rows) // 2] * 1000 if rows else 0.0,
+    }
+
+    print("\n" + json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'rows': rows}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
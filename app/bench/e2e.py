@@ -0,0 +1,335 @@
+"""
+離線端到端 benchmark
+
+啟動 bench/mock_openai.py（可設定延遲、吐字速度與罐頭語意拆解結果）與 app，
+以指定的併發數把 bench/questions.json 重播到 /api/chat 與 /api/chat/stream，
+統計吞吐量、總延遲 p50/p95/p99、第一個事件與第一個 token 的時間，以及各階段耗時
+（SSE 事件的 timings 欄位與 /metrics 的差值）。結果存成 JSON，可與前一次比較：
+
+    python bench/e2e.py --concurrency 1 8 32 --output bench/results/e2e.json
+    python bench/e2e.py --compare bench/results/e2e.json --max-regression 0.2
+    # 注入尾端延遲與錯誤，比較 UPSTREAM_GUARD=1 / 0 的 p99 與降級次數
+    python bench/e2e.py --slow-rate 0.05 --slow-latency 10 --error-rate 0.05
+
+需在 app/ 目錄下執行。預設關閉回應 / 語意 / 查詢向量快取，量到的是完整流程；
+--cache 保留 .env 中的快取設定。--base-url 可改測已經啟動的 server（不啟動 mock 與 app）。
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import httpx
+
+from load_test import SERVER_COMMANDS, _spawn, _wait_ready
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUESTIONS_PATH = os.path.join(APP_DIR, 'bench', 'questions.json')
+DECOMPOSITIONS_PATH = os.path.join(APP_DIR, 'bench', 'decompositions.json')
+
+METRIC_LINE = re.compile(r'^(mojo_rag_\w+?)(?:_(sum|count))?\{([^}]*)\} (\S+)$')
+
+
+def percentiles(values):
+    """nearest-rank 的 p50 / p95 / p99（毫秒）"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(q):
+        return round(values[min(len(values) - 1, int(len(values) * q))], 2)
+
+    return {'p50': rank(0.50), 'p95': rank(0.95), 'p99': rank(0.99), 'mean': round(sum(values) / len(values), 2)}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                                check=True, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=APP_DIR,
+                               check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}-dirty" if dirty else commit
+
+
+async def scrape_metrics(client, base_url):
+    """讀取 /metrics 中各階段與 token 的累計值：{(metric, labels): value}"""
+    try:
+        resp = await client.get(f"{base_url}/metrics")
+    except httpx.TransportError:
+        return {}
+    if resp.status_code != 200:
+        return {}
+    values = {}
+    for line in resp.text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match and 'le=' not in match.group(3):
+            name, suffix, labels, value = match.groups()
+            values[(name + (f"_{suffix}" if suffix else ""), labels)] = float(value)
+    return values
+
+
+def metrics_delta(before, after, requests):
+    """兩次 /metrics 之間的各階段平均耗時（毫秒）、每個請求的 token 數，以及 OpenAI 呼叫結果與降級次數"""
+    stages, tokens, upstream = {}, {}, {}
+    for (name, labels), value in after.items():
+        delta = value - before.get((name, labels), 0.0)
+        if name == 'mojo_rag_stage_seconds_sum':
+            count = after.get(('mojo_rag_stage_seconds_count', labels), 0) - before.get(
+                ('mojo_rag_stage_seconds_count', labels), 0)
+            if count:
+                stages[labels.split('"')[1]] = round(delta / count * 1000, 2)
+        elif name == 'mojo_rag_openai_tokens_total' and requests:
+            call, kind = re.findall(r'"([^"]*)"', labels)
+            tokens[f"{call}.{kind}"] = round(delta / requests, 1)
+        elif name == 'mojo_rag_openai_calls_total' and delta:
+            call, outcome = re.findall(r'"([^"]*)"', labels)
+            upstream[f"{call}.{outcome}"] = int(delta)
+        elif name == 'mojo_rag_degraded_total' and delta:
+            call, = re.findall(r'"([^"]*)"', labels)
+            upstream[f"{call}.degraded"] = int(delta)
+    return stages, tokens, upstream
+
+
+async def _chat(client, base_url, question):
+    start = time.perf_counter()
+    resp = await client.post(f"{base_url}/api/chat", json={'message': question})
+    return {'ok': resp.status_code == 200, 'total': (time.perf_counter() - start) * 1000}
+
+
+async def _stream(client, base_url, question):
+    start = time.perf_counter()
+    result = {'ok': False, 'first_event': None, 'first_token': None, 'timings': None}
+    async with client.stream('POST', f"{base_url}/api/chat/stream", json={'message': question}) as resp:
+        async for line in resp.aiter_lines():
+            if not line.startswith('data: '):
+                continue
+            elapsed = (time.perf_counter() - start) * 1000
+            event = json.loads(line[6:])
+            if result['first_event'] is None:
+                result['first_event'] = elapsed
+            if event['type'] == 'answer_delta' and result['first_token'] is None:
+                result['first_token'] = elapsed
+            elif event['type'] == 'answer_done':
+                result['timings'] = event.get('timings')
+            elif event['type'] == 'error':
+                break
+            elif event['type'] == 'done':
+                result['ok'] = resp.status_code == 200
+                break
+    result['total'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+async def run_scenario(base_url, endpoint, concurrency, questions):
+    """以固定併發數重播所有問題，回傳這個情境的統計"""
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    request = _stream if endpoint == 'stream' else _chat
+
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        async def worker(question):
+            async with semaphore:
+                return await request(client, base_url, question)
+
+        before = await scrape_metrics(client, base_url)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(worker(q) for q in questions))
+        elapsed = time.perf_counter() - start
+        after = await scrape_metrics(client, base_url)
+
+    ok = [r for r in results if r['ok']]
+    stage_means, tokens, upstream = metrics_delta(before, after, len(results))
+    report = {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'ok': len(ok),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(results) / elapsed, 3),
+        'latency_ms': percentiles([r['total'] for r in ok]),
+        'stage_means_ms': stage_means,
+        'tokens_per_request': tokens,
+        'upstream': upstream,
+    }
+    if endpoint == 'stream':
+        report['first_event_ms'] = percentiles([r['first_event'] for r in ok if r['first_event'] is not None])
+        report['first_token_ms'] = percentiles([r['first_token'] for r in ok if r['first_token'] is not None])
+        stages = {}
+        for r in ok:
+            for stage, ms in (r['timings'] or {}).items():
+                stages.setdefault(stage, []).append(ms)
+        report['stages_ms'] = {stage: percentiles(values) for stage, values in sorted(stages.items())}
+    return report
+
+
+async def run_suite(base_url, args, questions):
+    # 暖機：模型、索引頁面與連線
+    await run_scenario(base_url, 'chat', 1, questions[:2])
+    results = []
+    for endpoint in args.endpoints:
+        for concurrency in args.concurrency:
+            report = await run_scenario(base_url, endpoint, concurrency, questions * args.rounds)
+            print_report(report)
+            results.append(report)
+    return results
+
+
+def app_env(args):
+    env = dict(os.environ,
+               OPENAI_BASE_URL=f"http://127.0.0.1:{args.mock_port}/v1",
+               OPENAI_API_KEY='mock',
+               SSE_TIMINGS='1',
+               INDEX_RELOAD_INTERVAL='0')
+    if not args.cache:
+        env.update(RESPONSE_CACHE='0', SEMANTIC_CACHE='0', EMBEDDING_CACHE='0')
+    return env
+
+
+async def main_async(args, questions):
+    if args.base_url:
+        return {'external': await run_suite(args.base_url, args, questions)}
+
+    mock_cmd = [
+        sys.executable, os.path.join('bench', 'mock_openai.py'), '--port', str(args.mock_port),
+        '--latency', str(args.latency), '--tokens-per-sec', str(args.tokens_per_sec),
+        '--slow-rate', str(args.slow_rate), '--slow-latency', str(args.slow_latency),
+        '--error-rate', str(args.error_rate),
+    ]
+    if args.decompositions:
+        mock_cmd += ['--decompositions', args.decompositions]
+    mock = _spawn(mock_cmd)
+
+    results = {}
+    try:
+        await _wait_ready(f"http://127.0.0.1:{args.mock_port}/stats")
+        for mode in args.modes:
+            cmd = [part.format(port=args.app_port) for part in SERVER_COMMANDS[mode]]
+            server = _spawn(cmd, env=app_env(args))
+            try:
+                base_url = f"http://127.0.0.1:{args.app_port}"
+                await _wait_ready(base_url)
+                print(f"\n== {mode} ==")
+                results[mode] = await run_suite(base_url, args, questions)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        mock.terminate()
+        mock.wait()
+    return results
+
+
+def print_report(r):
+    latency = r['latency_ms'] or {}
+    line = (f"{r['endpoint']:<6} c={r['concurrency']:<3} ok={r['ok']}/{r['requests']} "
+            f"{r['throughput_rps']:.2f} req/s  p50={latency.get('p50')}ms p95={latency.get('p95')}ms "
+            f"p99={latency.get('p99')}ms")
+    if r.get('first_event_ms'):
+        line += f"  first event p50={r['first_event_ms']['p50']}ms"
+    if r.get('first_token_ms'):
+        line += f"  first token p50={r['first_token_ms']['p50']}ms"
+    print(line)
+    if r.get('upstream'):
+        print("       upstream: " + ", ".join(f"{k}={v}" for k, v in sorted(r['upstream'].items())))
+    if r['stage_means_ms']:
+        print("       stages(mean ms): " + ", ".join(f"{k}={v}" for k, v in sorted(r['stage_means_ms'].items())))
+
+
+def compare(baseline, current, max_regression=None):
+    """依 (mode, endpoint, concurrency) 比較 p50 / p95 延遲與吞吐量，回傳是否有超出門檻的退步"""
+    def index(report):
+        return {(mode, r['endpoint'], r['concurrency']): r
+                for mode, runs in report['results'].items() for r in runs}
+
+    old, new = index(baseline), index(current)
+    print(f"\ncompare {baseline.get('commit')} -> {current.get('commit')}")
+    regressed = False
+    for key in sorted(set(old) & set(new)):
+        changes = []
+        for metric in ('p50', 'p95'):
+            before = (old[key]['latency_ms'] or {}).get(metric)
+            after = (new[key]['latency_ms'] or {}).get(metric)
+            if before and after:
+                change = after / before - 1
+                changes.append(f"{metric} {before}->{after}ms ({change:+.1%})")
+                if metric == 'p95' and max_regression is not None and change > max_regression:
+                    regressed = True
+        before, after = old[key]['throughput_rps'], new[key]['throughput_rps']
+        if before:
+            changes.append(f"req/s {before}->{after} ({after / before - 1:+.1%})")
+        print(f"{'/'.join(str(k) for k in key):<18} " + "  ".join(changes))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark against a mock OpenAI server')
+    parser.add_argument('--modes', nargs='+', choices=sorted(SERVER_COMMANDS), default=['asgi'])
+    parser.add_argument('--endpoints', nargs='+', choices=['chat', 'stream'], default=['chat', 'stream'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--rounds', type=int, default=1, help='times to replay the question corpus per scenario')
+    parser.add_argument('--questions', default=QUESTIONS_PATH)
+    parser.add_argument('--latency', type=float, default=0.8, help='mock OpenAI latency before the first token (s)')
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0, help='mock OpenAI token rate')
+    parser.add_argument('--decompositions', default=DECOMPOSITIONS_PATH,
+                        help='canned decomposition JSON for the mock server (empty string to disable)')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of mock OpenAI calls with extra latency')
+    parser.add_argument('--slow-latency', type=float, default=10.0, help='extra latency of slow calls (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mock OpenAI calls that fail')
+    parser.add_argument('--cache', action='store_true', help='keep the cache settings from the environment')
+    parser.add_argument('--base-url', help='benchmark an already running server instead of spawning one')
+    parser.add_argument('--mock-port', type=int, default=9100)
+    parser.add_argument('--app-port', type=int, default=8090)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    parser.add_argument('--max-regression', type=float,
+                        help='exit with status 1 if any p95 latency grew by more than this fraction')
+    args = parser.parse_args()
+
+    with open(args.questions, encoding='utf-8') as f:
+        questions = json.load(f)
+
+    # 先讀基準，--output 與 --compare 可以是同一個檔案
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = asyncio.run(main_async(args, questions))
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {
+            'questions': len(questions),
+            'rounds': args.rounds,
+            'mock_latency_s': args.latency,
+            'mock_tokens_per_sec': args.tokens_per_sec,
+            'mock_slow_rate': args.slow_rate,
+            'mock_slow_latency_s': args.slow_latency,
+            'mock_error_rate': args.error_rate,
+            'decompositions': bool(args.decompositions),
+            'cache': args.cache,
+            'base_url': args.base_url,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nresults written to {args.output}")
+
+    if baseline is not None:
+        if compare(baseline, report, args.max_regression):
+            print(f"\n❌ p95 latency regressed by more than {args.max_regression:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+torch 與 ONNX（int8）embedding 後端的一致性檢查與效能比較
+
+- parity：同一批查詢 / 文件在兩個後端的 cosine 相似度，以及在既有 faiss_db 上
+  top-k 檢索結果的重疊率
+- 效能：每個後端在獨立的子行程中量測載入時間、單筆 / 批次延遲與峰值 RSS
+
+需在 app/ 目錄下執行，並先匯出 ONNX 模型（python -m mojo_rag.onnx_embeddings）：
+
+    python bench/embedding_backends.py --onnx-model-dir onnx_model
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import numpy as np  # noqa: E402
+
+from mojo_rag.embeddings import load_embedding_model  # noqa: E402
+
+QUESTIONS_PATH = os.path.join(APP_DIR, 'bench', 'questions.json')
+
+
+def _load_questions():
+    with open(QUESTIONS_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _peak_rss_mb():
+    # VmHWM 是目前行程的峰值 RSS；ru_maxrss 在 Linux 上會沿用父行程 exec 前的值
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(backend, model_name, onnx_model_dir, rounds):
+    """在目前的行程中載入單一後端並量測效能"""
+    questions = _load_questions()
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+    model, _ = load_embedding_model(model_name, backend=backend, onnx_model_dir=onnx_model_dir)
+    model.embed_queries(questions[:1])  # 暖機
+    load_s = time.perf_counter() - start
+
+    single, batch = [], []
+    for _ in range(rounds):
+        for question in questions:
+            t = time.perf_counter()
+            model.embed_queries([question])
+            single.append((time.perf_counter() - t) * 1000)
+        t = time.perf_counter()
+        model.embed_queries(questions[:8])
+        batch.append((time.perf_counter() - t) * 1000)
+
+    return {
+        'backend': backend,
+        'load_s': round(load_s, 2),
+        'single_p50_ms': round(statistics.median(single), 2),
+        'single_p95_ms': round(sorted(single)[int(len(single) * 0.95) - 1], 2),
+        'batch8_p50_ms': round(statistics.median(batch), 2),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        'model_rss_mb': round(_peak_rss_mb() - rss_before, 1),
+    }
+
+
+def _cosine(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    a /= np.linalg.norm(a, axis=1, keepdims=True)
+    b /= np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def parity(model_name, onnx_model_dir, faiss_path, top_k, num_passages):
+    """比較兩個後端的向量與在既有索引上的檢索結果"""
+    from mojo_rag.vectorstore import load_vector_store
+
+    questions = _load_questions()
+    torch_model, _ = load_embedding_model(model_name, backend='torch')
+    onnx_model, _ = load_embedding_model(model_name, backend='onnx', onnx_model_dir=onnx_model_dir)
+    db = load_vector_store(faiss_path, torch_model)
+    passages = [db.docstore.search(db.index_to_docstore_id[i]).page_content
+                for i in range(min(num_passages, db.index.ntotal))]
+
+    query_cos = _cosine(torch_model.embed_queries(questions), onnx_model.embed_queries(questions))
+    passage_cos = _cosine(torch_model.embed_documents(passages), onnx_model.embed_documents(passages))
+
+    overlaps = []
+    torch_vectors = np.asarray(torch_model.embed_queries(questions), dtype=np.float32)
+    onnx_vectors = np.asarray(onnx_model.embed_queries(questions), dtype=np.float32)
+    _, torch_ids = db.index.search(torch_vectors, top_k)
+    _, onnx_ids = db.index.search(onnx_vectors, top_k)
+    for expected, actual in zip(torch_ids, onnx_ids):
+        overlaps.append(len(set(expected) & set(actual)) / top_k)
+
+    return {
+        'query_cosine_min': round(float(query_cos.min()), 4),
+        'query_cosine_mean': round(float(query_cos.mean()), 4),
+        'passage_cosine_min': round(float(passage_cos.min()), 4),
+        'passage_cosine_mean': round(float(passage_cos.mean()), 4),
+        f'top{top_k}_overlap_mean': round(statistics.mean(overlaps), 4),
+        f'top{top_k}_identical_rate': round(sum(o == 1.0 for o in overlaps) / len(overlaps), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the torch and ONNX embedding backends')
+    parser.add_argument('--model', default=os.getenv('EMBEDDING_MODEL', 'intfloat/multilingual-e5-small'))
+    parser.add_argument('--onnx-model-dir', default=os.getenv('ONNX_MODEL_DIR', 'onnx_model'))
+    parser.add_argument('--faiss-path', default=os.path.join(APP_DIR, 'faiss_db'))
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--passages', type=int, default=200, help='number of indexed passages to compare')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--min-cosine', type=float, default=0.99, help='fail if any query cosine is below this')
+    parser.add_argument('--measure', choices=['torch', 'onnx'], help=argparse.SUPPRESS)
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args()
+
+    if args.measure:
+        # 子行程模式：只載入一個後端，RSS 才不會互相干擾
+        print(json.dumps(measure(args.measure, args.model, args.onnx_model_dir, args.rounds)))
+        return
+
+    report = {'performance': []}
+    for backend in ('torch', 'onnx'):
+        output = subprocess.run(
+            [sys.executable, __file__, '--measure', backend, '--model', args.model,
+             '--onnx-model-dir', args.onnx_model_dir, '--rounds', str(args.rounds)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        report['performance'].append(result)
+        print(f"{backend:<6} load={result['load_s']}s single p50={result['single_p50_ms']}ms "
+              f"batch8 p50={result['batch8_p50_ms']}ms peak RSS={result['peak_rss_mb']}MB")
+
+    report['parity'] = parity(args.model, args.onnx_model_dir, args.faiss_path, args.top_k, args.passages)
+    print("\n" + json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if report['parity']['query_cosine_min'] < args.min_cosine:
+        print(f"\n❌ query cosine below {args.min_cosine}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+langchain pickle 格式與 memory-mapped 原生格式的載入時間比較
+
+對每個大小建立一個合成的知識庫（隨機向量 + 約 800 字的文件），分別寫成
+index.faiss + index.pkl 與原生格式，再於獨立子行程中量測載入時間、第一次
+檢索延遲與峰值 RSS。需在 app/ 目錄下執行：
+
+    python bench/index_load.py --sizes 1000 10000 100000
+    python bench/index_load.py --path faiss_db   # 只量測既有的資料庫（需先轉換）
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import numpy as np  # noqa: E402
+
+DIM = 384
+
+
+def _peak_rss_mb():
+    # VmHWM 是目前行程的峰值 RSS；ru_maxrss 在 Linux 上會沿用父行程 exec 前的值
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_synthetic(directory, size):
+    """建立 langchain 格式與原生格式的合成知識庫"""
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import FakeEmbeddings
+
+    from mojo_rag.native_index import convert_langchain_store
+
+    rng = np.random.default_rng(0)
+    index = faiss.IndexFlatL2(DIM)
+    index.add(rng.random((size, DIM), dtype=np.float32))
+    ids = [f"doc-{i}" for i in range(size)]
+    docs = {doc_id: Document(page_content=f"夢酒館合成文件 {i} " + "調酒" * 400,
+                             metadata={"source": f"synthetic/{i}.txt"})
+            for i, doc_id in enumerate(ids)}
+    db = FAISS(FakeEmbeddings(size=DIM), index, InMemoryDocstore(docs), dict(enumerate(ids)))
+
+    pickle_dir = os.path.join(directory, f"pickle_{size}")
+    native_dir = os.path.join(directory, f"native_{size}")
+    db.save_local(pickle_dir)
+    convert_langchain_store(pickle_dir, native_dir)
+    return pickle_dir, native_dir
+
+
+def measure(path, native):
+    """在目前的行程中載入並量測"""
+    from langchain_core.embeddings import FakeEmbeddings
+
+    from mojo_rag.native_index import NativeFAISS
+
+    start = time.perf_counter()
+    if native:
+        db = NativeFAISS(path)
+    else:
+        from langchain_community.vectorstores import FAISS
+        db = FAISS.load_local(path, FakeEmbeddings(size=DIM), allow_dangerous_deserialization=True)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    _, indices = db.index.search(np.random.rand(1, db.index.d).astype(np.float32), 3)
+    for i in indices[0]:
+        db.docstore.search(db.index_to_docstore_id[i]).page_content
+    first_query_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        'format': 'native' if native else 'pickle',
+        'load_ms': round(load_ms, 1),
+        'first_query_ms': round(first_query_ms, 1),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+
+def _measure_subprocess(path, native):
+    cmd = [sys.executable, __file__, '--measure', path]
+    if native:
+        cmd.append('--native')
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare index load time of the pickle and native formats')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--path', help='measure an existing faiss_db directory instead of synthetic ones')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--native', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.native)))
+        return
+
+    from mojo_rag.native_index import is_native_store
+
+    rows = []
+    if args.path:
+        rows.append({'size': 'existing', **_measure_subprocess(args.path, False)})
+        if is_native_store(args.path):
+            rows.append({'size': 'existing', **_measure_subprocess(args.path, True)})
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            for size in args.sizes:
+                pickle_dir, native_dir = build_synthetic(directory, size)
+                for path, native in ((pickle_dir, False), (native_dir, True)):
+                    rows.append({'size': size, **_measure_subprocess(path, native)})
+
+    print(f"\n{'size':>9} {'format':<7} {'load ms':>9} {'1st query ms':>13} {'peak RSS MB':>12}")
+    for row in rows:
+        print(f"{row['size']:>9} {row['format']:<7} {row['load_ms']:>9} {row['first_query_ms']:>13} "
+              f"{row['peak_rss_mb']:>12}")
+
+
+if __name__ == '__main__':
+    main()
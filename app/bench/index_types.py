@@ -0,0 +1,145 @@
+"""
+FAISS 索引類型的 recall / 延遲 / 記憶體比較
+
+以合成的分群向量（模擬正規化後的 sentence embedding）建立 flat、hnsw、ivf、
+ivfpq 索引（與 ingest.py --index-type 相同的建置方式），以 flat 的結果為標準答案，
+對每組檢索參數（efSearch / nprobe）量測：
+
+- recall@k：與 flat 前 k 名重疊的比例
+- 單一查詢延遲的 p50 / p99（線上每個子問題各查一次，預設單一 thread）
+- 建置時間與索引大小（序列化後的大小，即載入後常駐的記憶體）
+
+需在 app/ 目錄下執行（1M 筆、384 維的 flat 約需 1.5 GB 記憶體，hnsw 建置需數分鐘）：
+
+    python bench/index_types.py --sizes 10000 100000 1000000
+    python bench/index_types.py --sizes 100000 --types hnsw --ef-search 32 64 128 --output hnsw.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import faiss  # noqa: E402
+import numpy as np  # noqa: E402
+
+from mojo_rag.index_types import INDEX_TYPES, create_index, set_search_params, training_rows  # noqa: E402
+
+DIM = 384
+CLUSTERS = 256
+ADD_BLOCK = 65536
+
+
+def synthetic_vectors(size, dim, queries, seed=0):
+    """分群的單位向量；查詢取自相同分佈但不在資料庫中"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((CLUSTERS, dim), dtype=np.float32)
+
+    def sample(n):
+        out = np.empty((n, dim), dtype=np.float32)
+        for begin in range(0, n, ADD_BLOCK):
+            end = min(begin + ADD_BLOCK, n)
+            labels = rng.integers(0, CLUSTERS, end - begin)
+            block = centers[labels] + 0.6 * rng.standard_normal((end - begin, dim), dtype=np.float32)
+            out[begin:end] = block / np.linalg.norm(block, axis=1, keepdims=True)
+        return out
+
+    return sample(size), sample(queries)
+
+
+def percentile(values, p):
+    return round(float(np.percentile(values, p)), 3)
+
+
+def measure(index, queries, truth, k):
+    """逐筆查詢，回傳 recall@k 與延遲（毫秒）"""
+    latencies, hits = [], 0
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, found = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(found[0]) & set(truth[i]))
+    return {
+        'recall': round(hits / (len(queries) * k), 4),
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+
+def sweep(index_type, args):
+    """每種索引要掃過的檢索參數"""
+    if index_type == 'hnsw':
+        return [{'ef_search': ef} for ef in args.ef_search]
+    if index_type in ('ivf', 'ivfpq'):
+        return [{'nprobe': nprobe} for nprobe in args.nprobe]
+    return [{}]
+
+
+def bench_size(size, args):
+    print(f"\n== {size} vectors, dim {args.dim} ==")
+    data, queries = synthetic_vectors(size, args.dim, args.queries)
+
+    flat = faiss.IndexFlatL2(args.dim)
+    flat.add(data)
+    _, truth = flat.search(queries, args.k)
+
+    rows = []
+    for index_type in args.types:
+        start = time.perf_counter()
+        if index_type == 'flat':
+            index, info = flat, {'factory': 'Flat'}
+        else:
+            sample = training_rows(size, index_type, args.nlist)
+            params = {'nlist': args.nlist, 'pq_m': args.pq_m, 'hnsw_m': args.hnsw_m}
+            index, info = create_index(index_type, data[sample] if len(sample) else None, args.dim, size,
+                                       **{k: v for k, v in params.items() if v is not None})
+            for begin in range(0, size, ADD_BLOCK):
+                index.add(data[begin:begin + ADD_BLOCK])
+        build_s = round(time.perf_counter() - start, 2)
+        index_mb = round(len(faiss.serialize_index(index)) / 1024 / 1024, 1)
+
+        for search_params in sweep(index_type, args):
+            set_search_params(index, **search_params)
+            row = {'size': size, 'type': index_type, 'factory': info['factory'], 'params': search_params,
+                   'build_s': build_s, 'index_mb': index_mb, **measure(index, queries, truth, args.k)}
+            rows.append(row)
+            print(f"{index_type:<6} {info['factory']:<14} {json.dumps(search_params):<20} recall@{args.k} "
+                  f"{row['recall']:.4f}  p50 {row['p50_ms']:.3f} ms  p99 {row['p99_ms']:.3f} ms  "
+                  f"build {build_s}s  {index_mb} MB")
+        if index is not flat:
+            del index
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall vs latency vs memory of the FAISS index types')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=DIM)
+    parser.add_argument('--types', nargs='+', choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument('--k', type=int, default=3, help='top_k of retrieve_answers')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[16, 32, 64, 128, 256])
+    parser.add_argument('--nlist', type=int, help='IVF lists (default about 4 * sqrt(size))')
+    parser.add_argument('--pq-m', type=int, help='PQ bytes per vector (default dim / 8)')
+    parser.add_argument('--hnsw-m', type=int, help='HNSW neighbours per node (default 32)')
+    parser.add_argument('--threads', type=int, default=1, help='FAISS OpenMP threads for search')
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    rows = []
+    for size in args.sizes:
+        rows.extend(bench_size(size, args))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'dim': args.dim, 'k': args.k, 'threads': args.threads, 'results': rows}, f, indent=2)
+        print(f"\nwrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
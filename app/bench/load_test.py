@@ -0,0 +1,139 @@
+"""
+WSGI（gunicorn sync worker）與 ASGI（uvicorn）併發壓測
+
+會先啟動 bench/mock_openai.py，再分別以兩種模式啟動 app，
+對 /api/chat 或 /api/chat/stream 送出併發請求並比較吞吐量與延遲。
+需在 app/ 目錄下執行：
+
+    python bench/load_test.py --concurrency 32 --requests 64
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "夢酒館的品牌理念是什麼？",
+    "請推薦一杯適合夏天的清爽調酒",
+    "有哪些國際媒體報導過夢酒館？",
+]
+
+SERVER_COMMANDS = {
+    'wsgi': ['gunicorn', '--workers', '1', '--bind', '127.0.0.1:{port}', 'app:app'],
+    'asgi': ['uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', '{port}', '--log-level', 'warning'],
+}
+
+
+def _spawn(cmd, env=None):
+    return subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+async def _wait_ready(url, timeout=180):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.5)
+    raise TimeoutError(f"server at {url} did not start within {timeout}s")
+
+
+async def _one_request(client, base_url, endpoint, question):
+    start = time.perf_counter()
+    if endpoint == 'stream':
+        async with client.stream('POST', f"{base_url}/api/chat/stream", json={'message': question}) as resp:
+            async for line in resp.aiter_lines():
+                if '"type": "done"' in line or '"type": "error"' in line:
+                    break
+        ok = resp.status_code == 200
+    else:
+        resp = await client.post(f"{base_url}/api/chat", json={'message': question})
+        ok = resp.status_code == 200
+    return ok, time.perf_counter() - start
+
+
+async def run_load(base_url, endpoint, concurrency, total):
+    """以固定併發數送出 total 筆請求"""
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        async def worker(i):
+            async with semaphore:
+                return await _one_request(client, base_url, endpoint, QUESTIONS[i % len(QUESTIONS)])
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(worker(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'ok': sum(1 for ok, _ in results if ok),
+        'total': total,
+        'elapsed': elapsed,
+        'throughput': total / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+async def main_async(args):
+    mock_port, app_port = args.mock_port, args.app_port
+    mock = _spawn([
+        sys.executable, os.path.join('bench', 'mock_openai.py'),
+        '--port', str(mock_port), '--latency', str(args.latency),
+    ])
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{mock_port}/v1", OPENAI_API_KEY='mock')
+
+    reports = {}
+    try:
+        await _wait_ready(f"http://127.0.0.1:{mock_port}/stats")
+        for mode in args.modes:
+            cmd = [part.format(port=app_port) for part in SERVER_COMMANDS[mode]]
+            server = _spawn(cmd, env=env)
+            try:
+                base_url = f"http://127.0.0.1:{app_port}"
+                await _wait_ready(base_url)
+                await run_load(base_url, args.endpoint, 1, 1)  # warmup
+                reports[mode] = await run_load(base_url, args.endpoint, args.concurrency, args.requests)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    print(f"\nendpoint=/api/chat{'/stream' if args.endpoint == 'stream' else ''} "
+          f"concurrency={args.concurrency} requests={args.requests} mock_latency={args.latency}s")
+    print(f"{'mode':<6} {'ok':>7} {'elapsed(s)':>11} {'req/s':>8} {'p50(s)':>8} {'p95(s)':>8}")
+    for mode, r in reports.items():
+        print(f"{mode:<6} {r['ok']:>3}/{r['total']:<3} {r['elapsed']:>11.2f} {r['throughput']:>8.2f} "
+              f"{r['p50']:>8.2f} {r['p95']:>8.2f}")
+    if 'wsgi' in reports and 'asgi' in reports:
+        print(f"\nASGI throughput gain: {reports['asgi']['throughput'] / reports['wsgi']['throughput']:.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WSGI vs ASGI load test against a mock OpenAI server')
+    parser.add_argument('--modes', nargs='+', choices=sorted(SERVER_COMMANDS), default=['wsgi', 'asgi'])
+    parser.add_argument('--endpoint', choices=['chat', 'stream'], default='chat')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.8, help='mock OpenAI latency per call (s)')
+    parser.add_argument('--mock-port', type=int, default=9100)
+    parser.add_argument('--app-port', type=int, default=8090)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+本機 OpenAI 相容 stub server，用於離線壓測
+
+只實作 POST /v1/chat/completions（一般與 stream 兩種回應）：
+- 語意拆解請求：回傳 --decompositions 檔案中預先寫好的子問題，沒有的問題回傳原句構成的 JSON array
+- 其他請求：以固定速率吐出罐頭回答
+- 附上 tools 的請求（fast 模式）：--tool-call-rate 比例的請求改為回傳一次搜尋工具呼叫，
+  查詢取自 --decompositions（沒有時為原句）；tool_choice 為 none 時一律直接回答
+- 故障注入：一定比例的請求額外延遲（模擬尾端延遲）或直接回 500 / 429，
+  用來驗證 mojo_rag/resilience.py 的期限、重試、hedging 與降級
+
+Usage:
+    python bench/mock_openai.py --port 9100 --latency 0.8 --tokens-per-sec 50
+    python bench/mock_openai.py --decompositions bench/decompositions.json
+    python bench/mock_openai.py --slow-rate 0.05 --slow-latency 10 --error-rate 0.05
+    python bench/mock_openai.py --tool-call-rate 0.3 --decompositions bench/decompositions.json
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=mock python app.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+CANNED_ANSWER = (
+    "歡迎來到夢酒館！我們位於金門後浦十六藝文特區，"
+    "以金門在地的歷史與風土為靈感設計每一杯調酒。"
+    "如果您喜歡清爽的口味，可以先告訴我您的喜好，我再為您推薦。"
+)
+
+
+def _chunk_text(text, size=4):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def load_decompositions(path):
+    """{問題: [子問題, ...]} 的 JSON 檔"""
+    if not path:
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def create_mock_app(latency=0.8, tokens_per_sec=50.0, answer=CANNED_ANSWER, decompositions=None,
+                    slow_rate=0.0, slow_latency=10.0, error_rate=0.0, error_status=500, seed=None,
+                    tool_call_rate=0.0):
+    """latency：第一個 token 前的等待秒數；tokens_per_sec：之後的吐字速度；
+    decompositions：語意拆解的罐頭結果 {問題: [子問題, ...]}；
+    slow_rate / slow_latency：多少比例的請求額外延遲幾秒；error_rate / error_status：多少比例的請求直接回錯誤；
+    tool_call_rate：附上 tools 的請求中多少比例回傳工具呼叫"""
+    stats = {'requests': 0, 'in_flight': 0, 'max_in_flight': 0, 'slow': 0, 'errors': 0, 'tool_calls': 0}
+    decompositions = decompositions or {}
+    rng = random.Random(seed)
+
+    def _reply_for(messages):
+        user_content = messages[-1]['content'] if messages else ''
+        if 'JSON array' in user_content:
+            question = user_content.split('\n', 1)[-1].strip()
+            return json.dumps(decompositions.get(question, [question]), ensure_ascii=False)
+        return answer
+
+    def _tool_call_for(body, messages):
+        tools = body.get('tools') or []
+        if not tools or body.get('tool_choice') == 'none' or rng.random() >= tool_call_rate:
+            return None
+        user_content = (messages[-1].get('content') or '') if messages else ''
+        question = user_content.rsplit('旅客問題：', 1)[-1].strip()
+        return {
+            'id': 'call_mock',
+            'type': 'function',
+            'function': {
+                'name': tools[0]['function']['name'],
+                'arguments': json.dumps({'queries': decompositions.get(question, [question])}, ensure_ascii=False),
+            },
+        }
+
+    def _usage(messages, content):
+        # 以字數粗估 token 數，足以驗證 usage 的統計流程
+        prompt_tokens = sum(len(m.get('content') or '') for m in messages)
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(content),
+            'total_tokens': prompt_tokens + len(content),
+        }
+
+    def _completion(model, content, usage, tool_call=None):
+        message = {'role': 'assistant', 'content': content}
+        if tool_call is not None:
+            message = {'role': 'assistant', 'content': None, 'tool_calls': [tool_call]}
+        return {
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': message,
+                'finish_reason': 'stop' if tool_call is None else 'tool_calls',
+            }],
+            'usage': usage,
+        }
+
+    def _stream_chunk(model, delta, finish_reason=None):
+        return {
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        }
+
+    def _usage_chunk(model, usage):
+        # stream_options.include_usage：最後一個 chunk 只有 usage，choices 為空
+        return {
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [],
+            'usage': usage,
+        }
+
+    async def chat_completions(request):
+        body = await request.json()
+        model = body.get('model', 'mock')
+        messages = body.get('messages', [])
+        content = _reply_for(messages)
+        tool_call = _tool_call_for(body, messages)
+        if tool_call is not None:
+            stats['tool_calls'] += 1
+            content = tool_call['function']['arguments']
+        usage = _usage(messages, content)
+
+        stats['requests'] += 1
+        if rng.random() < error_rate:
+            stats['errors'] += 1
+            return JSONResponse({'error': {'message': 'injected failure', 'type': 'server_error'}},
+                                status_code=error_status)
+        delay = latency
+        if rng.random() < slow_rate:
+            stats['slow'] += 1
+            delay += slow_latency
+
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+
+        if not body.get('stream'):
+            try:
+                await asyncio.sleep(delay + len(content) / tokens_per_sec)
+                return JSONResponse(_completion(model, content, usage, tool_call))
+            finally:
+                stats['in_flight'] -= 1
+
+        async def generate():
+            try:
+                await asyncio.sleep(delay)
+                yield f"data: {json.dumps(_stream_chunk(model, {'role': 'assistant', 'content': ''}))}\n\n"
+                if tool_call is not None:
+                    # 與 OpenAI 相同：第一個片段帶 id 與名稱，參數分段送出
+                    head = dict(tool_call, index=0, function={'name': tool_call['function']['name'], 'arguments': ''})
+                    yield f"data: {json.dumps(_stream_chunk(model, {'tool_calls': [head]}))}\n\n"
+                for piece in _chunk_text(content):
+                    if tool_call is not None:
+                        delta = {'tool_calls': [{'index': 0, 'function': {'arguments': piece}}]}
+                    else:
+                        delta = {'content': piece}
+                    yield f"data: {json.dumps(_stream_chunk(model, delta))}\n\n"
+                    await asyncio.sleep(len(piece) / tokens_per_sec)
+                finish_reason = 'stop' if tool_call is None else 'tool_calls'
+                yield f"data: {json.dumps(_stream_chunk(model, {}, finish_reason))}\n\n"
+                if (body.get('stream_options') or {}).get('include_usage'):
+                    yield f"data: {json.dumps(_usage_chunk(model, usage))}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                stats['in_flight'] -= 1
+
+        return StreamingResponse(generate(), media_type='text/event-stream')
+
+    async def get_stats(request):
+        return JSONResponse(stats)
+
+    return Starlette(routes=[
+        Route('/v1/chat/completions', chat_completions, methods=['POST']),
+        Route('/stats', get_stats),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI-compatible mock server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.8, help='seconds before the first token')
+    parser.add_argument('--tokens-per-sec', type=float, default=50.0)
+    parser.add_argument('--decompositions', help='JSON file mapping questions to canned sub-queries')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of requests with extra latency')
+    parser.add_argument('--slow-latency', type=float, default=10.0, help='extra latency of slow requests (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP status of injected failures')
+    parser.add_argument('--seed', type=int, help='random seed for fault injection')
+    parser.add_argument('--tool-call-rate', type=float, default=0.0,
+                        help='fraction of tool-enabled requests answered with a search tool call')
+    args = parser.parse_args()
+
+    import uvicorn
+
+    app = create_mock_app(latency=args.latency, tokens_per_sec=args.tokens_per_sec,
+                          decompositions=load_decompositions(args.decompositions),
+                          slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                          error_rate=args.error_rate, error_status=args.error_status, seed=args.seed,
+                          tool_call_rate=args.tool_call_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
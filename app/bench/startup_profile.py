@@ -0,0 +1,212 @@
+"""
+冷啟動 profile（startup-profile）
+
+每次以全新的 Python 行程跑一遍與 app.py / modal_app.py 相同的啟動流程（import → 載入 embedding
+模型 → 向量資料庫 → 查詢向量快取 → warmup），輸出各階段的耗時與結束時的 RSS，以及
+`python -X importtime` 中最花時間的頂層套件，用來守住冷啟動預算、在本機抓出退步：
+
+    python bench/startup_profile.py --runs 3
+    python bench/startup_profile.py --budget 20 --max-rss-mb 1500
+    python bench/startup_profile.py --output bench/results/startup.json
+    python bench/startup_profile.py --compare bench/results/startup.json --max-regression 0.2
+
+需在 app/ 目錄下執行，讀取 .env 的設定（EMBEDDING_BACKEND、EMBEDDING_CACHE_DIR 等）。
+只量啟動，不呼叫 OpenAI；沒有設定 OPENAI_API_KEY 時以假的 key 建立 client。
+第一次之後作業系統的 page cache 已經有模型與索引檔，Modal 的冷啟動通常比這裡的中位數慢。
+"""
+import argparse
+import importlib
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARKER = "STARTUP_PROFILE "
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def child(faiss_path):
+    """在這個行程中跑一遍啟動流程，最後一行輸出各階段的 JSON"""
+    start = time.perf_counter()
+    sys.path.insert(0, APP_DIR)
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(APP_DIR, '.env'))
+    os.environ.setdefault('OPENAI_API_KEY', 'startup-profile')
+
+    from mojo_rag.metrics import STARTUP_PHASES, rss_bytes, startup_phase
+
+    with startup_phase("import"):
+        from mojo_rag.asgi import create_asgi_app
+        from mojo_rag.pipeline import RAGPipeline
+        # app.py 也會 import，只為了把它的成本算進 import 階段
+        importlib.import_module("mojo_rag.reloader")
+
+    pipeline = RAGPipeline.from_env(faiss_path)
+    with startup_phase("app"):
+        create_asgi_app(pipeline, os.path.join(APP_DIR, 'static'), os.path.join(APP_DIR, 'templates'))
+
+    print(MARKER + json.dumps({
+        'phases': STARTUP_PHASES,
+        'in_process_s': round(time.perf_counter() - start, 4),
+        'rss_bytes': rss_bytes(),
+    }))
+
+
+def top_imports(stderr, limit):
+    """-X importtime 輸出中 import 耗時最多的套件（秒）
+
+    以各模組自身的耗時（不含它再 import 的其他套件）依頂層套件加總，openai 的成本不會算到 import 它的 mojo_rag。
+    """
+    totals = {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            package = match.group(4).split('.')[0]
+            totals[package] = totals.get(package, 0) + int(match.group(1)) / 1e6
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return {name: round(seconds, 3) for name, seconds in ranked}
+
+
+def run_once(faiss_path, imports):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', '--faiss-path', faiss_path],
+        cwd=APP_DIR, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    lines = [line for line in proc.stdout.splitlines() if line.startswith(MARKER)]
+    if proc.returncode != 0 or not lines:
+        print(proc.stdout[-2000:])
+        print('\n'.join(line for line in proc.stderr.splitlines() if not IMPORT_LINE.match(line))[-2000:])
+        raise SystemExit(f"startup failed (exit {proc.returncode})")
+    result = json.loads(lines[-1][len(MARKER):])
+    result['process_s'] = round(wall, 4)
+    result['imports'] = top_imports(proc.stderr, imports)
+    return result
+
+
+def summarize(runs):
+    """各階段與總時間取中位數，RSS 取最大值"""
+    phases = {}
+    for run in runs:
+        for phase in run['phases']:
+            entry = phases.setdefault(phase['phase'], {'seconds': [], 'rss_bytes': []})
+            entry['seconds'].append(phase['seconds'])
+            entry['rss_bytes'].append(phase['rss_bytes'])
+    imports = {}
+    for run in runs:
+        for name, seconds in run['imports'].items():
+            imports.setdefault(name, []).append(seconds)
+    return {
+        'phases': {
+            name: {
+                'seconds_p50': round(statistics.median(entry['seconds']), 4),
+                'seconds_max': round(max(entry['seconds']), 4),
+                'rss_mb': round(max(entry['rss_bytes']) / 1024 / 1024, 1),
+            }
+            for name, entry in phases.items()
+        },
+        'process_s_p50': round(statistics.median(run['process_s'] for run in runs), 4),
+        'process_s_max': round(max(run['process_s'] for run in runs), 4),
+        'rss_mb': round(max(run['rss_bytes'] for run in runs) / 1024 / 1024, 1),
+        'imports_s_p50': {name: round(statistics.median(values), 3) for name, values in imports.items()},
+    }
+
+
+def print_report(summary):
+    print(f"{'phase':<18}{'p50':>9}{'max':>9}{'RSS after':>12}")
+    for name, phase in summary['phases'].items():
+        print(f"{name:<18}{phase['seconds_p50']:>8.2f}s{phase['seconds_max']:>8.2f}s{phase['rss_mb']:>9.0f} MB")
+    print(f"{'process total':<18}{summary['process_s_p50']:>8.2f}s{summary['process_s_max']:>8.2f}s"
+          f"{summary['rss_mb']:>9.0f} MB")
+    imports = sorted(summary['imports_s_p50'].items(), key=lambda item: item[1], reverse=True)
+    print("top imports: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in imports))
+
+
+def compare(baseline, current, max_regression=None):
+    """比較各階段與整個行程的中位數，回傳總時間是否退步超過門檻"""
+    print(f"\ncompare {baseline.get('commit')} -> {current.get('commit')}")
+    old, new = baseline['summary'], current['summary']
+    for name in new['phases']:
+        if name in old['phases']:
+            before, after = old['phases'][name]['seconds_p50'], new['phases'][name]['seconds_p50']
+            print(f"{name:<18}{before:>8.2f}s -> {after:.2f}s")
+    before, after = old['process_s_p50'], new['process_s_p50']
+    change = after / before - 1 if before else 0.0
+    print(f"{'process total':<18}{before:>8.2f}s -> {after:.2f}s ({change:+.1%})  "
+          f"RSS {old['rss_mb']:.0f} -> {new['rss_mb']:.0f} MB")
+    return max_regression is not None and change > max_regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-phase wall time and RSS of a cold app startup')
+    parser.add_argument('--faiss-path', default=os.path.join(APP_DIR, 'faiss_db'))
+    parser.add_argument('--runs', type=int, default=3, help='fresh processes to start')
+    parser.add_argument('--imports', type=int, default=8, help='top-level packages to list from -X importtime')
+    parser.add_argument('--budget', type=float, help='exit with status 1 if the median process time exceeds this (s)')
+    parser.add_argument('--max-rss-mb', type=float, help='exit with status 1 if RSS after startup exceeds this')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    parser.add_argument('--max-regression', type=float,
+                        help='exit with status 1 if the median process time grew by more than this fraction')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.faiss_path)
+        return
+
+    # 不在模組層 import：子行程的 import 時間不應包含 benchmark 工具本身
+    from e2e import git_commit
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    runs = []
+    for i in range(args.runs):
+        runs.append(run_once(args.faiss_path, args.imports))
+        print(f"run {i + 1}/{args.runs}: {runs[-1]['process_s']:.2f}s")
+    summary = summarize(runs)
+    print()
+    print_report(summary)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': {
+            'runs': args.runs,
+            'faiss_path': args.faiss_path,
+            'embedding_backend': os.getenv('EMBEDDING_BACKEND', 'torch'),
+            'python': sys.version.split()[0],
+        },
+        'summary': summary,
+        'runs': runs,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nresults written to {args.output}")
+
+    failed = []
+    if args.budget is not None and summary['process_s_p50'] > args.budget:
+        failed.append(f"startup {summary['process_s_p50']:.2f}s exceeds the {args.budget:.2f}s budget")
+    if args.max_rss_mb is not None and summary['rss_mb'] > args.max_rss_mb:
+        failed.append(f"RSS {summary['rss_mb']:.0f} MB exceeds {args.max_rss_mb:.0f} MB")
+    if baseline is not None and compare(baseline, report, args.max_regression):
+        failed.append(f"startup regressed by more than {args.max_regression:.0%}")
+    for message in failed:
+        print(f"\n❌ {message}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
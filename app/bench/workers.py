@@ -0,0 +1,141 @@
+"""
+gunicorn 多 worker 的記憶體與吞吐量
+
+以 1 / 2 / 4 / 8 個 worker 啟動 app（gunicorn.conf.py），分別在 preload（master
+載入後 fork）與 no-preload（每個 worker 各自載入）兩種模式下，先暖機讓每個 worker
+都處理過請求，再量測：
+
+- 每個 worker 的 USS（獨占記憶體，即多開一個 worker 實際增加的量）與 RSS
+- 所有行程的 PSS 總和（共用頁面依共用行程數分攤，約等於整組 server 的實際用量）
+- /api/chat 的吞吐量與 p50 / p95（OpenAI 由 bench/mock_openai.py 模擬）
+
+需在 app/ 目錄下執行（Linux，讀取 /proc/<pid>/smaps_rollup）：
+
+    python bench/workers.py --workers 1 2 4 8 --concurrency 32 --requests 128
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from load_test import _spawn, _wait_ready, run_load
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from mojo_rag.prefork import memory_mb  # noqa: E402
+
+MODES = {'preload': '1', 'no-preload': '0'}
+
+
+def child_pids(pid):
+    """直接子行程（gunicorn worker）的 pid"""
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # comm 可能含空白，ppid 在最後一個 ')' 之後的第二欄
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return sorted(children)
+
+
+async def wait_workers(pid, workers, timeout=300):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while len(child_pids(pid)) < workers:
+        if asyncio.get_running_loop().time() > deadline:
+            raise TimeoutError(f"gunicorn did not start {workers} workers within {timeout}s")
+        await asyncio.sleep(0.5)
+
+
+async def run_one(args, mode, workers):
+    env = dict(os.environ,
+               OPENAI_BASE_URL=f"http://127.0.0.1:{args.mock_port}/v1",
+               OPENAI_API_KEY='mock',
+               INDEX_RELOAD_INTERVAL='0',
+               RESPONSE_CACHE='0', SEMANTIC_CACHE='0', EMBEDDING_CACHE='0',
+               WEB_CONCURRENCY=str(workers),
+               GUNICORN_PRELOAD=MODES[mode],
+               GUNICORN_THREADS=str(args.threads))
+    server = _spawn(['gunicorn', '--bind', f'127.0.0.1:{args.app_port}', 'app:app'], env=env)
+    try:
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        await _wait_ready(base_url)
+        await wait_workers(server.pid, workers)
+        # 暖機：每個 worker 都載入過模型、碰過索引頁面
+        await run_load(base_url, 'chat', workers * args.threads, workers * args.threads * 2)
+        load = await run_load(base_url, 'chat', args.concurrency, args.requests)
+
+        worker_memory = [memory_mb(pid) for pid in child_pids(server.pid)]
+        master = memory_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'mode': mode,
+        'workers': workers,
+        'worker_uss_mb': round(sum(m['uss_mb'] for m in worker_memory) / len(worker_memory), 1),
+        'worker_rss_mb': round(sum(m['rss_mb'] for m in worker_memory) / len(worker_memory), 1),
+        'master_rss_mb': master['rss_mb'],
+        'total_pss_mb': round(master['pss_mb'] + sum(m['pss_mb'] for m in worker_memory), 1),
+        'ok': load['ok'],
+        'throughput': round(load['throughput'], 2),
+        'p50': round(load['p50'], 3),
+        'p95': round(load['p95'], 3),
+    }
+
+
+async def main_async(args):
+    mock = _spawn([
+        sys.executable, os.path.join('bench', 'mock_openai.py'),
+        '--port', str(args.mock_port), '--latency', str(args.latency),
+    ])
+    rows = []
+    try:
+        await _wait_ready(f"http://127.0.0.1:{args.mock_port}/stats")
+        for mode in args.modes:
+            for workers in args.workers:
+                row = await run_one(args, mode, workers)
+                rows.append(row)
+                print(json.dumps(row))
+    finally:
+        mock.terminate()
+        mock.wait()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-worker memory and throughput of the gunicorn preload mode')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=['preload', 'no-preload'])
+    parser.add_argument('--threads', type=int, default=1, help='GUNICORN_THREADS per worker')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=128)
+    parser.add_argument('--latency', type=float, default=0.8, help='mock OpenAI latency per call (s)')
+    parser.add_argument('--mock-port', type=int, default=9100)
+    parser.add_argument('--app-port', type=int, default=8090)
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args()
+
+    rows = asyncio.run(main_async(args))
+
+    print(f"\n{'mode':<11} {'workers':>7} {'USS/worker':>11} {'RSS/worker':>11} {'total PSS':>10} "
+          f"{'ok':>9} {'req/s':>8} {'p50(s)':>7} {'p95(s)':>7}")
+    for r in rows:
+        print(f"{r['mode']:<11} {r['workers']:>7} {r['worker_uss_mb']:>11} {r['worker_rss_mb']:>11} "
+              f"{r['total_pss_mb']:>10} {r['ok']:>4}/{args.requests:<4} {r['throughput']:>8} "
+              f"{r['p50']:>7} {r['p95']:>7}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
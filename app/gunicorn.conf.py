@@ -0,0 +1,42 @@
+"""
+gunicorn 設定：master 先載入模型與索引，再 fork 出共用唯讀資源的 worker
+
+    gunicorn app:app                              # 讀取本檔（需在 app/ 目錄下執行）
+    WEB_CONCURRENCY=4 gunicorn app:app
+
+詳見 mojo_rag/prefork.py。
+"""
+import os
+
+from dotenv import load_dotenv
+
+from mojo_rag.prefork import PRELOAD_ENV, limit_threads, prepare_fork, run_worker_hooks, worker_threads
+
+# 與 app.py 相同，讓 .env 中的 EMBEDDING_BACKEND 等設定在這裡也看得到
+load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# 每個 worker 的請求執行緒；大於 1 時使用 gthread worker，串流回答不會佔住整個 worker
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+# 串流回答可能持續數十秒
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+# ONNX Runtime 的執行緒池無法跨 fork 使用，ONNX 後端時各 worker 自行載入（索引仍以 mmap 共用）
+preload_app = (os.getenv("GUNICORN_PRELOAD", "1") == "1"
+               and os.getenv("EMBEDDING_BACKEND", "torch") != "onnx")
+if preload_app:
+    # 設定檔比 app 先載入：app 看到後把 warmup 與熱更新 watcher 留給 fork 後的 worker
+    os.environ[PRELOAD_ENV] = "1"
+
+
+def when_ready(server):
+    if preload_app:
+        prepare_fork()
+
+
+def post_fork(server, worker):
+    limit_threads(worker_threads(server.cfg.workers))
+    if preload_app:
+        # warmup 與熱更新 watcher
+        run_worker_hooks()
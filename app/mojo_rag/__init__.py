@@ -0,0 +1,6 @@
+"""
+夢酒館 RAG 品牌大使核心模組
+
+app/app.py（Flask）、app/asgi_app.py（ASGI）與 modal_app.py 共用的
+語意拆解 → 檢索 → 整合回答流程。
+"""
@@ -0,0 +1,118 @@
+"""
+ASGI（Starlette）版本的 web 介面
+
+與 Flask 版本的 /api/chat、/api/chat/stream 契約完全相同，但整條流程跑在
+asyncio 上：等待 OpenAI 回應時不佔用 worker，單一 container 可同時服務
+多組對話。
+"""
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from starlette.templating import Jinja2Templates
+
+from . import metrics
+from .pipeline import PIPELINE_MODES, sse_event
+
+
+def _static_url_for(endpoint, filename):
+    # index.html 使用 Flask 風格的 url_for('static', filename=...)
+    return f"/static/{filename}"
+
+
+def create_asgi_app(pipeline, static_folder, template_folder):
+    """建立 Starlette app"""
+    templates = Jinja2Templates(directory=template_folder)
+    templates.env.globals['url_for'] = _static_url_for
+
+    async def index(request):
+        """首頁"""
+        return templates.TemplateResponse(request, 'index.html')
+
+    async def metrics_endpoint(request):
+        """Prometheus 指標"""
+        return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    async def chat(request):
+        """處理聊天請求"""
+        try:
+            data = await request.json()
+            user_message = data.get('message', '').strip()
+            # 選填：同一個 session_id 的請求共用對話紀錄
+            session_id = data.get('session_id')
+            # 選填：full（LLM 拆解 + 生成）/ fast（單趟生成），未指定時使用 PIPELINE_MODE
+            mode = data.get('mode')
+
+            if not user_message:
+                return JSONResponse({'error': '請輸入訊息'}, status_code=400)
+
+            if mode is not None and mode not in PIPELINE_MODES:
+                return JSONResponse({'error': f'mode 必須是 {" / ".join(PIPELINE_MODES)}'}, status_code=400)
+
+            response = await pipeline.aanswer(user_message, session_id, mode)
+
+            return JSONResponse({
+                'response': response,
+                'session_id': session_id,
+                'status': 'success'
+            })
+
+        except Exception as e:
+            print(f"錯誤: {str(e)}")
+            return JSONResponse({
+                'error': '處理訊息時發生錯誤，請稍後再試',
+                'status': 'error'
+            }, status_code=500)
+
+    async def chat_stream(request):
+        """Streaming chat endpoint with thinking visualization"""
+        try:
+            data = await request.json()
+            user_message = data.get('message', '').strip()
+            # 選填：同一個 session_id 的請求共用對話紀錄
+            session_id = data.get('session_id')
+            # 選填：full（LLM 拆解 + 生成）/ fast（單趟生成），未指定時使用 PIPELINE_MODE
+            mode = data.get('mode')
+
+            if not user_message:
+                return JSONResponse({'error': '請輸入訊息'}, status_code=400)
+
+            if mode is not None and mode not in PIPELINE_MODES:
+                return JSONResponse({'error': f'mode 必須是 {" / ".join(PIPELINE_MODES)}'}, status_code=400)
+
+            async def generate():
+                try:
+                    async for event in pipeline.astream_events(user_message, session_id, mode):
+                        yield sse_event(event)
+
+                except Exception as e:
+                    print(f"Stream error: {str(e)}")
+                    yield sse_event({
+                        'type': 'error',
+                        'message': '處理訊息時發生錯誤'
+                    })
+
+            return StreamingResponse(
+                generate(),
+                media_type='text/event-stream',
+                headers={
+                    'Cache-Control': 'no-cache',
+                    'X-Accel-Buffering': 'no'
+                }
+            )
+
+        except Exception as e:
+            print(f"錯誤: {str(e)}")
+            return JSONResponse({
+                'error': '處理訊息時發生錯誤，請稍後再試',
+                'status': 'error'
+            }, status_code=500)
+
+    routes = [
+        Route('/', index),
+        Route('/metrics', metrics_endpoint),
+        Route('/api/chat', chat, methods=['POST']),
+        Route('/api/chat/stream', chat_stream, methods=['POST']),
+        Mount('/static', StaticFiles(directory=static_folder), name='static'),
+    ]
+    return Starlette(routes=routes)
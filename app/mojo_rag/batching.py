@@ -0,0 +1,139 @@
+"""
+查詢 embedding 的動態 micro-batching
+
+同時進行中的請求各自只有 1～3 個子問題，逐一送進 CPU 上的 sentence-transformers
+浪費了大部分矩陣運算的吞吐量。BatchingQueryEmbedding 把各請求的查詢文字放進
+同一個佇列，由單一排程 thread 收集成 micro-batch：
+
+- 收到第一筆時佇列中沒有其他請求就立即送出（並行度 1 時不多等）；已有其他請求在等待時
+  最多再等 max_wait_ms，或湊滿 max_batch_size 筆文字就送出
+- 每個 batch 只跑一次 forward pass，再把向量依序分回各個等待中的呼叫者
+- 模型運算期間進來的請求自然累積成下一個 batch
+
+同步呼叫（embed_queries）在呼叫端的 thread 等待；asyncio 呼叫（aembed_queries）
+只等待 future，不佔用 thread pool。佇列長度與 batch 大小輸出到 /metrics。
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .metrics import EMBED_BATCH_REQUESTS, EMBED_BATCH_SIZE, EMBED_QUEUE_DEPTH, STAGE_SECONDS
+from .prefork import after_fork_in_child
+
+
+class BatchingQueryEmbedding(Embeddings):
+    """將並行請求的 embed_queries 合併成 micro-batch；embed_documents 直接轉給內層模型"""
+
+    def __init__(self, inner, max_batch_size=32, max_wait_ms=5.0):
+        self.inner = inner
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # gunicorn preload 時排程 thread 不會跟著 fork，子行程第一次使用時重新啟動
+        after_fork_in_child(self._after_fork)
+
+    def _after_fork(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, inner):
+        """EMBEDDING_BATCHING=0 時直接回傳原本的模型"""
+        if os.getenv("EMBEDDING_BATCHING", "1") != "1":
+            return inner
+        return cls(
+            inner,
+            max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32")),
+            max_wait_ms=float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5")),
+        )
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        """回傳 float32 矩陣；在呼叫端的 thread 等待所屬的 batch 完成"""
+        return self.submit(texts).result()
+
+    async def aembed_queries(self, texts):
+        """embed_queries 的 async 版本"""
+        return await asyncio.wrap_future(self.submit(texts))
+
+    def submit(self, texts):
+        """把查詢放進佇列，回傳 concurrent.futures.Future"""
+        future = Future()
+        if not texts:
+            future.set_result(np.zeros((0, 0), dtype=np.float32))
+            return future
+        self._ensure_started()
+        self._queue.put((list(texts), future))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        """等待第一筆請求；佇列中還有其他請求時，再於 max_wait 內盡量湊滿一個 batch"""
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        if self._queue.empty():
+            # 沒有其他並行的請求，等待只會增加延遲
+            return batch
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        # 排程 thread 結束後所有 embedding 呼叫都會永遠等待，任何例外都不能讓迴圈跳出
+        while True:
+            try:
+                self._run_batch(self._collect())
+            except Exception as e:
+                print(f"embedding micro-batch 失敗: {e}")
+
+    def _run_batch(self, batch):
+        # 已取消的呼叫（ASGI 連線中斷、預先檢索被取消）不再計算，也不能再設定結果
+        batch = [(item_texts, future) for item_texts, future in batch if future.set_running_or_notify_cancel()]
+        EMBED_QUEUE_DEPTH.set(self._queue.qsize())
+        if not batch:
+            return
+        texts = [text for item_texts, _ in batch for text in item_texts]
+        EMBED_BATCH_SIZE.observe(len(texts))
+        EMBED_BATCH_REQUESTS.observe(len(batch))
+
+        start = time.perf_counter()
+        try:
+            vectors = np.asarray(self.inner.embed_queries(texts), dtype=np.float32)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="embedding_batch")
+
+        offset = 0
+        for item_texts, future in batch:
+            future.set_result(vectors[offset:offset + len(item_texts)])
+            offset += len(item_texts)
@@ -0,0 +1,146 @@
+"""
+大量文件的平行 embedding
+
+知識庫建置時的 generator pipeline：
+
+    (列號, 文字) → 依 token 長度在視窗內排序 → 分批 → process pool → 依列號寫入磁碟
+
+- 在 WINDOW_BATCHES 個 batch 的視窗內依 token 長度排序，同一批的長度接近，
+  padding 最少，又不必一次讀入整個語料
+- 每個 worker 行程各自載入一份模型，torch / ONNX Runtime 的執行緒數平均分配
+- 向量依列號寫入 memory-mapped 的 float32 檔案，記憶體用量與語料大小無關
+"""
+import os
+import resource
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing import get_context
+
+import numpy as np
+
+WINDOW_BATCHES = 32
+
+_worker_model = None
+
+
+def _init_worker(model_name, backend, num_threads):
+    global _worker_model
+    if backend != "onnx":
+        try:
+            import torch
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+    from .embeddings import load_embedding_model
+
+    _worker_model, _ = load_embedding_model(model_name, backend=backend, num_threads=num_threads)
+
+
+def _embed_batch(rows, texts):
+    vectors = np.asarray(_worker_model.embed_documents(texts), dtype=np.float32)
+    return rows, vectors
+
+
+def peak_rss_mb():
+    """目前行程與已結束子行程中最大的峰值 RSS（MB）"""
+    own = 0.0
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                own = int(line.split()[1]) / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {"main": round(own, 1), "worker": round(children, 1)}
+
+
+class BulkEmbedder:
+    """以 process pool 平行 embedding；workers <= 1 時在目前的行程中執行"""
+
+    def __init__(self, model_name, backend=None, workers=1, batch_size=64, embedding_model=None):
+        self.model_name = model_name
+        self.backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+        self.workers = workers
+        self.batch_size = batch_size
+        self.embedding_model = embedding_model
+        self._tokenizer = None
+        self.report = {}
+
+    def _token_lengths(self, texts):
+        """排序用的 token 長度；沒有 tokenizer 時以字數代替"""
+        if self._tokenizer is None:
+            try:
+                from transformers import AutoTokenizer
+                self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            except (ImportError, OSError):
+                self._tokenizer = False
+        if not self._tokenizer:
+            return [len(t) for t in texts]
+        return [len(ids) for ids in self._tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def batches(self, items):
+        """將 (列號, 文字) 依 token 長度在視窗內排序後分批"""
+        items = iter(items)
+        while True:
+            window = list(islice(items, self.batch_size * WINDOW_BATCHES))
+            if not window:
+                return
+            lengths = self._token_lengths([text for _, text in window])
+            window = [item for _, item in sorted(zip(lengths, window), key=lambda pair: pair[0])]
+            for start in range(0, len(window), self.batch_size):
+                batch = window[start:start + self.batch_size]
+                yield [row for row, _ in batch], [text for _, text in batch]
+
+    def embed(self, items):
+        """依序產生 (列號 list, 向量矩陣)；完成順序不一定與輸入相同"""
+        if self.workers <= 1:
+            if self.embedding_model is None:
+                from .embeddings import load_embedding_model
+                self.embedding_model, _ = load_embedding_model(self.model_name, backend=self.backend)
+            for rows, texts in self.batches(items):
+                yield rows, np.asarray(self.embedding_model.embed_documents(texts), dtype=np.float32)
+            return
+
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.model_name, self.backend, threads),
+        ) as pool:
+            pending = set()
+            for rows, texts in self.batches(items):
+                # 最多 2 * workers 個 batch 在途中，避免文字整批堆在佇列裡
+                if len(pending) >= self.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                pending.add(pool.submit(_embed_batch, rows, texts))
+            for future in pending:
+                yield future.result()
+
+    def embed_to_file(self, items, path, total_rows):
+        """將向量依列號寫入 (total_rows, dim) 的 float32 memmap，回傳 (memmap, 已寫入的列)"""
+        start = time.perf_counter()
+        matrix = None
+        written = []
+        for rows, vectors in self.embed(items):
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                                   shape=(total_rows, vectors.shape[1]))
+            matrix[rows] = vectors
+            written.extend(rows)
+            elapsed = time.perf_counter() - start
+            print(f"embedding {len(written)} chunks ({len(written) / elapsed:.1f} chunks/s)")
+        if matrix is not None:
+            matrix.flush()
+
+        elapsed = time.perf_counter() - start
+        self.report = {
+            "chunks": len(written),
+            "seconds": round(elapsed, 2),
+            "chunks_per_sec": round(len(written) / elapsed, 1) if written and elapsed else 0.0,
+            "workers": self.workers,
+            "batch_size": self.batch_size,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        return matrix, written
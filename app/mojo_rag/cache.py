@@ -0,0 +1,224 @@
+"""
+回應快取：語意拆解結果與最終回答
+
+兩層架構：
+- LRUCache：行程內、有筆數上限與 TTL
+- DiskCache：選用的磁碟層（每個 key 一個 JSON 檔，有檔案數上限），可放在 Modal Volume 上，
+  container 重啟後仍然有效
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_question(text):
+    """快取 key 用的問句正規化：全形轉半形、忽略大小寫與多餘空白"""
+    text = unicodedata.normalize("NFKC", str(text))
+    return " ".join(text.lower().split())
+
+
+def text_hash(*parts):
+    """prompt 模板等內容的短 hash"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def cache_key(kind, question, model, prompt_hash, index_version=""):
+    """由正規化問句、模型、prompt 模板 hash 與索引版本組成快取 key"""
+    raw = json.dumps([kind, normalize_question(question), model, prompt_hash, index_version],
+                     ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """thread-safe、有筆數上限與 TTL 的記憶體快取"""
+
+    def __init__(self, max_entries=1024, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskCache:
+    """每個 key 一個 JSON 檔的持久化快取，寫入時以 rename 保證原子性
+
+    檔案數超過 max_entries 時依最後使用時間（檔案的 mtime，命中時更新）刪掉最舊的；
+    每寫入 max_entries / 10 筆才掃描一次目錄，實際檔案數最多超出上限約一成。
+    """
+
+    # 寫到一半的暫存檔超過這個秒數仍在，視為中斷的寫入
+    STALE_TMP_SECONDS = 3600
+
+    def __init__(self, directory, ttl=86400, max_entries=10000):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._prune_every = max(1, max_entries // 10)
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item.get("expires_at", 0) < time.time():
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            return None
+        try:
+            # mtime 當作最後使用時間，prune 時依此淘汰
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return item.get("value")
+
+    def set(self, key, value):
+        payload = {"expires_at": time.time() + self.ttl, "value": value}
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"快取寫入失敗: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._writes += 1
+            due = self._writes >= self._prune_every
+            if due:
+                self._writes = 0
+        if due:
+            self.prune()
+
+    def prune(self):
+        """刪除一定已過期的項目與中斷的暫存檔，再依最後使用時間淘汰超過 max_entries 的部分"""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if entry.name.endswith(".tmp"):
+                expired = mtime < now - self.STALE_TMP_SECONDS
+            elif entry.name.endswith(".json"):
+                # expires_at 為寫入時間 + ttl，不晚於 mtime + ttl
+                expired = mtime + self.ttl < now
+                if not expired:
+                    entries.append((mtime, entry.path))
+            else:
+                continue
+            if expired:
+                self._remove(entry.path)
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        # 多個行程可能同時淘汰同一個檔案
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+class ResponseCache:
+    """記憶體 LRU 在前、磁碟層在後的多層快取"""
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        """依環境變數建立快取；RESPONSE_CACHE=0 時回傳 None"""
+        if os.getenv("RESPONSE_CACHE", "1") != "1":
+            return None
+        ttl = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+        memory = LRUCache(max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "1024")), ttl=ttl)
+        cache_dir = os.getenv("RESPONSE_CACHE_DIR")
+        disk = None
+        if cache_dir:
+            disk = DiskCache(cache_dir, ttl=ttl, max_entries=int(os.getenv("RESPONSE_CACHE_DISK_SIZE", "10000")))
+        return cls(memory, disk)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
@@ -0,0 +1,135 @@
+"""
+檢索結果的 context 打包
+
+retrieve_answers 的結果以子問題為單位，子問題彼此相近時同一個 chunk 會重複出現。
+ContextPacker 在組 prompt 之前：
+
+1. 以文件 id 去除跨子問題的重複 chunk，保留最高的相似度分數
+2. 依分數由高到低排序
+3. 在 token 預算內盡量放入 chunk，超出的捨棄（第一個 chunk 太長時截斷）
+4. 輸出精簡的編號列表，取代原本的 Python repr（沒有引號跳脫與 dict key）
+
+token 數優先以 tiktoken 計算，沒有安裝時以字元數估算（中日韓文字一字一 token，
+其他約四個字元一 token）。
+"""
+import hashlib
+import os
+import re
+from collections import namedtuple
+
+DEFAULT_TOKEN_BUDGET = 3000
+
+# text：放進 prompt 的 context；stats：打包前後的 chunk 數與 token 數
+PackedContext = namedtuple("PackedContext", ["text", "stats"])
+
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+class TokenCounter:
+    """依模型計算 token 數；沒有 tiktoken 時改用估算"""
+
+    def __init__(self, model=None):
+        self.encoding = None
+        try:
+            import tiktoken
+        except ImportError:
+            return
+        try:
+            self.encoding = tiktoken.encoding_for_model(model or "")
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        cjk = len(_CJK.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    def truncate(self, text, max_tokens):
+        """截斷成不超過 max_tokens 的前綴"""
+        if self.encoding is not None:
+            return self.encoding.decode(self.encoding.encode(text)[:max_tokens])
+        while text and self.count(text) > max_tokens:
+            text = text[:int(len(text) * max_tokens / self.count(text)) or len(text) - 1]
+        return text
+
+
+def compact_text(text):
+    """去掉行尾空白與多餘的空行"""
+    text = re.sub(r"[ \t]+\n", "\n", text.strip())
+    return re.sub(r"\n{3,}", "\n\n", text)
+
+
+def _chunk_id(text):
+    # 舊版快取的檢索結果沒有 ids，以內容 hash 代替
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def dedupe_chunks(retrieved_answers):
+    """將各子問題的 chunk 攤平並去重，回傳依分數排序的 [{id, text, score, sub_queries}]"""
+    merged = {}
+    for number, result in enumerate(retrieved_answers, start=1):
+        chunks = result.get("chunks", [])
+        ids = result.get("ids") or [_chunk_id(text) for text in chunks]
+        # 沒有分數時以名次代替，排名越前面分數越高
+        scores = result.get("scores") or [-rank for rank in range(len(chunks))]
+        for chunk_id, text, score in zip(ids, chunks, scores):
+            entry = merged.get(chunk_id)
+            if entry is None:
+                merged[chunk_id] = {"id": chunk_id, "text": text, "score": score, "sub_queries": [number]}
+                continue
+            entry["score"] = max(entry["score"], score)
+            if number not in entry["sub_queries"]:
+                entry["sub_queries"].append(number)
+    # sorted 是穩定排序，同分時保留原本的檢索順序
+    return sorted(merged.values(), key=lambda entry: entry["score"], reverse=True)
+
+
+class ContextPacker:
+    """把檢索結果去重、排序並裁切到 token 預算內"""
+
+    def __init__(self, token_budget=DEFAULT_TOKEN_BUDGET, model=None):
+        # token_budget <= 0 表示不限制
+        self.token_budget = token_budget
+        self.counter = TokenCounter(model)
+
+    @classmethod
+    def from_env(cls, model=None):
+        return cls(int(os.getenv("CONTEXT_TOKEN_BUDGET", str(DEFAULT_TOKEN_BUDGET))), model)
+
+    def pack(self, retrieved_answers):
+        """回傳 PackedContext"""
+        sub_queries = [result["sub_query"] for result in retrieved_answers]
+        header = "子問題：\n" + "\n".join(f"{i}. {q}" for i, q in enumerate(sub_queries, start=1))
+        entries = dedupe_chunks(retrieved_answers)
+
+        used = self.counter.count(header)
+        lines = []
+        for entry in entries:
+            label = f"[{len(lines) + 1}]"
+            if len(sub_queries) > 1:
+                label += f"（子問題 {'、'.join(str(n) for n in entry['sub_queries'])}）"
+            line = f"{label}{compact_text(entry['text'])}"
+            tokens = self.counter.count(line) + 1
+            if self.token_budget > 0 and used + tokens > self.token_budget:
+                if lines:
+                    continue
+                # 至少保留分數最高的 chunk
+                line = self.counter.truncate(line, max(self.token_budget - used - 1, 0))
+                tokens = self.counter.count(line) + 1
+            lines.append(line)
+            used += tokens
+
+        text = f"{header}\n\n資料：\n" + "\n".join(lines)
+        stats = {
+            "chunks": sum(len(result.get("chunks", [])) for result in retrieved_answers),
+            "unique_chunks": len(entries),
+            "packed_chunks": len(lines),
+            # 打包前的 prompt 直接放入 [{sub_query, chunks}] 的 repr
+            "tokens_before": self.counter.count(str([
+                {"sub_query": result["sub_query"], "chunks": result.get("chunks", [])} for result in retrieved_answers
+            ])),
+            "tokens_after": self.counter.count(text),
+            "token_budget": self.token_budget,
+        }
+        return PackedContext(text, stats)
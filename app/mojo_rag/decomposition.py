@@ -0,0 +1,183 @@
+"""
+語意拆解的本地快速路徑
+
+單一子句的短問題丟給 LLM 拆解，永遠只會拿回 [user_input]，卻要付一整趟
+chat completion 的延遲與費用。DecompositionRouter 在呼叫 LLM 前先判斷
+是否真的需要拆解：
+
+- rules：依中文連接詞、標點與疑問詞數量判斷；有疑慮一律交給 LLM
+- hybrid：規則判斷不確定時，再用 E5 向量的最近中心分類器決定
+- llm：永遠呼叫 LLM（原本的行為）
+
+fast 模式（PIPELINE_MODE=fast）完全不呼叫 LLM 拆解，以 local_variants 在本地切出子句，
+與原句一起檢索。
+"""
+import os
+import re
+
+import numpy as np
+
+# 句子分隔標點：出現多個子句時幾乎一定需要拆解
+CLAUSE_SEPARATORS = re.compile(r"[？?！!。；;\n]")
+
+# 明確連接兩個子句的詞
+STRONG_CONJUNCTIONS = (
+    "還有", "以及", "並且", "而且", "同時", "另外", "此外", "順便",
+    "然後", "再來", "也想", "也請", "也要", "或是", "還是",
+)
+
+# 常只是連接名詞（例如「金門和夢酒館」），需要進一步判斷
+WEAK_CONJUNCTIONS = ("和", "與", "跟", "及", "、", "，", ",")
+
+QUESTION_WORDS = re.compile(r"什麼|哪些|哪裡|哪一|如何|怎麼|為什麼|多少|幾|誰")
+
+# fast 模式切分子句用
+CONJUNCTION_SPLIT = re.compile("|".join(STRONG_CONJUNCTIONS))
+WEAK_SEPARATORS = re.compile(r"[，,、]")
+MAX_LOCAL_VARIANTS = 3
+
+# 超過這個長度的問題交給 LLM
+MAX_LOCAL_LENGTH = 40
+
+# hybrid 模式的種子範例
+SINGLE_EXAMPLES = [
+    "夢酒館的品牌理念是什麼？",
+    "請推薦一杯適合夏天的清爽調酒",
+    "有哪些國際媒體報導過夢酒館？",
+    "夢酒館在哪裡？",
+    "純愛古崗的酒精濃度是多少？",
+    "金門和夢酒館有什麼關係？",
+    "推薦調酒",
+    "夢酒館的故事",
+]
+COMPOUND_EXAMPLES = [
+    "夢酒館登過哪些國際媒體，分別是哪些調酒？",
+    "請推薦一杯調酒，並說明夢酒館在地方所做的貢獻",
+    "夢酒館在哪裡？營業時間是幾點？",
+    "我喜歡清爽的調酒，也想知道有哪些媒體報導",
+    "介紹一下品牌故事以及最有名的調酒",
+    "夢酒館的價格如何，還有推薦哪一杯？",
+]
+
+
+def split_clauses(text):
+    """以句子分隔標點切出非空的子句"""
+    return [part.strip() for part in CLAUSE_SEPARATORS.split(text) if part.strip()]
+
+
+def local_variants(text, max_variants=MAX_LOCAL_VARIANTS):
+    """不呼叫 LLM，從問句切出額外的檢索查詢（不含原句）
+
+    以句子分隔標點與明確的連接詞切分；逗號切出的片段有兩個以上各自帶疑問詞時，也視為獨立子句。
+    """
+    text = text.strip()
+    # 與原句只差在句尾標點的子句不算變體
+    whole = text.strip("？?！!。；;，,、 ")
+    parts = []
+    for clause in split_clauses(text):
+        for piece in CONJUNCTION_SPLIT.split(clause):
+            pieces = WEAK_SEPARATORS.split(piece)
+            if sum(1 for p in pieces if QUESTION_WORDS.search(p)) > 1:
+                parts.extend(pieces)
+            else:
+                parts.append(piece)
+
+    variants = []
+    for part in parts:
+        part = part.strip(" ，,、")
+        if len(part) >= 2 and part != whole and part not in variants:
+            variants.append(part)
+    return variants[:max_variants]
+
+
+def rule_decision(text):
+    """規則判斷，回傳 'single'、'compound' 或 'uncertain' 以及原因"""
+    text = text.strip()
+    if len(text) > MAX_LOCAL_LENGTH:
+        return "compound", f"length>{MAX_LOCAL_LENGTH}"
+    if len(split_clauses(text)) > 1:
+        return "compound", "multiple clauses"
+    for word in STRONG_CONJUNCTIONS:
+        if word in text:
+            return "compound", f"conjunction:{word}"
+    if len(QUESTION_WORDS.findall(text)) > 1:
+        return "compound", "multiple question words"
+    for word in WEAK_CONJUNCTIONS:
+        if word in text:
+            return "uncertain", f"weak conjunction:{word}"
+    return "single", "single clause"
+
+
+class EmbeddingDecompositionClassifier:
+    """以 E5 向量與單句 / 複合句兩個中心的相似度判斷"""
+
+    def __init__(self, embedding_model, single_examples=SINGLE_EXAMPLES, compound_examples=COMPOUND_EXAMPLES):
+        self.embedding_model = embedding_model
+        self.single_examples = single_examples
+        self.compound_examples = compound_examples
+        self._centroids = None
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    def _load_centroids(self):
+        if self._centroids is None:
+            single = self._normalize(self.embedding_model.embed_queries(self.single_examples)).mean(axis=0)
+            compound = self._normalize(self.embedding_model.embed_queries(self.compound_examples)).mean(axis=0)
+            self._centroids = self._normalize(np.stack([single, compound]))
+        return self._centroids
+
+    def is_compound(self, text):
+        centroids = self._load_centroids()
+        vector = self._normalize(self.embedding_model.embed_queries([text]))[0]
+        single_score, compound_score = centroids @ vector
+        return bool(compound_score > single_score)
+
+
+class DecompositionRouter:
+    """決定語意拆解要走本地快速路徑還是 LLM"""
+
+    MODES = ("llm", "rules", "hybrid")
+
+    def __init__(self, mode="rules", classifier=None):
+        if mode not in self.MODES:
+            raise ValueError(f"未知的 DECOMPOSITION_ROUTER: {mode}")
+        self.mode = mode
+        self.classifier = classifier
+        self.local = 0
+        self.llm = 0
+
+    @classmethod
+    def from_env(cls, embedding_model=None):
+        mode = os.getenv("DECOMPOSITION_ROUTER", "rules")
+        classifier = None
+        if mode == "hybrid" and embedding_model is not None:
+            classifier = EmbeddingDecompositionClassifier(embedding_model)
+        return cls(mode, classifier)
+
+    def decide(self, text):
+        """回傳 (是否需要 LLM 拆解, 原因)"""
+        if self.mode == "llm":
+            return True, "router disabled"
+
+        label, reason = rule_decision(text)
+        if label == "uncertain":
+            if self.classifier is not None:
+                label = "compound" if self.classifier.is_compound(text) else "single"
+                reason = f"{reason} -> embedding:{label}"
+            else:
+                # 沒有分類器時寧可多呼叫一次 LLM，也不要漏拆
+                label = "compound"
+        return label == "compound", reason
+
+    def route(self, text):
+        """判斷並記錄決策"""
+        needs_llm, reason = self.decide(text)
+        if needs_llm:
+            self.llm += 1
+        else:
+            self.local += 1
+        print(f"語意拆解路由: {'llm' if needs_llm else 'local'} ({reason}) {text[:30]!r}")
+        return needs_llm
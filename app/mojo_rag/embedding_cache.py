@@ -0,0 +1,281 @@
+"""
+查詢向量快取
+
+子問題在不同使用者之間大量重複，每次都要在 CPU 上跑一次 sentence-transformers
+forward pass。CachedQueryEmbedding 包住任何有 embed_queries 的 embedding 類別：
+
+- 記憶體層：float32 向量的 LRU
+- 磁碟層（選用）：MmapVectorStore，每個寫入者（container）一組可 memory-map 的
+  float32 矩陣檔加上 append-only 的 key 檔，可放在 Modal Volume 上，剛啟動的
+  container 也能直接讀到其他 container 算過的向量
+
+各層的命中與未命中次數見 /metrics 的 mojo_rag_embedding_cache_total{tier="memory|disk|miss"}。
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import socket
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .cache import LRUCache
+from .metrics import EMBEDDING_CACHE
+
+
+def embedding_key(model_name, prefixed_text):
+    """以模型名稱與含前綴的文字組成 key"""
+    raw = f"{model_name}\0{prefixed_text}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+class VectorSegment:
+    """單一寫入者的 memory-mapped 向量檔
+
+    vectors.f32 是預先配置、容量不足時加倍的 float32 矩陣；keys.txt 每行一個
+    key，行號即為向量所在的列。先寫向量再寫 key，讀到 key 就代表向量已完整。
+    同一台機器上的多個行程（gunicorn worker）以 flock 協調寫入；其他寫入者的
+    segment 以唯讀開啟，讀取端在找不到 key 時才重新掃描 keys.txt。
+    """
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, directory, dim, writable=False):
+        self.directory = directory
+        self.dim = dim
+        self.writable = writable
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._keys_path = os.path.join(directory, "keys.txt")
+        self._lock_path = os.path.join(directory, ".lock")
+        self.rows = {}
+        self._keys_offset = 0
+        self._matrix = None
+        self.refresh()
+
+    def refresh(self):
+        """讀取其他行程新增的 key"""
+        if not os.path.exists(self._keys_path):
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        # 只處理完整的行，寫到一半的留給下次
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self.rows[line.decode("ascii")] = len(self.rows)
+        self._keys_offset += end
+
+    def _map(self, min_rows=0):
+        """必要時擴大檔案並重新 memory-map；唯讀的 segment 不擴大，回傳目前的容量"""
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        capacity = size // (self.dim * 4)
+        if self.writable and capacity < min_rows:
+            capacity = max(self.INITIAL_CAPACITY, capacity)
+            while capacity < min_rows:
+                capacity *= 2
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(capacity * self.dim * 4)
+        if capacity == 0:
+            return None
+        if self._matrix is None or self._matrix.shape[0] != capacity:
+            mode = "r+" if self.writable else "r"
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+        return self._matrix
+
+    def get_many(self, keys):
+        found = {key: self.rows[key] for key in keys if key in self.rows}
+        if not found:
+            return {}
+        matrix = self._map(max(found.values()) + 1)
+        # 唯讀 segment 的向量檔可能比 keys.txt 舊（volume 尚未同步完整），超出的列當作沒有
+        capacity = 0 if matrix is None else matrix.shape[0]
+        return {key: np.array(matrix[row]) for key, row in found.items() if row < capacity}
+
+    def put_many(self, items):
+        with open(self._lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                new_items = [(key, vector) for key, vector in items.items() if key not in self.rows]
+                if not new_items:
+                    return
+                start = len(self.rows)
+                matrix = self._map(start + len(new_items))
+                for offset, (_, vector) in enumerate(new_items):
+                    matrix[start + offset] = vector
+                matrix.flush()
+                with open(self._keys_path, "a", encoding="ascii") as f:
+                    f.write("".join(f"{key}\n" for key, _ in new_items))
+                self.refresh()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class MmapVectorStore:
+    """多個 container 共用的向量快取目錄，每個寫入者一個 segment
+
+    directory/<writer>/ 只由同一台機器（container）寫入：Modal Volume 以檔案為單位
+    last-writer-wins，flock 也無法跨 container 協調，多個 container 寫同一組
+    keys.txt / vectors.f32 會讓兩個檔案對不上，查到別的查詢的向量。
+    讀取時依修改時間由新到舊查最多 max_segments 個 segment；已結束的 container 留下的
+    segment 只會被讀取，可以直接刪除整個目錄。
+    """
+
+    def __init__(self, directory, dim, writer=None, max_segments=16):
+        self.directory = directory
+        self.dim = dim
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        self._write_meta()
+        self.writer = re.sub(r"[^A-Za-z0-9_.-]+", "_", writer or socket.gethostname())
+        self._lock = threading.Lock()
+        with self._lock:
+            self._own = VectorSegment(os.path.join(directory, self.writer), dim, writable=True)
+            self._segments = {self.writer: self._own}
+            self._refresh_segments()
+
+    def _write_meta(self):
+        meta_path = os.path.join(self.directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("dim") != self.dim:
+                raise ValueError(f"{self.directory} 的向量維度為 {meta.get('dim')}，與模型的 {self.dim} 不符")
+            return
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "dtype": "float32"}, f)
+
+    def _refresh_segments(self):
+        """重新掃描其他寫入者的 segment（自己的 segment 之外最新的 max_segments - 1 個）"""
+        others = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and entry.name != self.writer:
+                keys_path = os.path.join(entry.path, "keys.txt")
+                if os.path.exists(keys_path):
+                    others.append((os.path.getmtime(keys_path), entry.name))
+        names = [name for _, name in sorted(others, reverse=True)[:max(0, self.max_segments - 1)]]
+        segments = {self.writer: self._own}
+        for name in names:
+            segment = self._segments.get(name) or VectorSegment(os.path.join(self.directory, name), self.dim)
+            segment.refresh()
+            segments[name] = segment
+        self._own.refresh()
+        self._segments = segments
+
+    def _lookup(self, keys):
+        found = {}
+        for segment in self._segments.values():
+            missing = [key for key in keys if key not in found]
+            if not missing:
+                break
+            found.update(segment.get_many(missing))
+        return found
+
+    def get_many(self, keys):
+        """回傳 {key: 向量}，只包含找得到的 key"""
+        with self._lock:
+            found = self._lookup(keys)
+            if len(found) < len(set(keys)):
+                self._refresh_segments()
+                found = self._lookup(keys)
+            return found
+
+    def put_many(self, items):
+        """寫入 {key: 向量}；只寫自己的 segment"""
+        with self._lock:
+            self._own.put_many(items)
+
+    def __len__(self):
+        return sum(len(segment.rows) for segment in self._segments.values())
+
+
+class CachedQueryEmbedding(Embeddings):
+    """為 embed_queries / embed_query 加上向量快取，embed_documents 直接轉給內層模型"""
+
+    def __init__(self, inner, model_name, max_entries=4096, store=None):
+        self.inner = inner
+        self.model_name = model_name
+        self.memory = LRUCache(max_entries=max_entries, ttl=float("inf"))
+        self.store = store
+
+    @classmethod
+    def from_env(cls, inner, model_name, dim):
+        """依環境變數包裝；EMBEDDING_CACHE=0 時直接回傳原本的模型"""
+        if os.getenv("EMBEDDING_CACHE", "1") != "1":
+            return inner
+        store = None
+        cache_dir = os.getenv("EMBEDDING_CACHE_DIR")
+        if cache_dir:
+            # 不同模型的向量分開存放
+            safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+            store = MmapVectorStore(
+                os.path.join(cache_dir, safe_name), dim,
+                writer=os.getenv("EMBEDDING_CACHE_WRITER"),
+                max_segments=int(os.getenv("EMBEDDING_CACHE_SEGMENTS", "16")),
+            )
+        return cls(inner, model_name, int(os.getenv("EMBEDDING_CACHE_SIZE", "4096")), store)
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        """回傳 float32 矩陣；只有快取沒有的查詢才會送進模型（一次 batch）"""
+        keys, vectors, missing_texts = self._lookup(texts)
+        if missing_texts:
+            computed = self.inner.embed_queries(list(missing_texts.values()))
+            self._remember(vectors, missing_texts, computed)
+        return np.stack([vectors[key] for key in keys])
+
+    async def aembed_queries(self, texts):
+        """embed_queries 的 async 版本；內層模型須提供 aembed_queries（BatchingQueryEmbedding）"""
+        keys, vectors, missing_texts = self._lookup(texts)
+        if missing_texts:
+            computed = await self.inner.aembed_queries(list(missing_texts.values()))
+            self._remember(vectors, missing_texts, computed)
+        return np.stack([vectors[key] for key in keys])
+
+    def _lookup(self, texts):
+        """回傳 (keys, 已快取的 {key: 向量}, 需要計算的 {key: 文字})"""
+        keys = [embedding_key(self.model_name, f"query: {t}") for t in texts]
+        vectors = {}
+        memory_hits = 0
+        for key in keys:
+            vector = self.memory.get(key)
+            if vector is not None:
+                vectors[key] = vector
+                memory_hits += 1
+        if memory_hits:
+            EMBEDDING_CACHE.inc(memory_hits, tier="memory")
+
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing and self.store is not None:
+            found = self.store.get_many(missing)
+            for key, vector in found.items():
+                vectors[key] = vector
+                self.memory.set(key, vector)
+            if found:
+                EMBEDDING_CACHE.inc(len(found), tier="disk")
+
+        missing_texts = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing_texts.setdefault(key, text)
+        if missing_texts:
+            EMBEDDING_CACHE.inc(len(missing_texts), tier="miss")
+        return keys, vectors, missing_texts
+
+    def _remember(self, vectors, missing_texts, computed):
+        new_items = dict(zip(missing_texts.keys(), np.asarray(computed, dtype=np.float32)))
+        for key, vector in new_items.items():
+            vectors[key] = vector
+            self.memory.set(key, vector)
+        if self.store is not None:
+            self.store.put_many(new_items)
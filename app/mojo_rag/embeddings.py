@@ -0,0 +1,73 @@
+"""
+E5 embedding 類別
+
+EMBEDDING_BACKEND 決定使用哪個後端：
+- torch：langchain 的 HuggingFaceEmbeddings（sentence-transformers）
+- onnx：ONNX Runtime int8 量化模型（onnx_embeddings.py），不需要 torch
+
+langchain_community（以及它帶進來的 sentence-transformers / torch）只在真的建立 torch
+後端的模型時才 import：ONNX 後端與只需要 backend_model_name 的 ingest 不必付這段冷啟動成本。
+"""
+import functools
+import json
+import os
+
+
+@functools.lru_cache(maxsize=None)
+def _e5_embedding_class():
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    class CustomE5Embedding(HuggingFaceEmbeddings):
+        """E5 模型需要 "query: " / "passage: " 前綴"""
+
+        def embed_documents(self, texts):
+            texts = [f"passage: {t}" for t in texts]
+            return super().embed_documents(texts)
+
+        def embed_query(self, text):
+            return self.embed_queries([text])[0]
+
+        def embed_queries(self, texts):
+            """一次 forward pass 計算多個查詢的向量"""
+            texts = [f"query: {t}" for t in texts]
+            return super().embed_documents(texts)
+
+    CustomE5Embedding.__module__, CustomE5Embedding.__qualname__ = __name__, "CustomE5Embedding"
+    return CustomE5Embedding
+
+
+def __getattr__(name):
+    # `from mojo_rag.embeddings import CustomE5Embedding` 照常可用，第一次存取時才 import
+    if name == "CustomE5Embedding":
+        return _e5_embedding_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def backend_model_name(model_name, backend=None, onnx_model_dir=None):
+    """快取與建置 manifest 用的模型名稱：量化後的向量與 torch 版本略有差異，要分開記錄"""
+    backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+    if backend != "onnx":
+        return model_name
+    from .onnx_embeddings import META_FILE
+
+    model_dir = onnx_model_dir or os.getenv("ONNX_MODEL_DIR", "onnx_model")
+    with open(os.path.join(model_dir, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    return f"{model_name}:{'onnx-int8' if meta.get('quantized') else 'onnx'}"
+
+
+def load_embedding_model(model_name, backend=None, onnx_model_dir=None, num_threads=None):
+    """依 EMBEDDING_BACKEND 建立 embedding 模型，回傳 (模型, 快取用的模型名稱)"""
+    backend = backend or os.getenv("EMBEDDING_BACKEND", "torch")
+    if backend == "torch":
+        return _e5_embedding_class()(model_name=model_name), model_name
+    if backend == "onnx":
+        from .onnx_embeddings import OnnxE5Embedding
+
+        model_dir = onnx_model_dir or os.getenv("ONNX_MODEL_DIR", "onnx_model")
+        num_threads = num_threads or int(os.getenv("ONNX_THREADS", "0")) or None
+        model = OnnxE5Embedding(model_dir, num_threads=num_threads)
+        if model.model_name != model_name:
+            raise ValueError(f"{model_dir} 是 {model.model_name} 匯出的模型，與 EMBEDDING_MODEL={model_name} 不符")
+        return model, backend_model_name(model_name, backend, model_dir)
+    raise ValueError(f"未知的 EMBEDDING_BACKEND: {backend}")
@@ -0,0 +1,129 @@
+"""
+FAISS 索引類型與檢索參數
+
+目前的知識庫只有數百個 chunk，flat（暴力搜尋）最準也夠快；知識庫成長到
+數十萬、上百萬個 chunk 時改用近似搜尋：
+
+- flat：IndexFlatL2，精確搜尋
+- hnsw：HNSW 圖索引，efSearch 越大越準、越慢
+- ivf：IVF + 原始向量，nprobe 決定每次搜尋幾個 cluster
+- ivfpq：IVF + product quantization，向量壓縮成 pq_m bytes，記憶體最省但有量化誤差
+
+建置時由 ingest.py 的 --index-type 選擇；檢索參數寫在 store.json 的 search_params，
+載入時可用 FAISS_NPROBE / FAISS_EF_SEARCH 覆寫。
+"""
+import math
+import os
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+
+# IVF 訓練時每個 cluster 取樣的向量數（FAISS 建議 30～256）
+TRAIN_POINTS_PER_LIST = 64
+
+
+def default_nlist(count):
+    """IVF 的 cluster 數：約 4 * sqrt(N)，至少 1"""
+    return max(1, min(count // TRAIN_POINTS_PER_LIST or 1, int(4 * math.sqrt(max(count, 1)))))
+
+
+def default_pq_m(dim):
+    """PQ 的子向量數：每 8 維一個 byte，且須整除維度"""
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def index_spec(index_type, dim, count, hnsw_m=32, nlist=None, pq_m=None):
+    """回傳 (faiss.index_factory 字串, 實際使用的參數)"""
+    if index_type == "flat":
+        return "Flat", {}
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m},Flat", {"hnsw_m": hnsw_m}
+    nlist = nlist or default_nlist(count)
+    if index_type == "ivf":
+        return f"IVF{nlist},Flat", {"nlist": nlist}
+    if index_type == "ivfpq":
+        pq_m = pq_m or default_pq_m(dim)
+        return f"IVF{nlist},PQ{pq_m}", {"nlist": nlist, "pq_m": pq_m}
+    raise ValueError(f"未知的索引類型: {index_type}（可用 {', '.join(INDEX_TYPES)}）")
+
+
+def default_search_params(index_type, params):
+    """預設的檢索參數，寫入 store.json"""
+    if index_type == "hnsw":
+        return {"efSearch": 64}
+    if index_type in ("ivf", "ivfpq"):
+        return {"nprobe": min(params["nlist"], 16)}
+    return {}
+
+
+def create_index(index_type, vectors_sample, dim, count, ef_construction=200, **kwargs):
+    """建立空的索引；IVF 類以 vectors_sample 訓練"""
+    spec, params = index_spec(index_type, dim, count, **kwargs)
+    if index_type == "ivfpq" and count < 256:
+        raise ValueError(f"ivfpq 至少需要 256 個向量才能訓練 PQ codebook，目前只有 {count} 個，請改用 flat / hnsw")
+    index = faiss.index_factory(dim, spec, faiss.METRIC_L2)
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = ef_construction
+        params["ef_construction"] = ef_construction
+    if index_type == "ivfpq":
+        # polysemous 訓練只對 polysemous 搜尋有用，卻會讓訓練時間多好幾倍
+        index.do_polysemous_training = False
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(vectors_sample, dtype=np.float32))
+    return index, {"type": index_type, "factory": spec, **params}
+
+
+def training_rows(count, index_type, nlist=None, seed=0):
+    """IVF 訓練用的取樣列號（已排序，方便從 memmap 依序讀取）"""
+    if index_type not in ("ivf", "ivfpq"):
+        return np.zeros(0, dtype=np.int64)
+    size = min(count, (nlist or default_nlist(count)) * TRAIN_POINTS_PER_LIST)
+    # PQ 的 codebook 每個子空間有 256 個中心，樣本太少時訓練會失敗
+    if index_type == "ivfpq":
+        size = min(count, max(size, 256 * 39))
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(count, size=size, replace=False))
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """設定檢索參數；索引類型不支援的參數會被忽略"""
+    params = faiss.ParameterSpace()
+    ivf = faiss.try_extract_index_ivf(index)
+    if nprobe and ivf is not None:
+        params.set_index_parameter(index, "nprobe", int(nprobe))
+    if ef_search and hasattr(faiss.downcast_index(index), "hnsw"):
+        params.set_index_parameter(index, "efSearch", int(ef_search))
+
+
+def configure_search(index, defaults=None):
+    """依 store.json 的預設值與 FAISS_NPROBE / FAISS_EF_SEARCH 環境變數設定檢索參數"""
+    defaults = defaults or {}
+    nprobe = os.getenv("FAISS_NPROBE") or defaults.get("nprobe")
+    ef_search = os.getenv("FAISS_EF_SEARCH") or defaults.get("efSearch")
+    set_search_params(index, nprobe, ef_search)
+
+
+def reconstruct_all(index):
+    """還原索引中的原始向量；量化過（有損）或不支援時回傳 None"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        if not isinstance(faiss.downcast_index(ivf), faiss.IndexIVFFlat):
+            return None
+        ivf.make_direct_map()
+    try:
+        return index.reconstruct_n(0, index.ntotal)
+    except RuntimeError:
+        return None
+
+
+def reconstruct_row(index, row):
+    """還原單一列的向量；不支援（例如沒有 direct map 的 IVF）時回傳 None"""
+    try:
+        return index.reconstruct(int(row))
+    except RuntimeError:
+        return None
@@ -0,0 +1,270 @@
+"""
+知識庫增量建置
+
+將來源文件切成 chunk，以內容 hash 作為 chunk id：已存在於索引中的 chunk
+直接沿用原本的向量，只有新增或修改過的 chunk 需要重新 embedding，已刪除的
+chunk 則從索引中移除。輸出為 native_index 的原生格式，並寫入 manifest.json
+（版本號、索引版本、來源檔與輸出檔的 checksum），供 upload_faiss_to_modal.py
+只上傳有變動的檔案。需在 app/ 目錄下執行：
+
+    python -m mojo_rag.ingest uploaded_docs --output faiss_db
+    python -m mojo_rag.ingest uploaded_docs --output faiss_db --workers 4   # 大型語料
+
+embedding 交給 bulk_embed.BulkEmbedder，結束時在 manifest 的 stats.embedding
+記錄吞吐量（chunks/sec）與峰值 RSS。
+
+知識庫很大時可改用近似搜尋的索引（見 index_types.py），例如：
+
+    python -m mojo_rag.ingest uploaded_docs --output faiss_db --index-type hnsw
+    python -m mojo_rag.ingest uploaded_docs --output faiss_db --index-type ivfpq --nlist 4096
+
+改變索引類型只會重建索引，沿用既有向量（ivfpq 為有損壓縮，之後的增量建置需重新 embedding）。
+
+每個 chunk 依來源檔名標上類別（metadata.category，見 sharding.py），並為每個類別
+另外建立子索引，檢索時依子問題只搜尋相關的類別；--no-shards 只建立全域索引。
+"""
+import argparse
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+from .index_types import INDEX_TYPES, create_index, default_search_params, reconstruct_all, training_rows
+from .native_index import MANIFEST_FILE, MappedColumn, is_native_store, read_index_mmap, write_native_store
+from .sharding import categorize_source
+
+BUILD_MANIFEST = "manifest.json"
+SOURCE_EXTENSIONS = (".txt", ".md")
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+# 建立索引時每次加入的向量數
+ADD_BLOCK = 8192
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(os.path.join(path, BUILD_MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def list_sources(source_dir):
+    """回傳 (metadata 中的 source 路徑, 實際路徑)，source 路徑以來源目錄名稱開頭，與原本的 faiss_db 一致"""
+    base = os.path.dirname(os.path.abspath(source_dir))
+    sources = []
+    for root, _, files in os.walk(source_dir):
+        for name in sorted(files):
+            if name.endswith(SOURCE_EXTENSIONS):
+                path = os.path.join(root, name)
+                sources.append((os.path.relpath(os.path.abspath(path), base).replace(os.sep, "/"), path))
+    return sorted(sources)
+
+
+def chunk_sources(sources, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """切 chunk 並以 (source, 內容) 的 hash 作為 id；同一檔案中重複的內容加上序號區分"""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    ids, documents = [], []
+    for source, path in sources:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        seen = {}
+        for chunk in splitter.split_text(text):
+            digest = hashlib.sha256(f"{source}\0{chunk}".encode("utf-8")).hexdigest()[:32]
+            seen[digest] = seen.get(digest, 0) + 1
+            ids.append(digest if seen[digest] == 1 else f"{digest}-{seen[digest]}")
+            documents.append(Document(page_content=chunk,
+                                      metadata={"source": source, "category": categorize_source(source)}))
+    return ids, documents
+
+
+def existing_vectors(output_dir):
+    """讀取既有原生格式索引中的 {chunk id: 向量}；無法還原向量時回傳空 dict"""
+    if not is_native_store(output_dir):
+        return {}
+    index = read_index_mmap(os.path.join(output_dir, "index.faiss"))
+    vectors = reconstruct_all(index)
+    if vectors is None:
+        print("既有索引不支援還原向量，將重新 embedding 所有 chunk")
+        return {}
+    ids = MappedColumn(output_dir, "ids")
+    return {ids[i]: vectors[i] for i in range(len(ids))}
+
+
+def stack_vectors(known, ids, new_vectors, rows):
+    """依列號取出向量：沿用舊索引的向量，其餘從新算的 memmap 讀取"""
+    return np.stack([known[ids[i]] if ids[i] in known else new_vectors[i] for i in rows])
+
+
+def build_index(index_type, index_params, rows, vectors_at, dim):
+    """以 rows 列的向量建立索引，回傳 (索引, 索引設定, 預設檢索參數)"""
+    sample = training_rows(len(rows), index_type, index_params.get("nlist"))
+    index, info = create_index(index_type, vectors_at([rows[i] for i in sample]) if len(sample) else None,
+                               dim, len(rows), **index_params)
+    for begin in range(0, len(rows), ADD_BLOCK):
+        index.add(vectors_at(rows[begin:begin + ADD_BLOCK]))
+    return index, info, default_search_params(index_type, info)
+
+
+def build_shards(documents, index_type, index_params, vectors_at, dim):
+    """每個類別一個子索引；只有一個類別時分片沒有意義，回傳 None"""
+    rows_by_category = {}
+    for i, doc in enumerate(documents):
+        rows_by_category.setdefault(doc.metadata["category"], []).append(i)
+    if len(rows_by_category) < 2:
+        return None
+
+    shards = {}
+    for category, rows in rows_by_category.items():
+        # 子索引小得多：ivfpq 樣本不足時改用 flat，nlist 依子索引大小重新計算
+        shard_type = "flat" if index_type == "ivfpq" and len(rows) < 256 else index_type
+        params = {k: v for k, v in index_params.items() if k != "nlist"}
+        if shard_type == "flat":
+            params = {}
+        index, _, search_params = build_index(shard_type, params, rows, vectors_at, dim)
+        shards[category] = (index, rows, shard_type, search_params)
+    return shards
+
+
+def build(source_dir, output_dir, embedder, model_name,
+          chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, full=False, index_type="flat", index_params=None,
+          shards=True):
+    """增量建置知識庫，回傳新的 manifest；embedder 為 bulk_embed.BulkEmbedder
+
+    index_type 為 index_types.INDEX_TYPES 之一，index_params 為 nlist / pq_m / hnsw_m / ef_construction；
+    shards=True 時另外建立各類別的子索引。
+    """
+    start = time.perf_counter()
+    previous = load_manifest(output_dir) or {}
+    settings = {"embedding_model": model_name, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+    if any(previous.get(k) != v for k, v in settings.items()):
+        # 模型或切塊設定改變時舊向量不能沿用
+        full = True
+
+    sources = list_sources(source_dir)
+    ids, documents = chunk_sources(sources, chunk_size, chunk_overlap)
+    known = {} if full else existing_vectors(output_dir)
+    missing = [i for i, chunk_id in enumerate(ids) if chunk_id not in known]
+
+    # 先寫到暫存目錄，再逐一 os.replace：正在讀取舊檔案的行程（mmap）不受影響
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix=".build-") as tmp_dir:
+        # 新向量依列號寫入暫存的 memmap，不必全部留在記憶體
+        new_vectors, _ = embedder.embed_to_file(
+            ((i, documents[i].page_content) for i in missing), os.path.join(tmp_dir, "vectors.npy"), len(ids)
+        )
+        if new_vectors is not None:
+            dim = new_vectors.shape[1]
+        elif known:
+            dim = len(next(iter(known.values())))
+        else:
+            dim = int(previous.get("dim", 0))
+
+        vectors_at = functools.partial(stack_vectors, known, ids, new_vectors)
+        index_params = {k: v for k, v in (index_params or {}).items() if v is not None}
+        index, index_info, search_params = build_index(index_type, index_params, range(len(ids)), vectors_at, dim)
+        shard_indexes = build_shards(documents, index_type, index_params, vectors_at, dim) if shards else None
+        # 索引建好後不再需要新向量的 memmap
+        del vectors_at, new_vectors
+
+        store_dir = os.path.join(tmp_dir, "store")
+        write_native_store(store_dir, index, documents, ids, normalize_L2=False, distance_strategy="EUCLIDEAN_DISTANCE",
+                           index_type=index_type, search_params=search_params, shards=shard_indexes)
+        names = sorted(
+            os.path.relpath(os.path.join(root, name), store_dir).replace(os.sep, "/")
+            for root, _, files in os.walk(store_dir) for name in files
+        )
+        for name in names:
+            if name != MANIFEST_FILE:
+                os.makedirs(os.path.dirname(os.path.join(output_dir, name)), exist_ok=True)
+                os.replace(os.path.join(store_dir, name), os.path.join(output_dir, name))
+        os.replace(os.path.join(store_dir, MANIFEST_FILE), os.path.join(output_dir, MANIFEST_FILE))
+        # 類別減少或停用分片時，移除已不在 store.json 中的舊子索引
+        for name in previous.get("files", {}):
+            if name.startswith("shards/") and name not in names:
+                try:
+                    os.remove(os.path.join(output_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    with open(os.path.join(output_dir, MANIFEST_FILE), encoding="utf-8") as f:
+        store = json.load(f)
+    removed = len(set(known) - set(ids))
+    manifest = {
+        "version": int(previous.get("version", 0)) + 1,
+        "index_version": store["index_version"],
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        **settings,
+        "dim": dim,
+        # 索引類型不影響向量，不列入 settings（改變時不必重新 embedding）
+        "index": {**index_info, "search_params": search_params},
+        "shards": {category: len(rows) for category, (_, rows, _, _) in sorted((shard_indexes or {}).items())},
+        "chunks": len(ids),
+        "sources": {source: file_sha256(path) for source, path in sources},
+        "files": {
+            name: {"sha256": file_sha256(os.path.join(output_dir, name)),
+                   "size": os.path.getsize(os.path.join(output_dir, name))}
+            for name in names
+        },
+        "stats": {
+            "embedded": len(missing),
+            "reused": len(ids) - len(missing),
+            "removed": removed,
+            "seconds": round(time.perf_counter() - start, 2),
+            "embedding": embedder.report,
+        },
+    }
+    tmp_path = os.path.join(output_dir, f"{BUILD_MANIFEST}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(output_dir, BUILD_MANIFEST))
+    return manifest
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    from .bulk_embed import BulkEmbedder
+    from .embeddings import backend_model_name
+
+    parser = argparse.ArgumentParser(description="增量建置夢酒館知識庫")
+    parser.add_argument("source", help="來源文件目錄（.txt / .md）")
+    parser.add_argument("--output", default="faiss_db")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=1, help="embedding 行程數（大型語料建議設為 vCPU 數的一半）")
+    parser.add_argument("--full", action="store_true", help="忽略既有向量，全部重新 embedding")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat", help="FAISS 索引類型（見 index_types.py）")
+    parser.add_argument("--nlist", type=int, help="IVF 的 cluster 數（預設約 4 * sqrt(chunks)）")
+    parser.add_argument("--pq-m", type=int, help="IVF-PQ 每個向量壓縮成幾個 byte（須整除維度，預設維度 / 8）")
+    parser.add_argument("--hnsw-m", type=int, help="HNSW 每個節點的鄰居數（預設 32）")
+    parser.add_argument("--ef-construction", type=int, help="HNSW 建置時的搜尋寬度（預設 200）")
+    parser.add_argument("--no-shards", action="store_true", help="不建立各類別的子索引")
+    args = parser.parse_args()
+
+    load_dotenv()
+    model_name = os.getenv("EMBEDDING_MODEL", "intfloat/multilingual-e5-small")
+    embedder = BulkEmbedder(model_name, workers=args.workers, batch_size=args.batch_size)
+    # ONNX 後端的向量與 torch 略有差異，以含後端的名稱記錄，切換後端時會全部重建
+    result = build(args.source, args.output, embedder, backend_model_name(model_name),
+                   args.chunk_size, args.chunk_overlap, args.full, args.index_type,
+                   {"nlist": args.nlist, "pq_m": args.pq_m, "hnsw_m": args.hnsw_m,
+                    "ef_construction": args.ef_construction}, not args.no_shards)
+    print(json.dumps({k: result[k] for k in ("version", "index_version", "chunks", "stats")},
+                     ensure_ascii=False, indent=2))
@@ -0,0 +1,248 @@
+"""
+延遲與 token 用量指標（Prometheus 文字格式）
+
+- mojo_rag_stage_seconds：各階段耗時的 histogram（decomposition、embedding、
+  faiss_search、prompt_build、generation 等），p50 / p99 以 histogram_quantile 計算
+- mojo_rag_retrieval_routes_total：子問題搜尋了哪些類別的子索引（all 為全域搜尋）
+- mojo_rag_openai_tokens_total：OpenAI 回應中的 token 用量
+- mojo_rag_openai_calls_total / mojo_rag_circuit_state / mojo_rag_degraded_total：OpenAI 呼叫的
+  結果（重試、hedging、逾時）、circuit breaker 狀態與降級回應次數（resilience.py）
+- mojo_rag_embedding_*：查詢 embedding micro-batching 的佇列長度與 batch 大小
+- mojo_rag_startup_seconds / mojo_rag_startup_rss_bytes：冷啟動各階段的耗時與結束時的 RSS
+
+指標存在行程內，由 web.py / asgi.py 的 /metrics 路由輸出；不需要 prometheus_client。
+"""
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """單調遞增的計數器"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    """可任意設定的數值"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """累積分桶的 histogram"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # {label 值: [各分桶計數, 總和, 筆數]}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "mojo_rag_stage_seconds", "Latency of each RAG pipeline stage in seconds.", ["stage"]))
+REQUESTS = REGISTRY.register(Counter(
+    "mojo_rag_requests_total", "Answer requests by cache status.", ["cache"]))
+COALESCED = REGISTRY.register(Counter(
+    "mojo_rag_coalesced_requests_total", "Requests served by joining an identical in-flight request.", ["endpoint"]))
+RETRIEVAL_ROUTES = REGISTRY.register(Counter(
+    "mojo_rag_retrieval_routes_total", "Sub-queries by the category shards they were routed to.", ["shard"]))
+OPENAI_TOKENS = REGISTRY.register(Counter(
+    "mojo_rag_openai_tokens_total", "Token usage reported by OpenAI responses.", ["call", "kind"]))
+UPSTREAM_CALLS = REGISTRY.register(Counter(
+    "mojo_rag_openai_calls_total",
+    "OpenAI call attempts by outcome (ok, timeout, error, rejected, hedged, hedge_won).", ["call", "outcome"]))
+CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "mojo_rag_circuit_state", "Circuit breaker state per OpenAI call: 0 closed, 1 half-open, 2 open.", ["call"]))
+DEGRADED = REGISTRY.register(Counter(
+    "mojo_rag_degraded_total", "Requests served by a degraded fallback after an OpenAI call failed.", ["call"]))
+CONTEXT_TOKENS = REGISTRY.register(Histogram(
+    "mojo_rag_context_tokens", "Retrieved context size before and after packing.", ["packing"], TOKEN_BUCKETS))
+EMBEDDING_CACHE = REGISTRY.register(Counter(
+    "mojo_rag_embedding_cache_total", "Query embedding lookups by the cache tier that served them.", ["tier"]))
+EMBED_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "mojo_rag_embedding_queue_depth", "Query embedding requests still queued after a micro-batch was formed."))
+EMBED_BATCH_SIZE = REGISTRY.register(Histogram(
+    "mojo_rag_embedding_batch_size", "Query texts per embedding micro-batch.", buckets=BATCH_BUCKETS))
+EMBED_BATCH_REQUESTS = REGISTRY.register(Histogram(
+    "mojo_rag_embedding_batch_requests", "Caller requests merged into each embedding micro-batch.", buckets=BATCH_BUCKETS))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    "mojo_rag_startup_seconds", "Duration of each cold-start phase in seconds.", ["phase"]))
+STARTUP_RSS = REGISTRY.register(Gauge(
+    "mojo_rag_startup_rss_bytes", "Resident set size at the end of each cold-start phase.", ["phase"]))
+
+# 依序記錄的冷啟動階段 {phase, seconds, rss_bytes}，供 bench/startup_profile.py 輸出
+STARTUP_PHASES = []
+
+
+def render():
+    """/metrics 的回應內容"""
+    return REGISTRY.render()
+
+
+def record_usage(call, usage):
+    """記錄 OpenAI 回應的 usage；call 為 decomposition / answer"""
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(usage.prompt_tokens or 0, call=call, kind="prompt")
+    OPENAI_TOKENS.inc(usage.completion_tokens or 0, call=call, kind="completion")
+    # 命中供應商端 prompt 快取的部分
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    OPENAI_TOKENS.inc(cached, call=call, kind="cached_prompt")
+
+
+def rss_bytes():
+    """目前的 RSS；沒有 /proc 時（macOS）改用峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextmanager
+def startup_phase(phase):
+    """記錄冷啟動其中一個階段的耗時與結束時的 RSS"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        rss = rss_bytes()
+        STARTUP_SECONDS.set(round(seconds, 4), phase=phase)
+        STARTUP_RSS.set(rss, phase=phase)
+        STARTUP_PHASES.append({"phase": phase, "seconds": round(seconds, 4), "rss_bytes": rss})
+        print(f"啟動階段 {phase}: {seconds:.2f}s, RSS {rss / 1024 / 1024:.0f} MB")
+
+
+class Timings:
+    """單一請求各階段的耗時（毫秒），同時記錄到 STAGE_SECONDS
+
+    預先檢索在背景執行緒中進行，同名的階段會累加。
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        with self._lock:
+            self.spans[stage] = round(self.spans.get(stage, 0.0) + seconds * 1000, 2)
+
+    def finish(self):
+        """記錄整個請求的耗時"""
+        self.add("total", time.perf_counter() - self.start)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.spans)
@@ -0,0 +1,224 @@
+"""
+不需要 pickle 的 memory-mapped 索引格式
+
+FAISS.load_local 會 unpickle 整個 index.pkl（InMemoryDocstore 與 id 對照表），
+並把 index.faiss 完整讀進記憶體，啟動時間隨知識庫線性成長。原生格式：
+
+- index.faiss：FAISS 原生格式，以 mmap 開啟
+- texts.bin / texts.offsets：UTF-8 文字 blob 與 uint64 位移表（第 i 列即第 i 個向量）
+- metadata.bin / metadata.offsets：每列一個 JSON 物件
+- ids.bin / ids.offsets：原本的 docstore id，供增量更新使用
+- shards/<類別>.faiss / shards/<類別>.rows：依類別分片的子索引與子索引列號 → 全域列號（可省略，見 sharding.py）
+- store.json：格式版本、筆數、維度、距離設定、索引類型與檢索參數、分片、內容 hash（索引版本）
+
+所有檔案都以唯讀 mmap 開啟、用到時才讀取，載入時間與知識庫大小幾乎無關，
+gunicorn 多個 worker 也共用同一份 page cache。NativeFAISS 提供與 langchain
+FAISS 相同的 index / docstore / index_to_docstore_id 介面，pipeline 不需要修改。
+
+既有的 faiss_db 以下列指令轉換（預設寫在同一個目錄，index.pkl 保留給舊版程式）：
+
+    python -m mojo_rag.native_index faiss_db
+"""
+import argparse
+import json
+import mmap
+import os
+import pickle
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from .index_types import configure_search
+from .vectorstore import hash_files
+
+FORMAT_VERSION = 1
+MANIFEST_FILE = "store.json"
+COLUMNS = ("texts", "metadata", "ids")
+
+
+def is_native_store(path):
+    return os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def _write_column(path, prefix, items):
+    """寫入一個 UTF-8 blob 與 N+1 個 uint64 位移"""
+    offsets = np.zeros(len(items) + 1, dtype=np.uint64)
+    with open(os.path.join(path, f"{prefix}.bin"), "wb") as f:
+        for i, item in enumerate(items):
+            data = item.encode("utf-8")
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    offsets.tofile(os.path.join(path, f"{prefix}.offsets"))
+
+
+class MappedColumn:
+    """以 mmap 讀取的字串欄位，第 i 列在用到時才解碼"""
+
+    def __init__(self, path, prefix):
+        self._offsets = np.memmap(os.path.join(path, f"{prefix}.offsets"), dtype=np.uint64, mode="r")
+        with open(os.path.join(path, f"{prefix}.bin"), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # 空檔案無法 mmap
+            self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._blob[start:end].decode("utf-8")
+
+
+class RowIds:
+    """index_to_docstore_id 的替代品：原生格式以列號作為 docstore id"""
+
+    def __init__(self, size):
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        i = int(i)
+        if not 0 <= i < self._size:
+            raise KeyError(i)
+        return i
+
+
+class MappedDocstore:
+    """與 InMemoryDocstore.search 相同介面，依列號回傳 Document"""
+
+    def __init__(self, path):
+        self.texts = MappedColumn(path, "texts")
+        self.metadata = MappedColumn(path, "metadata")
+        self.ids = MappedColumn(path, "ids")
+
+    def search(self, row):
+        return Document(page_content=self.texts[row], metadata=json.loads(self.metadata[row]))
+
+
+class Shard:
+    """一個類別的子索引；search 回傳全域列號"""
+
+    def __init__(self, path, category, search_params=None):
+        self.category = category
+        self.index = read_index_mmap(os.path.join(path, "shards", f"{category}.faiss"))
+        configure_search(self.index, search_params)
+        self.rows = np.memmap(os.path.join(path, "shards", f"{category}.rows"), dtype=np.int64, mode="r")
+
+    def search(self, vectors, top_k):
+        distances, local = self.index.search(vectors, top_k)
+        return distances, np.where(local == -1, -1, self.rows[np.maximum(local, 0)])
+
+
+class NativeFAISS:
+    """唯讀、memory-mapped 的向量資料庫"""
+
+    def __init__(self, path, embedding_function=None):
+        with open(os.path.join(path, MANIFEST_FILE), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"{path} 的格式版本 {self.manifest.get('format_version')} 不支援")
+
+        self.path = path
+        self.embedding_function = embedding_function
+        self.index = read_index_mmap(os.path.join(path, "index.faiss"))
+        # HNSW / IVF 的 efSearch、nprobe；FAISS_EF_SEARCH / FAISS_NPROBE 可覆寫
+        configure_search(self.index, self.manifest.get("search_params"))
+        self.docstore = MappedDocstore(path)
+        self.index_to_docstore_id = RowIds(len(self.docstore.texts))
+        self._normalize_L2 = self.manifest.get("normalize_L2", False)
+        self.distance_strategy = self.manifest.get("distance_strategy")
+        self.shards = {
+            category: Shard(path, category, info.get("search_params"))
+            for category, info in self.manifest.get("shards", {}).items()
+        }
+
+        if self.index.ntotal != len(self.docstore.texts):
+            raise ValueError(f"{path} 的索引有 {self.index.ntotal} 筆向量，文件卻有 {len(self.docstore.texts)} 筆")
+
+
+def read_index_mmap(index_path):
+    """以 mmap 開啟 FAISS 索引；IVF 的 inverted lists 與 flat 的向量都不會整份讀進記憶體"""
+    flags = faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP
+    # faiss >= 1.10 起 IndexFlat 系列也能 mmap
+    ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(index_path, flags | ifc)
+    except RuntimeError:
+        # IVF 的 inverted lists 不接受 IO_FLAG_MMAP_IFC，改用舊的 mmap 方式
+        if not ifc:
+            raise
+        return faiss.read_index(index_path, flags)
+
+
+def write_native_store(path, index, documents, ids=None, normalize_L2=False, distance_strategy=None,
+                       index_type="flat", search_params=None, shards=None):
+    """將索引與文件寫成原生格式；documents 的順序必須與索引中的向量一致
+
+    index_type 與 search_params 見 index_types.py，載入時依 search_params 設定檢索參數。
+    shards 為 {類別: (子索引, 全域列號, 子索引的 index_type, search_params)}。
+    """
+    if index.ntotal != len(documents):
+        raise ValueError(f"索引有 {index.ntotal} 筆向量，文件卻有 {len(documents)} 筆")
+    ids = list(ids) if ids is not None else [str(i) for i in range(len(documents))]
+
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(index, os.path.join(path, "index.faiss"))
+    _write_column(path, "texts", [doc.page_content for doc in documents])
+    _write_column(path, "metadata", [json.dumps(doc.metadata, ensure_ascii=False) for doc in documents])
+    _write_column(path, "ids", [str(i) for i in ids])
+
+    files = ["index.faiss"] + [f"{c}.{ext}" for c in COLUMNS for ext in ("bin", "offsets")]
+    shard_info = {}
+    if shards:
+        os.makedirs(os.path.join(path, "shards"), exist_ok=True)
+    for category, (shard_index, rows, shard_type, shard_params) in sorted((shards or {}).items()):
+        faiss.write_index(shard_index, os.path.join(path, "shards", f"{category}.faiss"))
+        np.asarray(rows, dtype=np.int64).tofile(os.path.join(path, "shards", f"{category}.rows"))
+        files += [f"shards/{category}.faiss", f"shards/{category}.rows"]
+        shard_info[category] = {"count": shard_index.ntotal, "index_type": shard_type,
+                                "search_params": shard_params or {}}
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        # 寫入時先算好，啟動時不必再讀一遍所有檔案
+        "index_version": hash_files(path, files),
+        "count": len(documents),
+        "dim": index.d,
+        "normalize_L2": bool(normalize_L2),
+        "distance_strategy": distance_strategy,
+        "index_type": index_type,
+        "search_params": search_params or {},
+        "shards": shard_info,
+    }
+    # manifest 最後寫入：看得到 store.json 就代表其他檔案都已完整
+    tmp_path = os.path.join(path, f"{MANIFEST_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(path, MANIFEST_FILE))
+
+
+def convert_langchain_store(source, output=None):
+    """將 langchain 的 index.faiss + index.pkl 轉成原生格式（只在轉換時 unpickle 一次）"""
+    output = output or source
+    with open(os.path.join(source, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    index = faiss.read_index(os.path.join(source, "index.faiss"))
+
+    ids = [index_to_docstore_id[i] for i in range(index.ntotal)]
+    documents = [docstore.search(doc_id) for doc_id in ids]
+
+    # langchain 預設以 L2 距離建立索引且不做正規化
+    write_native_store(output, index, documents, ids, normalize_L2=False, distance_strategy="EUCLIDEAN_DISTANCE")
+    print(f"已轉換 {len(documents)} 筆文件: {source} -> {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="將 langchain FAISS 資料庫轉成 memory-mapped 原生格式")
+    parser.add_argument("source", help="含 index.faiss 與 index.pkl 的目錄")
+    parser.add_argument("--output", help="輸出目錄（預設寫回 source）")
+    args = parser.parse_args()
+    convert_langchain_store(args.source, args.output)
@@ -0,0 +1,137 @@
+"""
+ONNX Runtime（int8 動態量化）版本的 E5 embedding
+
+執行時只需要 onnxruntime 與 tokenizers，不必載入 torch / sentence-transformers。
+模型需先以 torch 匯出一次（匯出後的目錄可放進 image 或 Volume）：
+
+    python -m mojo_rag.onnx_embeddings --model intfloat/multilingual-e5-small --output onnx_model
+
+輸出與 sentence-transformers 相同：mean pooling 後再做 L2 正規化，
+因此可以直接查詢既有的 faiss_db。
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+MODEL_FILE = "model_int8.onnx"
+FP32_MODEL_FILE = "model.onnx"
+META_FILE = "onnx_meta.json"
+
+
+class OnnxE5Embedding(Embeddings):
+    """與 CustomE5Embedding 相同的 "query: " / "passage: " 前綴行為"""
+
+    def __init__(self, model_dir, batch_size=32, num_threads=None):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.model_name = self.meta["model_name"]
+        self.batch_size = batch_size
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.meta["max_length"])
+        self.tokenizer.enable_padding(pad_id=self.meta["pad_token_id"], pad_token=self.meta["pad_token"])
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        model_file = MODEL_FILE if os.path.exists(os.path.join(model_dir, MODEL_FILE)) else FP32_MODEL_FILE
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _embed(self, texts):
+        # 與 HuggingFaceEmbeddings 一致：換行改成空白
+        texts = [t.replace("\n", " ") for t in texts]
+        results = []
+        for start in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + self.batch_size])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+            hidden = self.session.run(None, feeds)[0]
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            results.append(pooled.astype(np.float32))
+        if not results:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate(results)
+
+    @property
+    def dim(self):
+        return self.meta["dim"]
+
+    def embed_documents(self, texts):
+        return self._embed([f"passage: {t}" for t in texts]).tolist()
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        """一次 forward pass 計算多個查詢的向量"""
+        return self._embed([f"query: {t}" for t in texts])
+
+
+def export_onnx_model(model_name, output_dir, max_length=512, quantize=True):
+    """以 torch 匯出 ONNX 模型並做 int8 動態量化（只在建置時需要 torch）"""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(output_dir)
+
+    sample = tokenizer(["query: 夢酒館", "passage: 範例"], padding=True, return_tensors="pt")
+    fp32_path = os.path.join(output_dir, FP32_MODEL_FILE)
+    dynamic = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={"input_ids": dynamic, "attention_mask": dynamic, "last_hidden_state": dynamic},
+            opset_version=17,
+            dynamo=False,
+        )
+    print(f"已匯出 {fp32_path}")
+
+    if quantize:
+        int8_path = os.path.join(output_dir, MODEL_FILE)
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+        print(f"已量化 {int8_path}")
+
+    meta = {
+        "model_name": model_name,
+        "dim": model.config.hidden_size,
+        "max_length": min(max_length, tokenizer.model_max_length),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": tokenizer.pad_token_id,
+        "quantized": quantize,
+    }
+    with open(os.path.join(output_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="匯出量化的 ONNX E5 模型")
+    parser.add_argument("--model", default="intfloat/multilingual-e5-small")
+    parser.add_argument("--output", default="onnx_model")
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--no-quantize", action="store_true", help="保留 fp32 模型")
+    args = parser.parse_args()
+    export_onnx_model(args.model, args.output, args.max_length, quantize=not args.no_quantize)
@@ -0,0 +1,1360 @@
+"""
+RAG 流程：語意拆解 → 批次檢索 → 整合回答
+
+兩種模式（PIPELINE_MODE 或請求的 mode 欄位）：
+- full：先呼叫 LLM 做語意拆解，再呼叫一次 LLM 整合回答
+- fast：不呼叫 LLM 拆解，原句加上本地切出的子句一起檢索，只呼叫一次 LLM；
+  生成時附上 search 工具，模型判斷資料不足時才會要求補充檢索（多一趟呼叫）
+
+同一個 RAGPipeline 同時提供同步（Flask）與 asyncio（ASGI）兩組方法，
+async 版本使用 AsyncOpenAI，embedding / FAISS 這類 CPU 工作則丟到
+有上限的 thread pool 執行，不會卡住 event loop。
+"""
+import asyncio
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+from openai import DEFAULT_MAX_RETRIES, AsyncOpenAI, OpenAI
+
+from .cache import ResponseCache, cache_key, text_hash
+from .context import ContextPacker, dedupe_chunks
+from .decomposition import DecompositionRouter, local_variants
+from .index_types import reconstruct_row
+from .metrics import CONTEXT_TOKENS, DEGRADED, REQUESTS, Timings, record_usage, startup_phase
+from .prefork import after_fork_in_child, in_each_worker, preloading
+from .prompts import (
+    PROMPT_TEMPLATE,
+    SEARCH_TOOL,
+    SEARCH_TOOL_NAME,
+    SYSTEM_PROMPT_ANSWER,
+    SYSTEM_PROMPT_SEPARATE,
+    build_final_prompt,
+    build_separate_prompt,
+)
+from .resilience import UpstreamGuard, UpstreamUnavailable, afirst_token, first_token
+from .semantic_cache import SemanticCache
+from .sessions import SessionManager, decode_vector, encode_vector
+from .sharding import ShardRouter
+from .singleflight import SingleFlight
+
+# prompt 模板改動後快取 key 隨之改變
+SEPARATE_PROMPT_HASH = text_hash(SYSTEM_PROMPT_SEPARATE, build_separate_prompt(""))
+ANSWER_PROMPT_HASH = text_hash(SYSTEM_PROMPT_ANSWER, PROMPT_TEMPLATE)
+
+
+def sse_event(payload):
+    """將事件格式化成一筆 Server-Sent Event"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def normalize_query(text):
+    """比對子問題與原句時忽略前後與重複的空白"""
+    return " ".join(str(text).split())
+
+
+PIPELINE_MODES = ("full", "fast")
+# fast 模式單次工具呼叫最多檢索的子問題數
+MAX_TOOL_QUERIES = 4
+NO_TOOL_RESULTS = "（沒有找到相關資料）"
+
+# OpenAI 生成回答逾時或無法使用時，改為直接回傳最相關的幾段資料
+FALLBACK_CHUNKS = 3
+FALLBACK_CHUNK_CHARS = 300
+FALLBACK_INTRO = "抱歉，目前回覆較慢，先為您整理與問題最相關的資料："
+
+# 啟動 warmup 用的查詢
+WARMUP_QUERY = "夢酒館有哪些推薦的調酒？"
+
+# 向量資料庫與其版本必須一起替換，請求開始時取一份快照，整個請求都用同一份
+IndexSnapshot = namedtuple("IndexSnapshot", ["db", "version"])
+
+
+class RAGPipeline:
+    """夢酒館品牌大使的 RAG 流程"""
+
+    def __init__(self, db, embedding_model, model, client=None, async_client=None, max_workers=2,
+                 speculative_retrieval=True, cache=None, index_version="", semantic_cache=None,
+                 decomposition_router=None, context_packer=None, event_timings=False, single_flight=None,
+                 micro_batching=False, shard_router=None, sessions=None, upstream=None, mode="full"):
+        if mode not in PIPELINE_MODES:
+            raise ValueError(f"未知的 PIPELINE_MODE: {mode}")
+        self.index = IndexSnapshot(db, index_version)
+        self.embedding_model = embedding_model
+        self.model = model
+        self.client = client
+        self.async_client = async_client
+        # 語意拆解進行中就先對原句做檢索，單一子句問題可直接沿用結果
+        self.speculative_retrieval = speculative_retrieval
+        # 語意拆解與最終回答的快取（None 表示停用）
+        self.cache = cache
+        # 以問句向量相似度比對的回答快取（None 表示停用）
+        self.semantic_cache = semantic_cache
+        # 單一子句問題在本地直接回傳 [user_input]，不呼叫 LLM（None 表示一律呼叫）
+        self.decomposition_router = decomposition_router
+        # 檢索結果去重、排序並裁切到 token 預算內
+        self.context_packer = context_packer or ContextPacker(model=model)
+        # SSE 事件附上目前為止各階段的耗時（毫秒）
+        self.event_timings = event_timings
+        # 同時進行中的相同問題只跑一次 pipeline（None 表示停用）
+        self.single_flight = single_flight
+        # embedding_model 內含 BatchingQueryEmbedding 時，async 版本直接等待排程器，不佔用 thread pool
+        self.micro_batching = micro_batching
+        # 依子問題的類別只搜尋相關的子索引（None 表示一律搜尋全域索引）
+        self.shard_router = shard_router
+        # 帶 session_id 的請求保留對話紀錄與上一輪的檢索結果（None 表示一律不保留）
+        self.sessions = sessions
+        # OpenAI 呼叫的期限、重試、hedging 與 circuit breaker（None 表示直接呼叫）
+        self.upstream = upstream
+        # 請求沒有指定 mode 時使用的模式（full / fast）
+        self.mode = mode
+        # CPU 密集的 embedding / FAISS 工作數量上限（約等於 vCPU 數）
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-cpu")
+        # gunicorn preload 時 master 的 thread pool 不會跟著 fork
+        after_fork_in_child(self._after_fork)
+
+    def _after_fork(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="rag-cpu")
+
+    @property
+    def db(self):
+        return self.index.db
+
+    @property
+    def index_version(self):
+        return self.index.version
+
+    def swap_index(self, db, index_version):
+        """換上新的向量資料庫；進行中的請求繼續使用自己的快照
+
+        回答快取的 key 含索引版本，換版後舊回答自然不會再命中；語意快取則直接清空。
+        """
+        old_version = self.index_version
+        self.index = IndexSnapshot(db, index_version)
+        if self.semantic_cache is not None:
+            self.semantic_cache.clear()
+        print(f"向量資料庫已更新: {old_version} -> {index_version}")
+
+    @classmethod
+    def from_env(cls, faiss_path, default_model="gpt-4.1-nano"):
+        """依環境變數載入 embedding 模型、FAISS 資料庫與 OpenAI client"""
+        from .batching import BatchingQueryEmbedding
+        from .embedding_cache import CachedQueryEmbedding
+        from .embeddings import load_embedding_model
+        from .vectorstore import index_version, load_vector_store
+
+        api_key = os.getenv("OPENAI_API_KEY")
+        upstream = UpstreamGuard.from_env()
+        # 由 UpstreamGuard 在期限內重試時，SDK 本身不再重試
+        max_retries = 0 if upstream is not None else DEFAULT_MAX_RETRIES
+        model = os.getenv("OPENAI_MODEL", default_model)
+        embedding_model_name = os.getenv("EMBEDDING_MODEL", "intfloat/multilingual-e5-small")
+
+        with startup_phase("embedding_model"):
+            embedding_model, cache_model_name = load_embedding_model(embedding_model_name)
+        with startup_phase("vector_store"):
+            db = load_vector_store(faiss_path, embedding_model)
+            version = index_version(faiss_path)
+        # 快取在外層，命中時不必進 micro-batch 佇列
+        batched_model = BatchingQueryEmbedding.from_env(embedding_model)
+        micro_batching = batched_model is not embedding_model
+        with startup_phase("embedding_cache"):
+            embedding_model = CachedQueryEmbedding.from_env(batched_model, cache_model_name, db.index.d)
+
+        pipeline = cls(
+            db=db,
+            embedding_model=embedding_model,
+            model=model,
+            client=OpenAI(api_key=api_key, max_retries=max_retries),
+            async_client=AsyncOpenAI(api_key=api_key, max_retries=max_retries),
+            max_workers=int(os.getenv("EMBEDDING_WORKERS", "2")),
+            speculative_retrieval=os.getenv("SPECULATIVE_RETRIEVAL", "1") == "1",
+            cache=ResponseCache.from_env(),
+            index_version=version,
+            semantic_cache=SemanticCache.from_env(db.index.d, version),
+            decomposition_router=DecompositionRouter.from_env(embedding_model),
+            context_packer=ContextPacker.from_env(model),
+            event_timings=os.getenv("SSE_TIMINGS", "0") == "1",
+            single_flight=SingleFlight() if os.getenv("SINGLE_FLIGHT", "1") == "1" else None,
+            micro_batching=micro_batching,
+            shard_router=ShardRouter.from_env(),
+            sessions=SessionManager.from_env(model),
+            upstream=upstream,
+            mode=os.getenv("PIPELINE_MODE", "full"),
+        )
+        if os.getenv("STARTUP_WARMUP", "1") == "1":
+            if preloading():
+                in_each_worker(pipeline.warmup)
+            else:
+                pipeline.warmup()
+        return pipeline
+
+    def warmup(self):
+        """開始接流量前先跑一次查詢 embedding 與檢索
+
+        第一次 forward pass（torch 的 kernel 選擇與執行緒池建立）、mmap 索引的分頁讀入、
+        micro-batch 排程器與 thread pool 的啟動都在這裡完成，不由第一個請求負擔。
+        """
+        with startup_phase("warmup"):
+            self.retrieve_answers([WARMUP_QUERY])
+            self.context_packer.counter.count(WARMUP_QUERY)
+
+    # ------------------------------------------------------------------
+    # 同步版本（Flask）
+    # ------------------------------------------------------------------
+
+    def separate_queries(self, user_input):
+        """將複合問句拆解成多個子問題"""
+        if self.decomposition_router is not None and not self.decomposition_router.route(user_input):
+            return self._local_sub_queries(user_input)
+
+        key = self._separate_key(user_input)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return self._cached_sub_queries(user_input, cached)
+
+        try:
+            response = self._complete("decomposition", self._separate_messages(user_input))
+        except UpstreamUnavailable as e:
+            return self._fallback_sub_queries(user_input, e)
+        record_usage("decomposition", response.usage)
+        return self._parse_and_cache_sub_queries(key, user_input, response.choices[0].message.content)
+
+    def embed_queries(self, queries_list):
+        """批次計算查詢向量（float32 矩陣）"""
+        return np.asarray(self.embedding_model.embed_queries(queries_list), dtype=np.float32)
+
+    def retrieve_answers(self, queries_list, top_k=3, vectors=None, snapshot=None, timings=None):
+        """針對每個子問題檢索相關文件
+
+        所有子問題一次批次 embedding，再以單一矩陣送進 FAISS 搜尋，
+        子問題數量增加時檢索成本幾乎不變。已算好的查詢向量可由 vectors 傳入。
+        索引有類別子索引時，由 shard_router 決定每個子問題搜尋哪些子索引。
+        """
+        if not queries_list:
+            return []
+
+        db = (snapshot or self.index).db
+        timings = timings or Timings()
+        if vectors is None:
+            with timings.span("embedding"):
+                vectors = self.embed_queries(queries_list)
+        with timings.span("faiss_search"):
+            if db._normalize_L2:
+                vectors = vectors.copy()
+                faiss.normalize_L2(vectors)
+            if self.shard_router is not None:
+                distances, indices = self.shard_router.search(db, queries_list, vectors, top_k)
+            else:
+                distances, indices = db.index.search(vectors, top_k)
+        # 分數一律是越大越相關：內積直接使用，L2 距離取負值
+        sign = 1.0 if db.index.metric_type == faiss.METRIC_INNER_PRODUCT else -1.0
+
+        results = []
+        for sub_query, row, row_distances in zip(queries_list, indices, distances):
+            retrieved_chunks, ids, rows, scores = [], [], [], []
+            for i, distance in zip(row, row_distances):
+                if i == -1:
+                    continue
+                doc_id = db.index_to_docstore_id[i]
+                retrieved_chunks.append(db.docstore.search(doc_id).page_content)
+                ids.append(str(doc_id))
+                rows.append(int(i))
+                scores.append(round(sign * float(distance), 6))
+            results.append({
+                "sub_query": sub_query,
+                "chunks": retrieved_chunks,
+                "ids": ids,
+                "rows": rows,
+                "scores": scores
+            })
+        return results
+
+    def retrieve_follow_up(self, queries_list, session, top_k=3, vectors=None, snapshot=None, timings=None):
+        """追問的檢索：沿用上一輪的 chunk，只以一次檢索補上新的 chunk
+
+        queries_list 為 [上一輪問題 + 追問]。上一輪保留的 chunk 直接以存下的向量對新的查詢
+        重新計分，與這次檢索到的 top_k 筆合併後依分數排序，回傳單一筆檢索結果。
+        """
+        snapshot = snapshot or self.index
+        db = snapshot.db
+        timings = timings or Timings()
+        if vectors is None:
+            with timings.span("embedding"):
+                vectors = self.embed_queries(queries_list)
+        fresh = self.retrieve_answers(queries_list, top_k, vectors, snapshot, timings)[0]
+
+        with timings.span("session_rescore"):
+            query = np.array(vectors[:1], dtype=np.float32)
+            if db._normalize_L2:
+                faiss.normalize_L2(query)
+            query = query[0]
+            inner_product = db.index.metric_type == faiss.METRIC_INNER_PRODUCT
+            scores = dict(zip(fresh["rows"], fresh["scores"]))
+            for chunk in session.reusable_chunks(snapshot.version):
+                if chunk["row"] in scores or chunk.get("vector") is None:
+                    continue
+                vector = decode_vector(chunk["vector"])
+                # 與 retrieve_answers 相同：內積直接使用，L2 距離（平方）取負值
+                score = float(vector @ query) if inner_product else -float(np.sum((vector - query) ** 2))
+                scores[chunk["row"]] = round(score, 6)
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:self.sessions.max_chunks]
+
+        fresh_rows = set(fresh["rows"])
+        result = {"sub_query": fresh["sub_query"], "chunks": [], "ids": [], "rows": [], "scores": [], "reused": 0}
+        for row, score in ranked:
+            doc_id = db.index_to_docstore_id[row]
+            result["chunks"].append(db.docstore.search(doc_id).page_content)
+            result["ids"].append(str(doc_id))
+            result["rows"].append(row)
+            result["scores"].append(score)
+            if row not in fresh_rows:
+                result["reused"] += 1
+        return [result]
+
+    def pack_context(self, retrieved_answers, timings=None):
+        """將檢索結果打包成 prompt 用的 context，並記錄打包前後的 token 數"""
+        with (timings or Timings()).span("prompt_build"):
+            packed = self.context_packer.pack(retrieved_answers)
+        stats = packed.stats
+        CONTEXT_TOKENS.observe(stats['tokens_before'], packing="before")
+        CONTEXT_TOKENS.observe(stats['tokens_after'], packing="after")
+        print(f"context: {stats['unique_chunks']}/{stats['chunks']} chunks 去重後放入 {stats['packed_chunks']} 個，"
+              f"tokens {stats['tokens_before']} -> {stats['tokens_after']}")
+        return packed
+
+    def integrate_answers(self, main_query, retrieved_answers, packed=None, timings=None, history=""):
+        """整合檢索結果並生成最終回答；packed 為已打包好的 context，history 為 session 的對話紀錄
+
+        期限內沒有回應時拋出 UpstreamUnavailable，由呼叫端改用 _fallback_answer。
+        """
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        with timings.span("generation"):
+            response = self._complete("answer", self._integrate_messages(main_query, packed, history))
+        record_usage("answer", response.usage)
+        return response.choices[0].message.content
+
+    def integrate_answers_stream(self, main_query, retrieved_answers, packed=None, timings=None, history=""):
+        """整合檢索結果並以串流方式逐段產生最終回答；第一個 token 前失敗時拋出 UpstreamUnavailable"""
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        start = time.perf_counter()
+        stream = self._open_stream(self._integrate_messages(main_query, packed, history))
+        yield from self._stream_deltas(stream, timings, start)
+        timings.add("generation", time.perf_counter() - start)
+
+    def integrate_answers_fast(self, main_query, retrieved_answers, packed=None, snapshot=None, timings=None,
+                               history=""):
+        """fast 模式的整合回答：附上 search 工具，模型要求補充資料時檢索後再生成一次
+
+        回傳 (回答, 補充的檢索結果)；期限內沒有回應時拋出 UpstreamUnavailable。
+        """
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        messages = self._integrate_messages(main_query, packed, history)
+        with timings.span("generation"):
+            response = self._complete("answer", messages, tools=[SEARCH_TOOL])
+        record_usage("answer", response.usage)
+        message = response.choices[0].message
+        if not message.tool_calls:
+            return message.content, []
+
+        tool_calls = self._tool_queries(message.tool_calls)
+        with timings.span("tool_retrieval"):
+            extra = self.retrieve_answers(self._flat_tool_queries(tool_calls), snapshot=snapshot, timings=timings)
+        messages = self._tool_messages(messages, tool_calls, extra)
+        with timings.span("generation"):
+            response = self._complete("answer", messages, tools=[SEARCH_TOOL], tool_choice="none")
+        record_usage("answer", response.usage)
+        return response.choices[0].message.content, extra
+
+    def integrate_answers_fast_stream(self, main_query, retrieved_answers, packed=None, snapshot=None,
+                                      timings=None, history=""):
+        """integrate_answers_fast 的串流版本，產生 answer_delta 事件
+
+        模型要求補充檢索時，先送出一個 extra 的 stage2 事件（補充的檢索結果），再串流第二趟的回答；
+        事件順序與 full 模式相同，所有 stage2 都在第一個 answer_delta 之前。
+        """
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        messages = self._integrate_messages(main_query, packed, history)
+        start = time.perf_counter()
+        pending = {}
+        stream = self._open_stream(messages, tools=[SEARCH_TOOL])
+        emitted = False
+        for delta in self._stream_deltas(stream, timings, start, pending):
+            emitted = True
+            yield {'type': 'answer_delta', 'data': delta}
+        timings.add("generation", time.perf_counter() - start)
+        if not pending or emitted:
+            # 已經送出回答後才要求補充檢索時沿用已送出的回答：第二趟的內容無法接在後面，
+            # extra 的 stage2 事件也必須在所有 answer_delta 之前
+            return
+
+        tool_calls = self._tool_queries(self._pending_tool_calls(pending))
+        with timings.span("tool_retrieval"):
+            extra = self.retrieve_answers(self._flat_tool_queries(tool_calls), snapshot=snapshot, timings=timings)
+        yield self._timed(self._stage2_event(extra, extra=True), timings)
+        messages = self._tool_messages(messages, tool_calls, extra)
+        round_start = time.perf_counter()
+        stream = self._open_stream(messages, tools=[SEARCH_TOOL], tool_choice="none")
+        for delta in self._stream_deltas(stream, timings, None if emitted else start):
+            yield {'type': 'answer_delta', 'data': delta}
+        timings.add("generation", time.perf_counter() - round_start)
+
+    def start_speculative_retrieval(self, user_message, vector=None, snapshot=None, timings=None):
+        """在背景對原句做檢索，回傳 Future（未啟用時回傳 None）"""
+        if not self.speculative_retrieval:
+            return None
+        vectors = None if vector is None else vector.reshape(1, -1)
+        return self.executor.submit(self.retrieve_answers, [user_message], 3, vectors, snapshot, timings)
+
+    def lookup_answer(self, user_message, session=None):
+        """依序查精確快取與語意快取，回傳 (快取內容, 快取狀態, 問句向量)
+
+        追問（承接上一輪的問題）的回答取決於先前的對話，不查快取。
+        """
+        if self._is_follow_up(session, user_message):
+            return None, 'session', None
+        cached = self._cache_get(self._answer_key(user_message))
+        if cached is not None:
+            return cached, 'hit', None
+        if self.semantic_cache is None:
+            return None, 'miss', None
+
+        vector = self.embed_queries([user_message])[0]
+        return self._semantic_lookup(vector)
+
+    def finish_retrieval(self, main_query, queries_list, speculative=None, snapshot=None, timings=None):
+        """檢索所有子問題，與原句相同的子問題沿用預先檢索的結果"""
+        if speculative is None:
+            return self.retrieve_answers(queries_list, snapshot=snapshot, timings=timings)
+
+        new_queries = self._new_queries(main_query, queries_list)
+        new_results = self.retrieve_answers(new_queries, snapshot=snapshot, timings=timings) if new_queries else []
+        return self._merge_retrieval(main_query, queries_list, speculative.result(), new_results)
+
+    def answer(self, user_message, session_id=None, mode=None):
+        """/api/chat：完整跑完三個階段並回傳最終回答；相同問題進行中時共用同一次的結果
+
+        只有追問（session.is_follow_up）的回答取決於先前的對話，不查快取也不與其他請求共用；
+        其他問題即使帶 session_id 也照常共用，結束後再把這一輪記錄到自己的 session。
+        mode 為 full / fast，未指定時使用 self.mode。
+        """
+        mode = self._resolve_mode(mode)
+        session = self.load_session(session_id)
+        if self.single_flight is None or self._is_follow_up(session, user_message):
+            return self._answer(user_message, session, mode)[0]
+        snapshot = self.index
+        response, retrieved_answers = self.single_flight.call(
+            self._flight_key(user_message, mode), lambda: self._answer(user_message, mode=mode)
+        )
+        self._record_turn(session, user_message, response, retrieved_answers, snapshot)
+        return response
+
+    def stream_events(self, user_message, session_id=None, mode=None):
+        """/api/chat/stream：依序產生各階段事件；相同問題進行中時訂閱同一次的事件"""
+        mode = self._resolve_mode(mode)
+        session = self.load_session(session_id)
+        if self.single_flight is None or self._is_follow_up(session, user_message):
+            return self._stream_events(user_message, session, mode)
+        events = self.single_flight.stream(
+            self._flight_key(user_message, mode), lambda: self._stream_events(user_message, mode=mode)
+        )
+        if session is None:
+            return events
+        return self._recording_events(events, session, user_message, self.index)
+
+    def _answer(self, user_message, session=None, mode="full"):
+        """回傳 (回答, 檢索結果)；檢索結果供共用 single-flight 的 session 記錄這一輪"""
+        snapshot = self.index
+        timings = Timings()
+        history = self._history_text(session, user_message)
+        with timings.span("cache_lookup"):
+            cached, cache_status, vector = self.lookup_answer(user_message, session)
+        REQUESTS.inc(cache=cache_status)
+        if cached is not None:
+            self._record_turn(session, user_message, cached['answer'], cached['retrieved_answers'], snapshot)
+            timings.finish()
+            return cached['answer'], cached['retrieved_answers']
+
+        if self._is_follow_up(session, user_message):
+            result = self._follow_up_sub_queries(user_message, session)
+            with timings.span("retrieval"):
+                retrieved_answers = self.retrieve_follow_up(
+                    result['sub_queries'], session, snapshot=snapshot, timings=timings
+                )
+        elif mode == "fast":
+            result = self._fast_sub_queries(user_message)
+            with timings.span("retrieval"):
+                retrieved_answers = self.retrieve_answers(result['sub_queries'], snapshot=snapshot, timings=timings)
+        else:
+            speculative = self.start_speculative_retrieval(user_message, vector, snapshot, timings)
+            with timings.span("decomposition"):
+                result = self.separate_queries(user_message)
+            with timings.span("retrieval"):
+                retrieved_answers = self.finish_retrieval(
+                    user_message, result['sub_queries'], speculative, snapshot, timings
+                )
+        # 降級的回答（原句檢索或直接回傳資料）不寫入快取
+        degraded = result['cache'] == 'fallback'
+        try:
+            if mode == "fast":
+                response, extra = self.integrate_answers_fast(
+                    result['main_query'], retrieved_answers, snapshot=snapshot, timings=timings, history=history
+                )
+                retrieved_answers = retrieved_answers + extra
+            else:
+                response = self.integrate_answers(
+                    result['main_query'], retrieved_answers, timings=timings, history=history
+                )
+        except UpstreamUnavailable as e:
+            response, degraded = self._fallback_answer(retrieved_answers, e), True
+        if not history and not degraded:
+            self._cache_answer(user_message, vector, result['sub_queries'], retrieved_answers, response, snapshot)
+        self._record_turn(session, user_message, response, retrieved_answers, snapshot)
+        timings.finish()
+        return response, retrieved_answers
+
+    def _stream_events(self, user_message, session=None, mode="full"):
+        snapshot = self.index
+        timings = Timings()
+        history = self._history_text(session, user_message)
+        with timings.span("cache_lookup"):
+            cached, cache_status, vector = self.lookup_answer(user_message, session)
+        REQUESTS.inc(cache=cache_status)
+        if cached is not None:
+            self._record_turn(session, user_message, cached['answer'], cached['retrieved_answers'], snapshot)
+            yield from self._cached_answer_events(user_message, cached, cache_status, timings)
+            return
+
+        follow_up = self._is_follow_up(session, user_message)
+        if follow_up:
+            result = self._follow_up_sub_queries(user_message, session)
+        elif mode == "fast":
+            result, speculative = self._fast_sub_queries(user_message), None
+        else:
+            speculative = self.start_speculative_retrieval(user_message, vector, snapshot, timings)
+            with timings.span("decomposition"):
+                result = self.separate_queries(user_message)
+        main_query = result['main_query']
+        queries_list = result['sub_queries']
+        yield self._timed(self._stage1_event(main_query, queries_list, result['cache']), timings)
+
+        with timings.span("retrieval"):
+            if follow_up:
+                retrieved_answers = self.retrieve_follow_up(queries_list, session, snapshot=snapshot, timings=timings)
+            elif mode == "fast":
+                retrieved_answers = self.retrieve_answers(queries_list, snapshot=snapshot, timings=timings)
+            else:
+                retrieved_answers = self.finish_retrieval(main_query, queries_list, speculative, snapshot, timings)
+        yield self._timed(self._stage2_event(retrieved_answers), timings)
+        packed = self.pack_context(retrieved_answers, timings)
+        yield self._timed(self._stage3_event(main_query, packed, history), timings)
+
+        degraded = result['cache'] == 'fallback'
+        answer_parts = []
+        if mode == "fast":
+            events = self.integrate_answers_fast_stream(
+                main_query, retrieved_answers, packed, snapshot, timings, history
+            )
+        else:
+            events = ({'type': 'answer_delta', 'data': delta} for delta in
+                      self.integrate_answers_stream(main_query, retrieved_answers, packed, timings, history))
+        try:
+            for event in events:
+                if event['type'] == 'answer_delta':
+                    answer_parts.append(event['data'])
+                else:
+                    # fast 模式補充檢索的結果，一起寫入快取與 session
+                    retrieved_answers = retrieved_answers + event['data']
+                yield event
+        except UpstreamUnavailable as e:
+            degraded = True
+            if answer_parts:
+                # 已經送出部分回答：以送出的內容結束，不再接上降級的檢索資料
+                self._partial_answer(e)
+            else:
+                answer_parts = [self._fallback_answer(retrieved_answers, e)]
+                yield {'type': 'answer_delta', 'data': answer_parts[0]}
+        response = ''.join(answer_parts)
+        if not history and not degraded:
+            self._cache_answer(user_message, vector, queries_list, retrieved_answers, response, snapshot)
+        self._record_turn(session, user_message, response, retrieved_answers, snapshot)
+        timings.finish()
+        yield self._timed(self._answer_done_event(response, degraded), timings)
+        yield {'type': 'done'}
+
+    # ------------------------------------------------------------------
+    # asyncio 版本（ASGI）
+    # ------------------------------------------------------------------
+
+    async def aseparate_queries(self, user_input):
+        """separate_queries 的 async 版本"""
+        if self.decomposition_router is not None:
+            if self.decomposition_router.classifier is not None:
+                # hybrid 模式可能需要 embedding，不要在 event loop 上算
+                loop = asyncio.get_running_loop()
+                needs_llm = await loop.run_in_executor(self.executor, self.decomposition_router.route, user_input)
+            else:
+                needs_llm = self.decomposition_router.route(user_input)
+            if not needs_llm:
+                return self._local_sub_queries(user_input)
+
+        key = self._separate_key(user_input)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return self._cached_sub_queries(user_input, cached)
+
+        try:
+            response = await self._acomplete("decomposition", self._separate_messages(user_input))
+        except UpstreamUnavailable as e:
+            return self._fallback_sub_queries(user_input, e)
+        record_usage("decomposition", response.usage)
+        return self._parse_and_cache_sub_queries(key, user_input, response.choices[0].message.content)
+
+    async def aembed_queries(self, queries_list):
+        """embed_queries 的 async 版本：micro-batching 時等待排程器，否則在 thread pool 中執行"""
+        if self.micro_batching:
+            return np.asarray(await self.embedding_model.aembed_queries(queries_list), dtype=np.float32)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.embed_queries, queries_list)
+
+    async def aretrieve_answers(self, queries_list, top_k=3, vectors=None, snapshot=None, timings=None):
+        """retrieve_answers 的 async 版本，在 thread pool 中執行
+
+        micro-batching 時查詢向量先在 event loop 上等待，thread pool 只負責 FAISS 搜尋。
+        """
+        if vectors is None and self.micro_batching and queries_list:
+            timings = timings or Timings()
+            with timings.span("embedding"):
+                vectors = await self.aembed_queries(queries_list)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.retrieve_answers, queries_list, top_k, vectors, snapshot, timings
+        )
+
+    async def aretrieve_follow_up(self, queries_list, session, top_k=3, snapshot=None, timings=None):
+        """retrieve_follow_up 的 async 版本，在 thread pool 中執行"""
+        vectors = None
+        if self.micro_batching:
+            timings = timings or Timings()
+            with timings.span("embedding"):
+                vectors = await self.aembed_queries(queries_list)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.retrieve_follow_up, queries_list, session, top_k, vectors, snapshot, timings
+        )
+
+    async def alookup_answer(self, user_message, session=None):
+        """lookup_answer 的 async 版本"""
+        if self._is_follow_up(session, user_message):
+            return None, 'session', None
+        cached = self._cache_get(self._answer_key(user_message))
+        if cached is not None:
+            return cached, 'hit', None
+        if self.semantic_cache is None:
+            return None, 'miss', None
+
+        vectors = await self.aembed_queries([user_message])
+        return self._semantic_lookup(vectors[0])
+
+    async def aintegrate_answers(self, main_query, retrieved_answers, packed=None, timings=None, history=""):
+        """integrate_answers 的 async 版本"""
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        with timings.span("generation"):
+            response = await self._acomplete("answer", self._integrate_messages(main_query, packed, history))
+        record_usage("answer", response.usage)
+        return response.choices[0].message.content
+
+    async def aintegrate_answers_stream(self, main_query, retrieved_answers, packed=None, timings=None,
+                                        history=""):
+        """integrate_answers_stream 的 async 版本"""
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        start = time.perf_counter()
+        stream = await self._aopen_stream(self._integrate_messages(main_query, packed, history))
+        async for delta in self._astream_deltas(stream, timings, start):
+            yield delta
+        timings.add("generation", time.perf_counter() - start)
+
+    async def aintegrate_answers_fast(self, main_query, retrieved_answers, packed=None, snapshot=None,
+                                      timings=None, history=""):
+        """integrate_answers_fast 的 async 版本"""
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        messages = self._integrate_messages(main_query, packed, history)
+        with timings.span("generation"):
+            response = await self._acomplete("answer", messages, tools=[SEARCH_TOOL])
+        record_usage("answer", response.usage)
+        message = response.choices[0].message
+        if not message.tool_calls:
+            return message.content, []
+
+        tool_calls = self._tool_queries(message.tool_calls)
+        with timings.span("tool_retrieval"):
+            extra = await self.aretrieve_answers(
+                self._flat_tool_queries(tool_calls), snapshot=snapshot, timings=timings
+            )
+        messages = self._tool_messages(messages, tool_calls, extra)
+        with timings.span("generation"):
+            response = await self._acomplete("answer", messages, tools=[SEARCH_TOOL], tool_choice="none")
+        record_usage("answer", response.usage)
+        return response.choices[0].message.content, extra
+
+    async def aintegrate_answers_fast_stream(self, main_query, retrieved_answers, packed=None, snapshot=None,
+                                             timings=None, history=""):
+        """integrate_answers_fast_stream 的 async 版本"""
+        timings = timings or Timings()
+        packed = packed or self.pack_context(retrieved_answers, timings)
+        messages = self._integrate_messages(main_query, packed, history)
+        start = time.perf_counter()
+        pending = {}
+        stream = await self._aopen_stream(messages, tools=[SEARCH_TOOL])
+        emitted = False
+        async for delta in self._astream_deltas(stream, timings, start, pending):
+            emitted = True
+            yield {'type': 'answer_delta', 'data': delta}
+        timings.add("generation", time.perf_counter() - start)
+        if not pending or emitted:
+            return
+
+        tool_calls = self._tool_queries(self._pending_tool_calls(pending))
+        with timings.span("tool_retrieval"):
+            extra = await self.aretrieve_answers(
+                self._flat_tool_queries(tool_calls), snapshot=snapshot, timings=timings
+            )
+        yield self._timed(self._stage2_event(extra, extra=True), timings)
+        messages = self._tool_messages(messages, tool_calls, extra)
+        round_start = time.perf_counter()
+        stream = await self._aopen_stream(messages, tools=[SEARCH_TOOL], tool_choice="none")
+        async for delta in self._astream_deltas(stream, timings, None if emitted else start):
+            yield {'type': 'answer_delta', 'data': delta}
+        timings.add("generation", time.perf_counter() - round_start)
+
+    async def _aseparate_with_speculation(self, user_message, vector=None, snapshot=None, timings=None):
+        """語意拆解的同時在 thread pool 對原句做檢索"""
+        timings = timings or Timings()
+        if not self.speculative_retrieval:
+            with timings.span("decomposition"):
+                return await self.aseparate_queries(user_message), None
+
+        vectors = None if vector is None else vector.reshape(1, -1)
+        speculative = asyncio.ensure_future(self.aretrieve_answers([user_message], 3, vectors, snapshot, timings))
+        try:
+            with timings.span("decomposition"):
+                result = await self.aseparate_queries(user_message)
+        except BaseException:
+            speculative.cancel()
+            raise
+        return result, speculative
+
+    async def afinish_retrieval(self, main_query, queries_list, speculative=None, snapshot=None, timings=None):
+        """finish_retrieval 的 async 版本"""
+        if speculative is None:
+            return await self.aretrieve_answers(queries_list, snapshot=snapshot, timings=timings)
+
+        new_queries = self._new_queries(main_query, queries_list)
+        new_results = (await self.aretrieve_answers(new_queries, snapshot=snapshot, timings=timings)
+                       if new_queries else [])
+        return self._merge_retrieval(main_query, queries_list, await speculative, new_results)
+
+    async def aanswer(self, user_message, session_id=None, mode=None):
+        """answer 的 async 版本"""
+        mode = self._resolve_mode(mode)
+        session = self.load_session(session_id)
+        if self.single_flight is None or self._is_follow_up(session, user_message):
+            return (await self._aanswer(user_message, session, mode))[0]
+        snapshot = self.index
+        response, retrieved_answers = await self.single_flight.acall(
+            self._flight_key(user_message, mode), lambda: self._aanswer(user_message, mode=mode)
+        )
+        self._record_turn(session, user_message, response, retrieved_answers, snapshot)
+        return response
+
+    def astream_events(self, user_message, session_id=None, mode=None):
+        """stream_events 的 async 版本，回傳 async iterator"""
+        mode = self._resolve_mode(mode)
+        session = self.load_session(session_id)
+        if self.single_flight is None or self._is_follow_up(session, user_message):
+            return self._astream_events(user_message, session, mode)
+        events = self.single_flight.astream(
+            self._flight_key(user_message, mode), lambda: self._astream_events(user_message, mode=mode)
+        )
+        if session is None:
+            return events
+        return self._arecording_events(events, session, user_message, self.index)
+
+    async def _aanswer(self, user_message, session=None, mode="full"):
+        snapshot = self.index
+        timings = Timings()
+        history = self._history_text(session, user_message)
+        with timings.span("cache_lookup"):
+            cached, cache_status, vector = await self.alookup_answer(user_message, session)
+        REQUESTS.inc(cache=cache_status)
+        if cached is not None:
+            self._record_turn(session, user_message, cached['answer'], cached['retrieved_answers'], snapshot)
+            timings.finish()
+            return cached['answer'], cached['retrieved_answers']
+
+        if self._is_follow_up(session, user_message):
+            result = self._follow_up_sub_queries(user_message, session)
+            with timings.span("retrieval"):
+                retrieved_answers = await self.aretrieve_follow_up(
+                    result['sub_queries'], session, snapshot=snapshot, timings=timings
+                )
+        elif mode == "fast":
+            result = self._fast_sub_queries(user_message)
+            with timings.span("retrieval"):
+                retrieved_answers = await self.aretrieve_answers(
+                    result['sub_queries'], snapshot=snapshot, timings=timings
+                )
+        else:
+            result, speculative = await self._aseparate_with_speculation(user_message, vector, snapshot, timings)
+            with timings.span("retrieval"):
+                retrieved_answers = await self.afinish_retrieval(
+                    user_message, result['sub_queries'], speculative, snapshot, timings
+                )
+        degraded = result['cache'] == 'fallback'
+        try:
+            if mode == "fast":
+                response, extra = await self.aintegrate_answers_fast(
+                    result['main_query'], retrieved_answers, snapshot=snapshot, timings=timings, history=history
+                )
+                retrieved_answers = retrieved_answers + extra
+            else:
+                response = await self.aintegrate_answers(
+                    result['main_query'], retrieved_answers, timings=timings, history=history
+                )
+        except UpstreamUnavailable as e:
+            response, degraded = self._fallback_answer(retrieved_answers, e), True
+        if not history and not degraded:
+            self._cache_answer(user_message, vector, result['sub_queries'], retrieved_answers, response, snapshot)
+        self._record_turn(session, user_message, response, retrieved_answers, snapshot)
+        timings.finish()
+        return response, retrieved_answers
+
+    async def _astream_events(self, user_message, session=None, mode="full"):
+        snapshot = self.index
+        timings = Timings()
+        history = self._history_text(session, user_message)
+        with timings.span("cache_lookup"):
+            cached, cache_status, vector = await self.alookup_answer(user_message, session)
+        REQUESTS.inc(cache=cache_status)
+        if cached is not None:
+            self._record_turn(session, user_message, cached['answer'], cached['retrieved_answers'], snapshot)
+            for event in self._cached_answer_events(user_message, cached, cache_status, timings):
+                yield event
+            return
+
+        follow_up = self._is_follow_up(session, user_message)
+        if follow_up:
+            result, speculative = self._follow_up_sub_queries(user_message, session), None
+        elif mode == "fast":
+            result, speculative = self._fast_sub_queries(user_message), None
+        else:
+            result, speculative = await self._aseparate_with_speculation(user_message, vector, snapshot, timings)
+        main_query = result['main_query']
+        queries_list = result['sub_queries']
+        yield self._timed(self._stage1_event(main_query, queries_list, result['cache']), timings)
+
+        with timings.span("retrieval"):
+            if follow_up:
+                retrieved_answers = await self.aretrieve_follow_up(
+                    queries_list, session, snapshot=snapshot, timings=timings
+                )
+            elif mode == "fast":
+                retrieved_answers = await self.aretrieve_answers(queries_list, snapshot=snapshot, timings=timings)
+            else:
+                retrieved_answers = await self.afinish_retrieval(
+                    main_query, queries_list, speculative, snapshot, timings
+                )
+        yield self._timed(self._stage2_event(retrieved_answers), timings)
+        packed = self.pack_context(retrieved_answers, timings)
+        yield self._timed(self._stage3_event(main_query, packed, history), timings)
+
+        degraded = result['cache'] == 'fallback'
+        answer_parts = []
+        try:
+            if mode == "fast":
+                async for event in self.aintegrate_answers_fast_stream(
+                    main_query, retrieved_answers, packed, snapshot, timings, history
+                ):
+                    if event['type'] == 'answer_delta':
+                        answer_parts.append(event['data'])
+                    else:
+                        retrieved_answers = retrieved_answers + event['data']
+                    yield event
+            else:
+                async for delta in self.aintegrate_answers_stream(
+                    main_query, retrieved_answers, packed, timings, history
+                ):
+                    answer_parts.append(delta)
+                    yield {'type': 'answer_delta', 'data': delta}
+        except UpstreamUnavailable as e:
+            degraded = True
+            if answer_parts:
+                # 已經送出部分回答：以送出的內容結束，不再接上降級的檢索資料
+                self._partial_answer(e)
+            else:
+                answer_parts = [self._fallback_answer(retrieved_answers, e)]
+                yield {'type': 'answer_delta', 'data': answer_parts[0]}
+        response = ''.join(answer_parts)
+        if not history and not degraded:
+            self._cache_answer(user_message, vector, queries_list, retrieved_answers, response, snapshot)
+        self._record_turn(session, user_message, response, retrieved_answers, snapshot)
+        timings.finish()
+        yield self._timed(self._answer_done_event(response, degraded), timings)
+        yield {'type': 'done'}
+
+    # ------------------------------------------------------------------
+    # OpenAI 呼叫與降級
+    # ------------------------------------------------------------------
+
+    def _complete(self, call, messages, **options):
+        """非串流的 chat completion；有 upstream 時套用期限、重試、hedging 與 circuit breaker
+
+        options 直接傳給 API（例如 fast 模式的 tools / tool_choice）。
+        """
+        if self.upstream is None:
+            return self.client.chat.completions.create(model=self.model, messages=messages, **options)
+        return self.upstream.call(call, lambda timeout: self.client.chat.completions.create(
+            model=self.model, messages=messages, timeout=timeout, **options
+        ))
+
+    async def _acomplete(self, call, messages, **options):
+        if self.upstream is None:
+            return await self.async_client.chat.completions.create(model=self.model, messages=messages, **options)
+        return await self.upstream.acall(call, lambda timeout: self.async_client.chat.completions.create(
+            model=self.model, messages=messages, timeout=timeout, **options
+        ))
+
+    def _open_stream(self, messages, **options):
+        """開啟串流回答並讀到第一個 token；有 upstream 時這段期間的失敗可以重試
+
+        串流只有工具呼叫時會一路讀完（工具呼叫的參數很短）。
+        """
+        def request(**extra):
+            return first_token(self.client.chat.completions.create(
+                model=self.model, messages=messages, stream=True, stream_options={"include_usage": True},
+                **options, **extra
+            ))
+
+        if self.upstream is None:
+            return request()
+        return self.upstream.call("answer", lambda timeout: request(timeout=timeout))
+
+    async def _aopen_stream(self, messages, **options):
+        async def request(**extra):
+            return await afirst_token(await self.async_client.chat.completions.create(
+                model=self.model, messages=messages, stream=True, stream_options={"include_usage": True},
+                **options, **extra
+            ))
+
+        if self.upstream is None:
+            return await request()
+        return await self.upstream.acall("answer", lambda timeout: request(timeout=timeout))
+
+    @staticmethod
+    def _stream_deltas(stream, timings, start=None, tool_calls=None):
+        """逐一產生串流回答的文字片段並記錄用量
+
+        start 不是 None 時以第一個片段記錄 first_token；tool_calls 為 dict 時收集串流中的工具呼叫片段，
+        出現工具呼叫之後的文字不再送出（第二趟會重新生成回答）。
+        """
+        for chunk in stream:
+            if chunk.usage is not None:
+                record_usage("answer", chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if tool_calls is not None and delta.tool_calls:
+                RAGPipeline._collect_tool_calls(tool_calls, delta.tool_calls)
+            if delta.content and not tool_calls:
+                if start is not None:
+                    timings.add("first_token", time.perf_counter() - start)
+                    start = None
+                yield delta.content
+
+    @staticmethod
+    async def _astream_deltas(stream, timings, start=None, tool_calls=None):
+        """_stream_deltas 的 async 版本"""
+        async for chunk in stream:
+            if chunk.usage is not None:
+                record_usage("answer", chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if tool_calls is not None and delta.tool_calls:
+                RAGPipeline._collect_tool_calls(tool_calls, delta.tool_calls)
+            if delta.content and not tool_calls:
+                if start is not None:
+                    timings.add("first_token", time.perf_counter() - start)
+                    start = None
+                yield delta.content
+
+    @staticmethod
+    def _fallback_sub_queries(user_input, error):
+        """語意拆解失敗時直接以原句檢索（預先檢索的結果可以直接沿用）"""
+        print(f"語意拆解降級為原句: {error}")
+        DEGRADED.inc(call="decomposition")
+        return {
+            "main_query": user_input,
+            "sub_queries": [user_input],
+            "cache": "fallback"
+        }
+
+    @staticmethod
+    def _partial_answer(error):
+        """串流回答中途失敗，以已送出的部分回答結束"""
+        print(f"生成回答中途失敗，以已送出的部分回答結束: {error}")
+        DEGRADED.inc(call="answer")
+
+    @staticmethod
+    def _fallback_answer(retrieved_answers, error):
+        """生成回答失敗時，改為回傳分數最高的幾段檢索資料"""
+        print(f"生成回答降級為檢索資料: {error}")
+        DEGRADED.inc(call="answer")
+        chunks = dedupe_chunks(retrieved_answers)[:FALLBACK_CHUNKS]
+        if not chunks:
+            return "抱歉，目前服務忙碌中，請稍後再試。"
+        parts = [FALLBACK_INTRO]
+        for chunk in chunks:
+            text = " ".join(chunk["text"].split())
+            if len(text) > FALLBACK_CHUNK_CHARS:
+                text = text[:FALLBACK_CHUNK_CHARS] + "…"
+            parts.append(f"・{text}")
+        return "\n\n".join(parts)
+
+    # ------------------------------------------------------------------
+    # 多輪對話
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _is_follow_up(session, user_message):
+        return session is not None and session.is_follow_up(user_message)
+
+    def load_session(self, session_id):
+        """未啟用 session 或請求沒有帶 session_id 時回傳 None"""
+        if self.sessions is None or not session_id:
+            return None
+        return self.sessions.load(session_id)
+
+    def _history_text(self, session, user_message):
+        """只有追問才把對話紀錄放進 prompt，其他問題的 prompt 與沒有 session 時相同"""
+        if not self._is_follow_up(session, user_message):
+            return ""
+        return self.sessions.history_text(session)
+
+    @staticmethod
+    def _follow_up_sub_queries(user_input, session):
+        """追問不做語意拆解：接上上一輪的問題當成單一查詢，補足「這杯」之類的指代"""
+        return {
+            "main_query": user_input,
+            "sub_queries": [f"{session.last_question} {user_input}"],
+            "cache": "session"
+        }
+
+    def _record_turn(self, session, user_message, response, retrieved_answers, snapshot):
+        """保存這一輪的問答，以及分數最高的 chunk（列號與向量）供下一輪追問沿用"""
+        if session is None:
+            return
+        best = {}
+        for result in retrieved_answers:
+            # 舊版快取的檢索結果沒有 rows，這一輪就不保留 chunk
+            for row, doc_id, score in zip(result.get("rows", []), result["ids"], result["scores"]):
+                if row not in best or score > best[row]["score"]:
+                    best[row] = {"row": row, "id": doc_id, "score": score}
+        chunks = sorted(best.values(), key=lambda chunk: chunk["score"], reverse=True)[:self.sessions.max_chunks]
+        for chunk in chunks:
+            vector = reconstruct_row(snapshot.db.index, chunk["row"])
+            chunk["vector"] = None if vector is None else encode_vector(vector)
+        self.sessions.record(session, user_message, response, chunks, snapshot.version)
+
+    def _recording_events(self, events, session, user_message, snapshot):
+        """轉送共用 single-flight 的事件，在 answer_done 之前把這一輪記錄到自己的 session"""
+        retrieved_answers = []
+        for event in events:
+            if event['type'] == 'stage2':
+                # fast 模式補充檢索的 stage2 也一併記錄
+                retrieved_answers = retrieved_answers + event['data']
+            elif event['type'] == 'answer_done':
+                self._record_turn(session, user_message, event['data'], retrieved_answers, snapshot)
+            yield event
+
+    async def _arecording_events(self, events, session, user_message, snapshot):
+        """_recording_events 的 async 版本"""
+        retrieved_answers = []
+        async for event in events:
+            if event['type'] == 'stage2':
+                retrieved_answers = retrieved_answers + event['data']
+            elif event['type'] == 'answer_done':
+                self._record_turn(session, user_message, event['data'], retrieved_answers, snapshot)
+            yield event
+
+    # ------------------------------------------------------------------
+    # fast 模式
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _fast_sub_queries(user_input):
+        """fast 模式不呼叫 LLM 拆解：原句加上本地切出的子句"""
+        return {
+            "main_query": user_input,
+            "sub_queries": [user_input] + local_variants(user_input),
+            "cache": "fast"
+        }
+
+    @staticmethod
+    def _collect_tool_calls(pending, deltas):
+        """串流的工具呼叫分成多個片段送達，依 index 接起 id、名稱與參數"""
+        for delta in deltas:
+            call = pending.setdefault(delta.index, {"id": "", "name": "", "arguments": ""})
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function is not None:
+                call["name"] += delta.function.name or ""
+                call["arguments"] += delta.function.arguments or ""
+
+    @staticmethod
+    def _pending_tool_calls(pending):
+        return [pending[index] for index in sorted(pending)]
+
+    @staticmethod
+    def _tool_queries(tool_calls):
+        """取出每個工具呼叫要檢索的子問題，回傳 [(工具呼叫, 子問題)]；總數不超過 MAX_TOOL_QUERIES"""
+        parsed = []
+        remaining = MAX_TOOL_QUERIES
+        for call in tool_calls:
+            if not isinstance(call, dict):
+                call = {"id": call.id, "name": call.function.name, "arguments": call.function.arguments}
+            queries = []
+            if call["name"] == SEARCH_TOOL_NAME:
+                try:
+                    queries = json.loads(call["arguments"] or "{}").get("queries") or []
+                except (json.JSONDecodeError, AttributeError):
+                    print(f"無法解析工具呼叫的參數: {call['arguments']}")
+                if not isinstance(queries, list):
+                    queries = [queries]
+                queries = [str(q).strip() for q in queries if str(q).strip()][:remaining]
+            remaining -= len(queries)
+            parsed.append((call, queries))
+        return parsed
+
+    @staticmethod
+    def _flat_tool_queries(tool_calls):
+        return [query for _, queries in tool_calls for query in queries]
+
+    def _tool_messages(self, messages, tool_calls, extra):
+        """第二趟生成的 messages：原本的對話，加上模型的工具呼叫與每個呼叫的檢索結果"""
+        results = iter(extra)
+        messages = messages + [{
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {"id": call["id"], "type": "function",
+                 "function": {"name": call["name"], "arguments": call["arguments"]}}
+                for call, _ in tool_calls
+            ],
+        }]
+        for call, queries in tool_calls:
+            call_results = [next(results) for _ in queries]
+            found = any(result["chunks"] for result in call_results)
+            text = self.context_packer.pack(call_results).text if found else NO_TOOL_RESULTS
+            messages.append({"role": "tool", "tool_call_id": call["id"], "content": text})
+        return messages
+
+    # ------------------------------------------------------------------
+    # 快取
+    # ------------------------------------------------------------------
+
+    def _separate_key(self, user_input):
+        # 拆解結果與知識庫內容無關，不需要索引版本
+        return cache_key("separate", user_input, self.model, SEPARATE_PROMPT_HASH)
+
+    def _answer_key(self, user_input):
+        # 兩種模式共用回答快取：同一個問題的回答可以互相沿用
+        return cache_key("answer", user_input, self.model, ANSWER_PROMPT_HASH, self.index_version)
+
+    def _flight_key(self, user_input, mode):
+        # single-flight 則依模式分開，進行中的 full 請求不會拖慢 fast 請求
+        return f"{mode}:{self._answer_key(user_input)}"
+
+    def _resolve_mode(self, mode):
+        mode = mode or self.mode
+        if mode not in PIPELINE_MODES:
+            raise ValueError(f"未知的 mode: {mode}")
+        return mode
+
+    def _cache_get(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(key)
+
+    def _cache_set(self, key, value):
+        if self.cache is not None:
+            self.cache.set(key, value)
+
+    def _semantic_lookup(self, vector):
+        entry, _ = self.semantic_cache.lookup(vector, self.index_version)
+        if entry is not None:
+            return entry, 'semantic_hit', vector
+        return None, 'miss', vector
+
+    def _cache_answer(self, user_message, vector, queries_list, retrieved_answers, response, snapshot=None):
+        # 請求進行中知識庫已換版時不寫入，避免舊資料的回答存到新版本的 key 下
+        if snapshot is not None and snapshot.version != self.index_version:
+            return
+        # 連同拆解與檢索結果一起存，命中時 stream 也能重播各階段
+        entry = {
+            "sub_queries": queries_list,
+            "retrieved_answers": retrieved_answers,
+            "answer": response
+        }
+        self._cache_set(self._answer_key(user_message), entry)
+        if self.semantic_cache is not None and vector is not None:
+            self.semantic_cache.add(vector, entry, self.index_version)
+
+    def _parse_and_cache_sub_queries(self, key, user_input, raw_output):
+        result, parsed = self._parse_sub_queries(user_input, raw_output)
+        if parsed:
+            self._cache_set(key, {"sub_queries": result["sub_queries"]})
+        result["cache"] = "miss"
+        return result
+
+    @staticmethod
+    def _local_sub_queries(user_input):
+        return {
+            "main_query": user_input,
+            "sub_queries": [user_input],
+            "cache": "local"
+        }
+
+    @staticmethod
+    def _cached_sub_queries(user_input, cached):
+        return {
+            "main_query": user_input,
+            "sub_queries": cached["sub_queries"],
+            "cache": "hit"
+        }
+
+    def _cached_answer_events(self, main_query, cached, cache_status, timings):
+        """快取命中時不呼叫 OpenAI，直接重播各階段事件"""
+        retrieved_answers = cached['retrieved_answers']
+        yield self._timed(self._stage1_event(main_query, cached['sub_queries'], cache_status), timings)
+        yield self._timed(self._stage2_event(retrieved_answers), timings)
+        yield self._timed(self._stage3_event(main_query, self.context_packer.pack(retrieved_answers)), timings)
+        yield {'type': 'answer_delta', 'data': cached['answer']}
+        timings.finish()
+        yield self._timed({'type': 'answer_done', 'data': cached['answer'], 'cache': cache_status}, timings)
+        yield {'type': 'done'}
+
+    # ------------------------------------------------------------------
+    # 共用的 prompt / 事件組裝
+    # ------------------------------------------------------------------
+
+    def _timed(self, event, timings):
+        """SSE_TIMINGS=1 時在事件附上目前為止各階段的耗時（毫秒）"""
+        if self.event_timings:
+            event['timings'] = timings.snapshot()
+        return event
+
+    @staticmethod
+    def _separate_messages(user_input):
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT_SEPARATE},
+            {"role": "user", "content": build_separate_prompt(user_input)},
+        ]
+
+    @staticmethod
+    def _integrate_messages(main_query, packed, history=""):
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT_ANSWER},
+            {"role": "user", "content": build_final_prompt(main_query, packed.text, history)},
+        ]
+
+    @staticmethod
+    def _parse_sub_queries(user_input, raw_output):
+        """回傳 (結果, 是否解析出有效的子問題)；只有非空的字串 list 才算有效，其他一律改用原句"""
+        try:
+            sub_queries = json.loads(raw_output.strip())
+        except json.JSONDecodeError:
+            sub_queries = None
+        parsed = (isinstance(sub_queries, list) and bool(sub_queries)
+                  and all(isinstance(q, str) and q.strip() for q in sub_queries))
+        if not parsed:
+            sub_queries = [user_input]
+
+        return {
+            "main_query": user_input,
+            "sub_queries": sub_queries
+        }, parsed
+
+    @staticmethod
+    def _new_queries(main_query, queries_list):
+        """與原句不同、需要另外檢索的子問題"""
+        original = normalize_query(main_query)
+        return [q for q in queries_list if normalize_query(q) != original]
+
+    @staticmethod
+    def _merge_retrieval(main_query, queries_list, speculative_results, new_results):
+        """依子問題原本的順序組合預先檢索與新檢索的結果"""
+        original = normalize_query(main_query)
+        new_results = iter(new_results)
+
+        results = []
+        for sub_query in queries_list:
+            if normalize_query(sub_query) == original:
+                source = speculative_results[0]
+            else:
+                source = next(new_results)
+            results.append(dict(source, sub_query=sub_query))
+        return results
+
+    @staticmethod
+    def _answer_done_event(response, degraded=False):
+        event = {'type': 'answer_done', 'data': response, 'cache': 'miss'}
+        if degraded:
+            event['degraded'] = True
+        return event
+
+    @staticmethod
+    def _stage1_event(main_query, queries_list, cache_status='miss'):
+        return {
+            'type': 'stage1',
+            'data': {
+                'original_query': main_query,
+                'sub_queries': queries_list
+            },
+            'cache': cache_status
+        }
+
+    @staticmethod
+    def _stage2_event(retrieved_answers, extra=False):
+        """extra 為 fast 模式中模型要求的補充檢索"""
+        event = {
+            'type': 'stage2',
+            'data': retrieved_answers
+        }
+        if extra:
+            event['extra'] = True
+        return event
+
+    @staticmethod
+    def _stage3_event(main_query, packed, history=""):
+        return {
+            'type': 'stage3',
+            'data': {
+                'method': 'LLM integration with brand voice',
+                'note': 'Combined all retrieved information',
+                'final_prompt': build_final_prompt(main_query, packed.text, history),
+                'context': packed.stats
+            }
+        }
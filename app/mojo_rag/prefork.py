@@ -0,0 +1,102 @@
+"""
+gunicorn preload + fork 的多 worker 模式
+
+app.py 在 import 時載入 embedding 模型與 FAISS 索引。一般的多 worker 模式下每個
+worker 各自 import 一次，記憶體隨 worker 數線性成長。gunicorn.conf.py 改為：
+
+- preload_app：master 載入一次唯讀資源，再 fork 出 worker，以 copy-on-write 共用
+- fork 前 gc.freeze()：載入完成的物件移到永久世代，GC 不再寫入這些頁面
+- fork 後每個 worker 限制 torch / FAISS 的執行緒數（vCPU 數 / worker 數），避免超額訂閱
+- 背景執行緒（thread pool、micro-batch 排程器）不會跟著 fork，各元件以 after_fork_in_child
+  註冊在子行程重建
+- 啟動 warmup（第一次 forward pass 與 FAISS 搜尋）延到 fork 之後、每個 worker 限制執行緒數後才跑：
+  OpenMP 執行緒池在 master 建立後再 fork，worker 可能卡住
+- 熱更新 watcher 只在 worker 中啟動：master 不處理請求，在 master 輪詢並載入新索引只會多佔
+  一份記憶體，還會讓共用的頁面被複製
+
+原生格式的索引本來就是 mmap，所有 worker 共用 page cache；langchain 的 pickle 格式
+在 preload 後雖然也共用，但讀取時的 refcount 變動會讓被碰到的頁面逐漸複製。
+"""
+import gc
+import os
+import sys
+import weakref
+
+# gunicorn.conf.py 在 preload 時設定，app 載入時據此把 warmup 與 watcher 延到 fork 之後
+PRELOAD_ENV = "MOJO_RAG_PRELOAD"
+
+_worker_hooks = []
+
+
+def after_fork_in_child(callback):
+    """註冊 fork 後在子行程執行的 bound method；物件被回收後自動失效"""
+    ref = weakref.WeakMethod(callback)
+
+    def run():
+        method = ref()
+        if method is not None:
+            method()
+
+    os.register_at_fork(after_in_child=run)
+
+
+def preloading():
+    """目前是否在 gunicorn preload 的 master 中載入 app"""
+    return os.getenv(PRELOAD_ENV) == "1"
+
+
+def in_each_worker(callback):
+    """註冊 fork 後由 run_worker_hooks 在每個 worker 執行的 bound method（preload 時取代在 master 中執行）"""
+    _worker_hooks.append(weakref.WeakMethod(callback))
+
+
+def run_worker_hooks():
+    """gunicorn.conf.py 的 post_fork 在限制執行緒數之後呼叫，依註冊順序執行"""
+    for ref in _worker_hooks:
+        method = ref()
+        if method is not None:
+            method()
+
+
+def worker_threads(workers):
+    """每個 worker 的運算執行緒數：WORKER_THREADS，未設定時為 vCPU 數 / worker 數"""
+    configured = int(os.getenv("WORKER_THREADS", "0"))
+    if configured > 0:
+        return configured
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def limit_threads(threads):
+    """限制目前行程中 torch 與 FAISS 的 OpenMP 執行緒數"""
+    import faiss
+
+    faiss.omp_set_num_threads(threads)
+    # 只在已經載入時設定，不為此 import torch
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(threads)
+    print(f"worker {os.getpid()}: torch / FAISS 執行緒數 {threads}")
+
+
+def prepare_fork():
+    """fork 前呼叫：回收垃圾後凍結所有物件，減少 worker 中的 copy-on-write"""
+    gc.collect()
+    gc.freeze()
+    print(f"已凍結 {gc.get_freeze_count()} 個物件，準備 fork worker")
+
+
+def memory_mb(pid=None):
+    """行程的 RSS、PSS 與 USS（獨占，MB）；USS 即多開一個 worker 實際增加的記憶體"""
+    path = f"/proc/{pid or 'self'}/smaps_rollup"
+    values = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                values[parts[0][:-1]] = int(parts[1])
+    uss = values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    return {
+        "rss_mb": round(values.get("Rss", 0) / 1024, 1),
+        "pss_mb": round(values.get("Pss", 0) / 1024, 1),
+        "uss_mb": round(uss / 1024, 1),
+    }
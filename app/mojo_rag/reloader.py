@@ -0,0 +1,136 @@
+"""
+向量資料庫熱更新
+
+IndexWatcher 在背景執行緒定期檢查索引的版本標記，有變動時：
+
+1. （選用）呼叫 before_check，例如 Modal 的 volume.reload()
+2. （選用）把索引複製到本機 staging 目錄，避免 mmap 佔住 Volume 上的檔案
+3. 在背景載入新索引並做一次暖機檢索，把需要的頁面讀進記憶體
+4. 呼叫 pipeline.swap_index() 換上新版本
+
+整個過程都不在請求路徑上；進行中的請求繼續使用自己的快照，載入失敗時保留舊版本。
+"""
+import hashlib
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from .native_index import MANIFEST_FILE, is_native_store
+from .prefork import after_fork_in_child
+from .vectorstore import index_version, load_vector_store
+
+
+def version_marker(faiss_path):
+    """便宜的版本標記：原生格式讀 store.json，舊格式看檔案大小與修改時間"""
+    if is_native_store(faiss_path):
+        with open(os.path.join(faiss_path, MANIFEST_FILE), "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()[:16]
+    stats = []
+    for name in sorted(os.listdir(faiss_path)):
+        path = os.path.join(faiss_path, name)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            stats.append(f"{name}:{st.st_size}:{st.st_mtime_ns}")
+    return hashlib.sha256("\n".join(stats).encode("utf-8")).hexdigest()[:16]
+
+
+def stage_copy(faiss_path, staging_root, marker=None):
+    """把索引複製到 staging_root/<版本標記>/ 並回傳該路徑"""
+    marker = marker or version_marker(faiss_path)
+    target = os.path.join(staging_root, marker)
+    if not os.path.isdir(target):
+        tmp_target = f"{target}.tmp"
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        shutil.copytree(faiss_path, tmp_target, ignore=shutil.ignore_patterns(".*"))
+        os.replace(tmp_target, target)
+    return target
+
+
+def warm_up(db):
+    """一次全索引檢索，把向量頁面讀進 page cache"""
+    db.index.search(np.zeros((1, db.index.d), dtype=np.float32), 1)
+    for shard in getattr(db, "shards", {}).values():
+        shard.search(np.zeros((1, db.index.d), dtype=np.float32), 1)
+
+
+class IndexWatcher:
+    """定期檢查並熱更新 pipeline 的向量資料庫"""
+
+    def __init__(self, pipeline, faiss_path, interval=30.0, before_check=None, staging_dir=None):
+        self.pipeline = pipeline
+        self.faiss_path = faiss_path
+        self.interval = interval
+        self.before_check = before_check
+        self.staging_dir = staging_dir
+        self.reloads = 0
+        # 第一輪檢查時以索引版本與 pipeline 比對，載入到啟動 watcher 之間的更新也不會漏掉
+        self._marker = None
+        self._stop = threading.Event()
+        self._thread = None
+        # fork 前已啟動的 watcher 執行緒不會跟著 fork，子行程各自重新啟動
+        # （gunicorn preload 時 app.py 不在 master 啟動，而是由 post_fork 在每個 worker 啟動）
+        after_fork_in_child(self._after_fork)
+
+    def _after_fork(self):
+        if self._thread is not None and not self._stop.is_set():
+            self.start()
+
+    @classmethod
+    def from_env(cls, pipeline, faiss_path, **kwargs):
+        """INDEX_RELOAD_INTERVAL 秒檢查一次；設為 0 時回傳 None"""
+        interval = float(os.getenv("INDEX_RELOAD_INTERVAL", "30"))
+        if interval <= 0:
+            return None
+        return cls(pipeline, faiss_path, interval, **kwargs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="index-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                # 檔案可能還在寫入中，下一輪再試
+                print(f"向量資料庫熱更新失敗，繼續使用 {self.pipeline.index_version}: {e}")
+
+    def check(self):
+        """檢查一次；有新版本並成功換上時回傳 True"""
+        if self.before_check is not None:
+            self.before_check()
+        marker = version_marker(self.faiss_path)
+        if marker == self._marker:
+            return False
+
+        path = self.faiss_path
+        if self.staging_dir:
+            path = stage_copy(self.faiss_path, self.staging_dir, marker)
+        version = index_version(path)
+        if version == self.pipeline.index_version:
+            self._marker = marker
+            return False
+
+        db = load_vector_store(path, self.pipeline.embedding_model)
+        if db.index.d != self.pipeline.db.index.d:
+            raise ValueError(f"新索引的維度 {db.index.d} 與目前的 {self.pipeline.db.index.d} 不同")
+        warm_up(db)
+
+        self.pipeline.swap_index(db, version)
+        self._marker = marker
+        self.reloads += 1
+        if self.staging_dir:
+            self._cleanup_staging(keep=os.path.basename(path))
+        return True
+
+    def _cleanup_staging(self, keep):
+        # 舊版本可能還有請求在用，但 Linux 上刪除已 mmap 的檔案不影響既有的映射
+        for name in os.listdir(self.staging_dir):
+            if name != keep:
+                shutil.rmtree(os.path.join(self.staging_dir, name), ignore_errors=True)
@@ -0,0 +1,352 @@
+"""
+OpenAI 呼叫的尾端延遲控制
+
+上游一次慢回應就會佔住 worker 直到它回來，失敗時只剩 /api/chat 的 500。
+UpstreamGuard 包住每一次 chat.completions.create：
+
+- 期限：每種呼叫（decomposition / answer）有自己的總期限，每次嘗試的 timeout 為剩餘時間
+- 重試：連線錯誤、逾時、429 與 5xx 以 full jitter 的指數退避在期限內重試（SDK 本身不再重試）
+- hedging：語意拆解是短的非串流呼叫，第一個請求超過近期耗時的 p95 仍未回來時，
+  再送一個相同的請求，取先回來的結果
+- circuit breaker：每種呼叫連續失敗達門檻後直接拒絕，冷卻時間過後放一個請求試探
+
+期限內仍沒有成功的回應、或 breaker 開啟中時拋出 UpstreamUnavailable，由 pipeline 改走
+降級路徑：語意拆解直接使用原句，生成回答改為回傳檢索到的資料。各呼叫的結果、breaker
+狀態與降級次數都在 /metrics。
+"""
+import asyncio
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import httpx
+import openai
+
+from .metrics import CIRCUIT_STATE, UPSTREAM_CALLS
+from .prefork import after_fork_in_child
+
+# 值得重試的錯誤：連線失敗與逾時（APITimeoutError 是 APIConnectionError 的子類別）、429、5xx；
+# 串流讀取中途的錯誤不經過 SDK 包裝，直接是 httpx 的例外
+RETRYABLE = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError, httpx.TransportError)
+TIMEOUTS = (openai.APITimeoutError, httpx.TimeoutException)
+
+# 各呼叫的總期限（秒）；串流回答的期限涵蓋到第一個 token 為止
+DEFAULT_DEADLINES = {"decomposition": 4.0, "answer": 20.0}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class UpstreamUnavailable(Exception):
+    """期限內沒有成功的回應，或 circuit breaker 開啟中"""
+
+
+class LatencyWindow:
+    """最近幾次成功呼叫的耗時，用來估計 hedging 的等待時間"""
+
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q, default):
+        """樣本不足 min_samples 時回傳 default"""
+        with self._lock:
+            values = sorted(self._samples)
+        if len(values) < self.min_samples:
+            return default
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class CircuitBreaker:
+    """連續失敗 failure_threshold 次後開啟，reset_timeout 秒後放一個請求試探（half-open）"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set(STATE_VALUES[CLOSED], call=name)
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        CIRCUIT_STATE.set(STATE_VALUES[state], call=self.name)
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # 試探中的請求回來之前，其他請求一律拒絕
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(CLOSED)
+
+    def release(self):
+        """結果不代表上游狀態（取消、本地錯誤）時只歸還試探的名額，不改變狀態與失敗次數"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+class UpstreamGuard:
+    """為 OpenAI 呼叫加上期限、重試、hedging 與 circuit breaker
+
+    request 為送出一次請求的函式，接受 timeout（秒）參數；async 版本回傳 awaitable。
+    """
+
+    def __init__(self, deadlines=None, retries=2, backoff=0.2, hedge_calls=("decomposition",),
+                 hedge_quantile=0.95, hedge_min_delay=0.2, hedge_default_delay=1.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.deadlines = dict(DEFAULT_DEADLINES, **(deadlines or {}))
+        self.retries = retries
+        # 第 n 次重試前等待 uniform(0, backoff * 2^n) 秒（full jitter）
+        self.backoff = backoff
+        self.hedge_calls = tuple(hedge_calls)
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        # 累積足夠樣本前使用的 hedging 等待時間
+        self.hedge_default_delay = hedge_default_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.latencies = {}
+        self._lock = threading.Lock()
+        # 同步版本的 hedging 需要在背景執行緒送出請求
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="openai-hedge")
+        after_fork_in_child(self._after_fork)
+
+    def _after_fork(self):
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="openai-hedge")
+
+    @classmethod
+    def from_env(cls):
+        """UPSTREAM_GUARD=0 時回傳 None（直接呼叫 OpenAI，由 SDK 自行重試，沒有期限）"""
+        if os.getenv("UPSTREAM_GUARD", "1") != "1":
+            return None
+        return cls(
+            deadlines={
+                "decomposition": float(os.getenv("DECOMPOSITION_DEADLINE", "4")),
+                "answer": float(os.getenv("ANSWER_DEADLINE", "20")),
+            },
+            retries=int(os.getenv("OPENAI_RETRIES", "2")),
+            backoff=float(os.getenv("RETRY_BACKOFF_MS", "200")) / 1000,
+            hedge_calls=("decomposition",) if os.getenv("HEDGE_DECOMPOSITION", "1") == "1" else (),
+            hedge_min_delay=float(os.getenv("HEDGE_MIN_DELAY_MS", "200")) / 1000,
+            failure_threshold=int(os.getenv("BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("BREAKER_RESET_SECONDS", "30")),
+        )
+
+    def breaker(self, call):
+        with self._lock:
+            if call not in self.breakers:
+                self.breakers[call] = CircuitBreaker(call, self.failure_threshold, self.reset_timeout)
+                self.latencies[call] = LatencyWindow()
+            return self.breakers[call]
+
+    def hedge_delay(self, call):
+        """近期耗時的 p95，不低於 hedge_min_delay"""
+        self.breaker(call)
+        delay = self.latencies[call].quantile(self.hedge_quantile, self.hedge_default_delay)
+        return max(self.hedge_min_delay, delay)
+
+    def _backoff_seconds(self, attempt, deadline):
+        if attempt >= self.retries:
+            return 0.0
+        return min(random.uniform(0, self.backoff * 2 ** attempt), max(0.0, deadline - time.monotonic()))
+
+    def _before_attempt(self, call, breaker):
+        if not breaker.allow():
+            UPSTREAM_CALLS.inc(call=call, outcome="rejected")
+            raise UpstreamUnavailable(f"{call}: circuit breaker open")
+
+    def _on_success(self, call, breaker, seconds):
+        breaker.record_success()
+        self.latencies[call].add(seconds)
+        UPSTREAM_CALLS.inc(call=call, outcome="ok")
+
+    def _on_failure(self, call, breaker, error):
+        breaker.record_failure()
+        outcome = "timeout" if isinstance(error, TIMEOUTS) else "error"
+        UPSTREAM_CALLS.inc(call=call, outcome=outcome)
+        print(f"OpenAI {call} 失敗（{outcome}）: {error}")
+
+    @staticmethod
+    def _on_other_error(breaker, error):
+        if isinstance(error, openai.APIStatusError) and 400 <= error.status_code < 500:
+            # 上游有回應（例如 400），不算 breaker 的失敗
+            breaker.record_success()
+        else:
+            # 取消、KeyboardInterrupt 或本地的錯誤沒有上游的回應，不影響 breaker
+            breaker.release()
+
+    # ------------------------------------------------------------------
+    # 同步版本
+    # ------------------------------------------------------------------
+
+    def call(self, call, request):
+        breaker = self.breaker(call)
+        deadline = time.monotonic() + self.deadlines[call]
+        for attempt in range(self.retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._before_attempt(call, breaker)
+            start = time.monotonic()
+            try:
+                if call in self.hedge_calls:
+                    result = self._hedged(call, request, remaining)
+                else:
+                    result = request(remaining)
+            except RETRYABLE as e:
+                self._on_failure(call, breaker, e)
+                time.sleep(self._backoff_seconds(attempt, deadline))
+                continue
+            except BaseException as e:
+                self._on_other_error(breaker, e)
+                raise
+            self._on_success(call, breaker, time.monotonic() - start)
+            return result
+        raise UpstreamUnavailable(f"{call}: no successful response within {self.deadlines[call]}s")
+
+    def _hedged(self, call, request, timeout):
+        first = self.executor.submit(request, timeout)
+        futures = [first]
+        delay = self.hedge_delay(call)
+        if delay < timeout and not wait(futures, timeout=delay).done:
+            UPSTREAM_CALLS.inc(call=call, outcome="hedged")
+            futures.append(self.executor.submit(request, timeout - delay))
+
+        errors = []
+        # 每個請求都帶 timeout，最後一定會結束；輸掉的請求在背景跑完後直接丟棄
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except RETRYABLE as e:
+                errors.append(e)
+                continue
+            if future is not first:
+                UPSTREAM_CALLS.inc(call=call, outcome="hedge_won")
+            return result
+        raise errors[0]
+
+    # ------------------------------------------------------------------
+    # asyncio 版本
+    # ------------------------------------------------------------------
+
+    async def acall(self, call, request):
+        """call 的 async 版本；request(timeout) 回傳 awaitable"""
+        breaker = self.breaker(call)
+        deadline = time.monotonic() + self.deadlines[call]
+        for attempt in range(self.retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._before_attempt(call, breaker)
+            start = time.monotonic()
+            try:
+                if call in self.hedge_calls:
+                    result = await self._ahedged(call, request, remaining)
+                else:
+                    result = await request(remaining)
+            except RETRYABLE as e:
+                self._on_failure(call, breaker, e)
+                await asyncio.sleep(self._backoff_seconds(attempt, deadline))
+                continue
+            except BaseException as e:
+                self._on_other_error(breaker, e)
+                raise
+            self._on_success(call, breaker, time.monotonic() - start)
+            return result
+        raise UpstreamUnavailable(f"{call}: no successful response within {self.deadlines[call]}s")
+
+    async def _ahedged(self, call, request, timeout):
+        first = asyncio.ensure_future(request(timeout))
+        pending = {first}
+        delay = self.hedge_delay(call)
+        try:
+            if delay < timeout:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    UPSTREAM_CALLS.inc(call=call, outcome="hedged")
+                    pending.add(asyncio.ensure_future(request(timeout - delay)))
+
+            errors = []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        if task is not first:
+                            UPSTREAM_CALLS.inc(call=call, outcome="hedge_won")
+                        return task.result()
+                    if not isinstance(error, RETRYABLE):
+                        raise error
+                    errors.append(error)
+            raise errors[0]
+        finally:
+            # 取消輸掉的請求（asyncio 可以真正中斷連線）
+            for task in pending:
+                task.cancel()
+
+
+def first_token(stream):
+    """讀到第一個有內容的 chunk 為止，回傳從頭開始的 chunk iterator
+
+    串流回答在第一個 token 之前失敗還可以重試或降級，之後就只能照常輸出。
+    """
+    chunks = iter(stream)
+    head = []
+    for chunk in chunks:
+        head.append(chunk)
+        if chunk.choices and chunk.choices[0].delta.content:
+            break
+    return itertools.chain(head, chunks)
+
+
+async def afirst_token(stream):
+    """first_token 的 async 版本，回傳 async iterator"""
+    chunks = stream.__aiter__()
+    head = []
+    async for chunk in chunks:
+        head.append(chunk)
+        if chunk.choices and chunk.choices[0].delta.content:
+            break
+
+    async def replay():
+        for chunk in head:
+            yield chunk
+        async for chunk in chunks:
+            yield chunk
+
+    return replay()
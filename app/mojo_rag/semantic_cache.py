@@ -0,0 +1,96 @@
+"""
+語意快取：以問句 embedding 相似度比對曾回答過的問題
+
+精確快取（cache.py）抓不到換句話說的問法，例如「有什麼推薦的調酒？」與
+「推薦一杯調酒給我」。這裡用一個小型 FAISS 內積索引存放已回答問句的
+（正規化後）E5 向量，相似度超過門檻就直接沿用當時的回答。
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+
+class SemanticCache:
+    """有容量上限（LRU 淘汰）的問句向量快取，知識庫版本變更時整個清空"""
+
+    def __init__(self, dim, threshold=0.95, max_entries=512, index_version=""):
+        self.dim = dim
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.index_version = index_version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    @classmethod
+    def from_env(cls, dim, index_version=""):
+        """依環境變數建立；SEMANTIC_CACHE 不為 1 時回傳 None"""
+        if os.getenv("SEMANTIC_CACHE", "0") != "1":
+            return None
+        return cls(
+            dim,
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+            max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "512")),
+            index_version=index_version,
+        )
+
+    def _reset(self):
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+        self._entries = OrderedDict()
+        self._next_id = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.array(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _check_version(self, index_version):
+        # 知識庫更新後舊回答可能已不正確
+        if index_version != self.index_version:
+            self._reset()
+            self.index_version = index_version
+
+    def lookup(self, vector, index_version=""):
+        """回傳 (entry, 相似度)；未命中時 entry 為 None"""
+        query = self._normalize(vector)
+        with self._lock:
+            self._check_version(index_version)
+            if not self._entries:
+                self.misses += 1
+                return None, 0.0
+
+            scores, ids = self._index.search(query, 1)
+            score, entry_id = float(scores[0][0]), int(ids[0][0])
+            if entry_id == -1 or score < self.threshold:
+                self.misses += 1
+                return None, score
+
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return self._entries[entry_id], score
+
+    def add(self, vector, entry, index_version=""):
+        """記錄一筆已回答的問句"""
+        query = self._normalize(vector)
+        with self._lock:
+            self._check_version(index_version)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(query, np.array([entry_id], dtype=np.int64))
+            self._entries[entry_id] = entry
+
+            while len(self._entries) > self.max_entries:
+                evicted_id, _ = self._entries.popitem(last=False)
+                self._index.remove_ids(np.array([evicted_id], dtype=np.int64))
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def __len__(self):
+        return len(self._entries)
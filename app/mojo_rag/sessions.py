@@ -0,0 +1,223 @@
+"""
+多輪對話的 session
+
+/api/chat 帶上 session_id 時，每個 session 保留一份精簡的紀錄：
+
+- 最近幾輪的問答（更早的輪次摺疊成一行一輪的摘要）
+- 上一輪檢索到的 chunk（列號、分數與 float16 向量）
+
+追問（例如「那這杯的酒精濃度呢？」）不再呼叫 LLM 做語意拆解：以上一輪問題加上
+追問 embedding 一次，對保留的 chunk 直接以向量重新計分，再以一次檢索補上新的
+chunk。對話紀錄在 SESSION_HISTORY_TOKENS 內放進 prompt，加上 CONTEXT_TOKEN_BUDGET，
+整個 prompt 的長度有固定上限。不是追問的問題與沒有 session 時相同，照常使用回答快取與
+single-flight，只把這一輪記錄下來。
+
+儲存層可替換，只需要 get / set：
+- MemorySessionStore：行程內、以位元組數為上限的 LRU（加上 TTL）
+- DiskCache（cache.py）：每個 session 一個 JSON 檔，多個 gunicorn worker 或 container 共用
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .cache import DiskCache
+from .context import TokenCounter, compact_text
+
+# 追問常見的指代詞與語氣：出現時沿用上一輪的檢索結果
+FOLLOW_UP_MARKERS = re.compile(r"這杯|那杯|這個|那個|這間|那間|它|他們|剛剛|剛才|上面|前面|上述|呢[？?]?$|^那|^還有|^另外")
+# 超過這個長度的問題通常自成一題，照一般流程拆解與檢索
+MAX_FOLLOW_UP_LENGTH = 30
+# 摘要中每輪回答保留的字數
+SUMMARY_ANSWER_CHARS = 60
+# 摘要最多保留的行數（更早的輪次直接捨棄）
+SUMMARY_MAX_LINES = 12
+
+
+def is_follow_up(text):
+    """判斷問題是否承接上一輪（需要上一輪的內容才看得懂）"""
+    text = text.strip()
+    return len(text) <= MAX_FOLLOW_UP_LENGTH and bool(FOLLOW_UP_MARKERS.search(text))
+
+
+def encode_vector(vector):
+    """float16 + base64，JSON 可序列化且只有 float32 的一半大小"""
+    return base64.b64encode(np.asarray(vector, dtype=np.float16).tobytes()).decode("ascii")
+
+
+def decode_vector(data):
+    return np.frombuffer(base64.b64decode(data), dtype=np.float16).astype(np.float32)
+
+
+class MemorySessionStore:
+    """thread-safe 的 LRU，以 JSON 序列化後的位元組數為上限，並有 TTL"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=1800):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, size, value = item
+            if expires_at < time.time():
+                del self._data[key]
+                self.bytes -= size
+                return None
+            self._data.move_to_end(key)
+            return json.loads(value)
+
+    def set(self, key, value):
+        value = json.dumps(value, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (time.time() + self.ttl, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._data) > 1:
+                _, (_, evicted, _) = self._data.popitem(last=False)
+                self.bytes -= evicted
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Session:
+    """單一 session 的對話紀錄與上一輪的檢索結果"""
+
+    def __init__(self, session_id, turns=None, summary=None, chunks=None, index_version=""):
+        self.session_id = session_id
+        # [{question, answer}]，由舊到新
+        self.turns = turns or []
+        # 較早輪次的摘要，一行一輪
+        self.summary = summary or []
+        # [{row, id, score, vector}]；vector 為 encode_vector 的結果，索引不支援還原向量時為 None
+        self.chunks = chunks or []
+        self.index_version = index_version
+
+    @classmethod
+    def from_dict(cls, session_id, data):
+        return cls(session_id, data.get("turns"), data.get("summary"), data.get("chunks"), data.get("index_version", ""))
+
+    def to_dict(self):
+        return {
+            "turns": self.turns,
+            "summary": self.summary,
+            "chunks": self.chunks,
+            "index_version": self.index_version,
+        }
+
+    @property
+    def has_history(self):
+        return bool(self.turns)
+
+    @property
+    def last_question(self):
+        return self.turns[-1]["question"] if self.turns else ""
+
+    def is_follow_up(self, text):
+        return self.has_history and bool(self.chunks) and is_follow_up(text)
+
+    def reusable_chunks(self, index_version):
+        """知識庫換版後列號不再有效"""
+        return self.chunks if self.index_version == index_version else []
+
+
+class SessionManager:
+    """載入、更新與保存 session；store 為任何提供 get / set 的儲存層"""
+
+    def __init__(self, store, max_turns=4, history_tokens=600, max_chunks=8, answer_chars=400, model=None):
+        self.store = store
+        self.max_turns = max_turns
+        self.history_tokens = history_tokens
+        self.max_chunks = max_chunks
+        # 保存的回答長度上限：對話紀錄只需要足以承接追問的內容
+        self.answer_chars = answer_chars
+        self.counter = TokenCounter(model)
+
+    @classmethod
+    def from_env(cls, model=None):
+        """SESSION_STORE=memory / disk；設為 0 時回傳 None（/api/chat 不保留對話）"""
+        backend = os.getenv("SESSION_STORE", "memory")
+        if backend == "0":
+            return None
+        ttl = int(os.getenv("SESSION_TTL", "1800"))
+        if backend == "disk":
+            store = DiskCache(os.getenv("SESSION_STORE_DIR", ".cache/sessions"), ttl=ttl)
+        elif backend == "memory":
+            store = MemorySessionStore(int(float(os.getenv("SESSION_STORE_MB", "64")) * 1024 * 1024), ttl)
+        else:
+            raise ValueError(f"未知的 SESSION_STORE: {backend}")
+        return cls(
+            store,
+            max_turns=int(os.getenv("SESSION_MAX_TURNS", "4")),
+            history_tokens=int(os.getenv("SESSION_HISTORY_TOKENS", "600")),
+            model=model,
+        )
+
+    @staticmethod
+    def _key(session_id):
+        # session_id 來自用戶端，hash 後才當成 key（磁碟層以 key 為檔名）
+        return hashlib.sha256(f"session\0{session_id}".encode("utf-8")).hexdigest()
+
+    def load(self, session_id):
+        data = self.store.get(self._key(session_id))
+        return Session.from_dict(session_id, data) if data else Session(session_id)
+
+    def save(self, session):
+        self.store.set(self._key(session.session_id), session.to_dict())
+
+    def record(self, session, question, answer, chunks, index_version):
+        """記錄一輪問答與這一輪的檢索結果，超過 max_turns 的舊輪次摺疊進摘要"""
+        session.turns.append({"question": question, "answer": answer[:self.answer_chars]})
+        while len(session.turns) > self.max_turns:
+            old = session.turns.pop(0)
+            answer_head = " ".join(old["answer"].split())[:SUMMARY_ANSWER_CHARS]
+            session.summary.append(f"{old['question']} → {answer_head}")
+        del session.summary[:-SUMMARY_MAX_LINES]
+        session.chunks = chunks[:self.max_chunks]
+        session.index_version = index_version
+        self.save(session)
+
+    def history_text(self, session):
+        """放進 prompt 的對話紀錄：由新到舊放入最近的輪次，剩下的預算給摘要"""
+        if not session.has_history:
+            return ""
+        budget = self.history_tokens
+        turns = []
+        for turn in reversed(session.turns):
+            text = f"旅客：{turn['question']}\n品牌大使：{compact_text(turn['answer'])}"
+            tokens = self.counter.count(text) + 1
+            if budget > 0 and tokens > budget:
+                if not turns:
+                    # 至少保留最近一輪
+                    turns.append(self.counter.truncate(text, budget))
+                break
+            turns.append(text)
+            budget -= tokens
+        summary = []
+        for line in reversed(session.summary):
+            tokens = self.counter.count(line) + 3
+            if self.history_tokens > 0 and tokens > budget:
+                break
+            summary.append(f"- {line}")
+            budget -= tokens
+
+        parts = []
+        if summary:
+            parts.append("較早的對話摘要：\n" + "\n".join(reversed(summary)))
+        parts.append("\n\n".join(reversed(turns)))
+        return "\n\n".join(parts)
@@ -0,0 +1,130 @@
+"""
+依類別分片的檢索
+
+知識庫混合了三種內容：品牌故事、調酒酒單與媒體報導。每個子問題都搜尋全部
+內容時，問調酒的問題也會撈到媒體報導，白白佔用 prompt。
+
+- 建置時（ingest.py）依來源檔名為每個 chunk 標上類別，除了全域索引之外，
+  每個類別另外寫一個子索引（shards/<類別>.faiss）與子索引列號 → 全域列號的對照表
+- 檢索時 ShardRouter 以關鍵字判斷子問題相關的類別，只搜尋對應的子索引；
+  判斷不出類別、或子索引的結果不足 top_k 筆時退回全域搜尋
+
+搜尋範圍變小，知識庫變大時延遲也跟著降低。
+"""
+import os
+import re
+
+import faiss
+import numpy as np
+
+from .metrics import RETRIEVAL_ROUTES
+
+CATEGORIES = ("brand", "menu", "media")
+DEFAULT_CATEGORY = "brand"
+
+# 依來源路徑決定類別，依序比對，都不符合時為 DEFAULT_CATEGORY
+SOURCE_RULES = (
+    ("media", re.compile(r"media|press|news", re.IGNORECASE)),
+    ("menu", re.compile(r"cocktail|menu|drink", re.IGNORECASE)),
+)
+
+# 子問題中出現這些詞時搜尋對應類別；可同時符合多個類別
+QUERY_KEYWORDS = {
+    "menu": (
+        "調酒", "酒單", "雞尾酒", "特調", "一杯", "喝", "口味", "口感", "風味", "酒精", "酒感",
+        "原料", "基酒", "價格", "多少錢", "清爽", "cocktail", "drink",
+    ),
+    "media": (
+        "媒體", "報導", "新聞", "專訪", "採訪", "曝光", "轉載", "雜誌", "影片", "推薦入選",
+        "路透", "南華早報", "海峽時報", "天下", "食尚玩家",
+        "reuters", "asiaone", "scmp", "straits times",
+    ),
+    "brand": (
+        "品牌", "理念", "創辦", "創業", "創生", "青創", "地方", "在地", "營業", "地址", "位置",
+        "在哪", "哪裡", "後浦", "音樂會", "老闆", "團隊",
+    ),
+}
+
+
+def categorize_source(source):
+    """依來源檔案路徑決定 chunk 的類別"""
+    name = os.path.basename(source or "")
+    for category, pattern in SOURCE_RULES:
+        if pattern.search(name):
+            return category
+    return DEFAULT_CATEGORY
+
+
+class ShardRouter:
+    """以關鍵字判斷子問題要搜尋哪些類別的子索引"""
+
+    def __init__(self, keywords=None):
+        self.keywords = keywords or QUERY_KEYWORDS
+
+    @classmethod
+    def from_env(cls):
+        """SHARD_ROUTING=0 時回傳 None（一律搜尋全域索引）"""
+        if os.getenv("SHARD_ROUTING", "1") != "1":
+            return None
+        return cls()
+
+    def route(self, text):
+        """回傳相關類別的 tuple；空 tuple 表示判斷不出來，搜尋全域索引"""
+        text = str(text).lower()
+        return tuple(
+            category for category, words in self.keywords.items()
+            if any(word in text for word in words)
+        )
+
+    def search(self, db, queries_list, vectors, top_k):
+        """與 index.search 相同的回傳值 (distances, indices)，indices 為全域列號
+
+        db 沒有子索引（langchain 格式或建置時未分片）時直接搜尋全域索引。
+        """
+        shards = getattr(db, "shards", None)
+        if not shards:
+            return db.index.search(vectors, top_k)
+
+        routes = []
+        for text in queries_list:
+            route = tuple(category for category in self.route(text) if category in shards)
+            # 所有類別都符合時和全域搜尋相同
+            if len(route) == len(shards):
+                route = ()
+            routes.append(route)
+            RETRIEVAL_ROUTES.inc(shard="+".join(route) or "all")
+
+        # 距離越小越相關（L2）；內積則越大越相關
+        larger_is_better = db.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        candidates = [[] for _ in queries_list]
+        for category in sorted({category for route in routes for category in route}):
+            rows = [i for i, route in enumerate(routes) if category in route]
+            self._collect(shards[category].search(vectors[rows], top_k), rows, candidates)
+
+        # 判斷不出類別、或子索引結果不足 top_k 筆時退回全域搜尋
+        fallback = [i for i, route in enumerate(routes) if not route or len(candidates[i]) < top_k]
+        if fallback:
+            self._collect(db.index.search(vectors[fallback], top_k), fallback, candidates)
+
+        distances = np.full((len(queries_list), top_k), np.inf, dtype=np.float32)
+        if larger_is_better:
+            distances.fill(-np.inf)
+        indices = np.full((len(queries_list), top_k), -1, dtype=np.int64)
+        for i, found in enumerate(candidates):
+            best = {}
+            for distance, row in found:
+                if row not in best or (distance > best[row] if larger_is_better else distance < best[row]):
+                    best[row] = distance
+            ranked = sorted(best.items(), key=lambda item: item[1], reverse=larger_is_better)[:top_k]
+            for j, (row, distance) in enumerate(ranked):
+                indices[i, j] = row
+                distances[i, j] = distance
+        return distances, indices
+
+    @staticmethod
+    def _collect(result, rows, candidates):
+        distances, indices = result
+        for row, row_distances, row_indices in zip(rows, distances, indices):
+            candidates[row].extend(
+                (float(distance), int(index)) for distance, index in zip(row_distances, row_indices) if index != -1
+            )
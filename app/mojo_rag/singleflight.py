@@ -0,0 +1,191 @@
+"""
+相同問題的請求合併（single-flight）
+
+分享連結後常有許多訪客同時送出同一個建議問題。以正規化問句（回答快取的 key）
+為單位，同時進行中的相同請求只跑一次 pipeline：
+
+- /api/chat：後到的請求等待第一個請求的結果
+- /api/chat/stream：pipeline 在背景執行（thread 或 asyncio task），每個事件依序
+  發送給所有訂閱者；中途加入的訂閱者會先收到已經產生的事件
+
+背景執行的 pipeline 不受個別連線中斷影響，跑完後結果照常寫入快取。
+"""
+import asyncio
+import queue
+import threading
+
+from .metrics import COALESCED
+
+_END = object()
+
+
+class _Failure:
+    """pipeline 的例外，轉交給每個訂閱者重新拋出"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class Flight:
+    """一次進行中的串流請求：保留已產生的事件，並轉送給每個訂閱者的佇列"""
+
+    def __init__(self, queue_factory):
+        self.queue_factory = queue_factory
+        self.history = []
+        self.queues = []
+        self.task = None
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        with self._lock:
+            q = self.queue_factory()
+            for item in self.history:
+                q.put_nowait(item)
+            self.queues.append(q)
+            return q
+
+    def publish(self, item):
+        with self._lock:
+            self.history.append(item)
+            for q in self.queues:
+                q.put_nowait(item)
+
+    def close(self):
+        self.publish(_END)
+
+
+class _Call:
+    """一次進行中的 /api/chat 請求"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """依 key 合併同時進行中的相同請求；同步與 asyncio 版本各自獨立"""
+
+    def __init__(self):
+        self._calls = {}
+        self._tasks = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # 同步版本（Flask）
+    # ------------------------------------------------------------------
+
+    def call(self, key, fn):
+        """第一個請求執行 fn()，同時到達的相同請求等待並共用結果"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            COALESCED.inc(endpoint="chat")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stream(self, key, produce):
+        """訂閱 key 的事件串流；沒有進行中的串流時以 produce() 在背景 thread 開始一個"""
+        flight, leader = self._join(("sync", key), lambda: Flight(queue.Queue))
+        q = flight.subscribe()
+        if leader:
+            flight.task = threading.Thread(
+                target=self._produce, args=(("sync", key), flight, produce), name="single-flight", daemon=True
+            )
+            flight.task.start()
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def _produce(self, key, flight, produce):
+        try:
+            for event in produce():
+                flight.publish(event)
+        except Exception as e:
+            flight.publish(_Failure(e))
+        finally:
+            self._leave(key, flight)
+
+    # ------------------------------------------------------------------
+    # asyncio 版本（ASGI）
+    # ------------------------------------------------------------------
+
+    async def acall(self, key, fn):
+        """call 的 async 版本；fn() 回傳 coroutine，以 shield 保護，個別連線中斷不會取消共用的 task"""
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None:
+                task = asyncio.ensure_future(fn())
+                self._tasks[key] = task
+                task.add_done_callback(lambda _: self._pop_task(key, task))
+            else:
+                COALESCED.inc(endpoint="chat")
+        return await asyncio.shield(task)
+
+    def _pop_task(self, key, task):
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+
+    async def astream(self, key, produce):
+        """stream 的 async 版本；produce() 回傳 async iterator，在背景 task 中執行"""
+        flight, leader = self._join(("async", key), lambda: Flight(asyncio.Queue))
+        q = flight.subscribe()
+        if leader:
+            flight.task = asyncio.ensure_future(self._aproduce(("async", key), flight, produce))
+        while True:
+            item = await q.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    async def _aproduce(self, key, flight, produce):
+        try:
+            async for event in produce():
+                flight.publish(event)
+        except Exception as e:
+            flight.publish(_Failure(e))
+        finally:
+            self._leave(key, flight)
+
+    # ------------------------------------------------------------------
+
+    def _join(self, key, factory):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                COALESCED.inc(endpoint="stream")
+                return flight, False
+            flight = self._flights[key] = factory()
+            return flight, True
+
+    def _leave(self, key, flight):
+        # 先從表中移除再送出結束訊號，之後到達的請求會開始新的一輪
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.close()
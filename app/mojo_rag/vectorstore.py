@@ -0,0 +1,43 @@
+"""
+FAISS 向量資料庫載入與版本識別
+"""
+import hashlib
+import json
+import os
+
+
+def hash_files(directory, names):
+    """依檔名與內容計算 hash"""
+    digest = hashlib.sha256()
+    for name in sorted(names):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        digest.update(name.encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def index_version(faiss_path):
+    """以索引檔內容計算版本字串，知識庫更新後快取 key 會自動改變"""
+    from .native_index import MANIFEST_FILE, is_native_store
+
+    if is_native_store(faiss_path):
+        # 原生格式在寫入時已記錄內容 hash
+        with open(os.path.join(faiss_path, MANIFEST_FILE), encoding="utf-8") as f:
+            return json.load(f)["index_version"]
+    return hash_files(faiss_path, os.listdir(faiss_path))
+
+
+def load_vector_store(faiss_path, embedding_model):
+    """載入向量資料庫：有 store.json 時使用 memory-mapped 原生格式，否則 unpickle langchain FAISS"""
+    from .native_index import NativeFAISS, is_native_store
+
+    if is_native_store(faiss_path):
+        return NativeFAISS(faiss_path, embedding_model)
+
+    from langchain_community.vectorstores import FAISS
+
+    return FAISS.load_local(faiss_path, embedding_model, allow_dangerous_deserialization=True)
@@ -0,0 +1,102 @@
+"""
+Flask（WSGI）版本的 web 介面
+"""
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+
+from . import metrics
+from .pipeline import PIPELINE_MODES, sse_event
+
+
+def create_flask_app(pipeline, secret_key='mojo-dream-bar-secret-key', **flask_kwargs):
+    """建立 Flask app，flask_kwargs 會傳給 Flask()（例如 static_folder、template_folder）"""
+    web_app = Flask(__name__, **flask_kwargs)
+    web_app.config['SECRET_KEY'] = secret_key
+
+    @web_app.route('/')
+    def index():
+        """首頁"""
+        return render_template('index.html')
+
+    @web_app.route('/metrics')
+    def metrics_endpoint():
+        """Prometheus 指標"""
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    @web_app.route('/api/chat', methods=['POST'])
+    def chat():
+        """處理聊天請求"""
+        try:
+            data = request.get_json()
+            user_message = data.get('message', '').strip()
+            # 選填：同一個 session_id 的請求共用對話紀錄
+            session_id = data.get('session_id')
+            # 選填：full（LLM 拆解 + 生成）/ fast（單趟生成），未指定時使用 PIPELINE_MODE
+            mode = data.get('mode')
+
+            if not user_message:
+                return jsonify({'error': '請輸入訊息'}), 400
+
+            if mode is not None and mode not in PIPELINE_MODES:
+                return jsonify({'error': f'mode 必須是 {" / ".join(PIPELINE_MODES)}'}), 400
+
+            response = pipeline.answer(user_message, session_id, mode)
+
+            return jsonify({
+                'response': response,
+                'session_id': session_id,
+                'status': 'success'
+            })
+
+        except Exception as e:
+            print(f"錯誤: {str(e)}")
+            return jsonify({
+                'error': '處理訊息時發生錯誤，請稍後再試',
+                'status': 'error'
+            }), 500
+
+    @web_app.route('/api/chat/stream', methods=['POST'])
+    def chat_stream():
+        """Streaming chat endpoint with thinking visualization"""
+        try:
+            data = request.get_json()
+            user_message = data.get('message', '').strip()
+            # 選填：同一個 session_id 的請求共用對話紀錄
+            session_id = data.get('session_id')
+            # 選填：full（LLM 拆解 + 生成）/ fast（單趟生成），未指定時使用 PIPELINE_MODE
+            mode = data.get('mode')
+
+            if not user_message:
+                return jsonify({'error': '請輸入訊息'}), 400
+
+            if mode is not None and mode not in PIPELINE_MODES:
+                return jsonify({'error': f'mode 必須是 {" / ".join(PIPELINE_MODES)}'}), 400
+
+            def generate():
+                try:
+                    for event in pipeline.stream_events(user_message, session_id, mode):
+                        yield sse_event(event)
+
+                except Exception as e:
+                    print(f"Stream error: {str(e)}")
+                    yield sse_event({
+                        'type': 'error',
+                        'message': '處理訊息時發生錯誤'
+                    })
+
+            return Response(
+                stream_with_context(generate()),
+                mimetype='text/event-stream',
+                headers={
+                    'Cache-Control': 'no-cache',
+                    'X-Accel-Buffering': 'no'
+                }
+            )
+
+        except Exception as e:
+            print(f"錯誤: {str(e)}")
+            return jsonify({
+                'error': '處理訊息時發生錯誤，請稍後再試',
+                'status': 'error'
+            }), 500
+
+    return web_app
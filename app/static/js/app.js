@@ -8,6 +8,18 @@ const messageInput = document.getElementById('messageInput');
 const sendButton = document.getElementById('sendButton');
 const chatContainer = document.getElementById('chatContainer');
 
+// 多輪對話：同一個分頁沿用同一個 session，後端據此保留對話紀錄
+function getSessionId() {
+    let sessionId = sessionStorage.getItem('mojoSessionId');
+    if (!sessionId) {
+        sessionId = window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : Date.now().toString(36) + Math.random().toString(36).slice(2);
+        sessionStorage.setItem('mojoSessionId', sessionId);
+    }
+    return sessionId;
+}
+
 // 自動調整 textarea 高度
 messageInput.addEventListener('input', function() {
     this.style.height = 'auto';
@@ -53,7 +65,7 @@ chatForm.addEventListener('submit', async function(e) {
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ message: message })
+            body: JSON.stringify({ message: message, session_id: getSessionId() })
         });
 
         if (!response.ok) {
@@ -68,6 +80,10 @@ chatForm.addEventListener('submit', async function(e) {
         const decoder = new TextDecoder();
         let buffer = '';
 
+        // 串流回答的狀態（answer_delta 逐段累積）
+        let answerDiv = null;
+        let answerText = '';
+
         while (true) {
             const { done, value } = await reader.read();
             if (done) break;
@@ -107,8 +123,21 @@ chatForm.addEventListener('submit', async function(e) {
                             }
                             break;
 
-                        case 'final_answer':
-                            await addMessage(data.data, 'assistant', true);
+                        case 'answer_delta':
+                            if (!answerDiv) {
+                                answerDiv = createStreamingMessage();
+                            }
+                            answerText += data.data;
+                            scheduleMarkdownRender(answerDiv, answerText);
+                            break;
+
+                        case 'answer_done':
+                            if (!answerDiv) {
+                                answerDiv = createStreamingMessage();
+                            }
+                            answerText = data.data;
+                            pendingRender = null;  // 取消尚未執行的串流重繪
+                            renderMarkdown(answerDiv, answerText);
                             scrollToBottom();
                             break;
 
@@ -197,9 +226,8 @@ function parseMarkdown(text) {
  * 添加訊息到聊天區
  * @param {string} text - 訊息內容
  * @param {string} role - 'user' 或 'assistant'
- * @param {boolean} animate - 是否使用打字動畫
  */
-async function addMessage(text, role, animate = false) {
+function addMessage(text, role) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${role}`;
 
@@ -209,19 +237,12 @@ async function addMessage(text, role, animate = false) {
     messageDiv.appendChild(contentDiv);
     chatContainer.appendChild(messageDiv);
 
-    if (animate && role === 'assistant') {
-        // 打字機效果 + markdown rendering
-        await typeWriterWithMarkdown(contentDiv, text);
+    if (role === 'user') {
+        // user 訊息用純文字
+        contentDiv.textContent = text;
     } else {
-        // 直接顯示（user 訊息用純文字）
-        if (role === 'user') {
-            contentDiv.textContent = text;
-        } else {
-            // assistant 訊息支援 markdown，使用 DOMPurify 淨化
-            const renderedHTML = parseMarkdown(text);
-            const cleanHTML = DOMPurify.sanitize(renderedHTML);
-            contentDiv.innerHTML = cleanHTML;
-        }
+        // assistant 訊息支援 markdown
+        renderMarkdown(contentDiv, text);
     }
 
     // 滾動到最新訊息
@@ -229,41 +250,49 @@ async function addMessage(text, role, animate = false) {
 }
 
 /**
- * 打字機效果（支援 markdown）
+ * 建立一則空的 assistant 訊息，供串流回答逐段填入
+ * @returns {HTMLElement} 訊息內容元素
+ */
+function createStreamingMessage() {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message assistant';
+
+    const contentDiv = document.createElement('div');
+    contentDiv.className = 'message-content';
+
+    messageDiv.appendChild(contentDiv);
+    chatContainer.appendChild(messageDiv);
+    scrollToBottom();
+
+    return contentDiv;
+}
+
+/**
+ * 將 markdown 渲染進元素（使用 DOMPurify 淨化）
  * @param {HTMLElement} element - 目標元素
  * @param {string} text - 文字內容
  */
-function typeWriterWithMarkdown(element, text) {
-    return new Promise((resolve) => {
-        let index = 0;
-        const speed = 15; // 打字速度（毫秒）
-
-        // 先渲染成 markdown HTML
-        const renderedHTML = parseMarkdown(text);
-
-        // 創建臨時元素來獲取純文字內容
-        const temp = document.createElement('div');
-        temp.textContent = ''; // 使用 textContent 確保安全
-        const tempClean = document.createElement('div');
-        tempClean.innerHTML = DOMPurify.sanitize(renderedHTML);
-        const plainText = tempClean.textContent;
-
-        function type() {
-            if (index < plainText.length) {
-                // 逐字顯示純文字
-                element.textContent = plainText.substring(0, index + 1);
-                index++;
-                scrollToBottom();
-                setTimeout(type, speed);
-            } else {
-                // 完成後替換為完整的 markdown HTML（使用 DOMPurify 淨化）
-                const cleanHTML = DOMPurify.sanitize(renderedHTML);
-                element.innerHTML = cleanHTML;
-                resolve();
-            }
-        }
+function renderMarkdown(element, text) {
+    element.innerHTML = DOMPurify.sanitize(parseMarkdown(text));
+}
 
-        type();
+/**
+ * 串流期間每個 animation frame 最多重繪一次，避免每個 token 都重建 DOM
+ * @param {HTMLElement} element - 目標元素
+ * @param {string} text - 目前累積的文字
+ */
+let pendingRender = null;
+function scheduleMarkdownRender(element, text) {
+    const alreadyScheduled = pendingRender !== null;
+    pendingRender = { element, text };
+    if (alreadyScheduled) return;
+
+    requestAnimationFrame(() => {
+        if (!pendingRender) return;
+        const { element, text } = pendingRender;
+        pendingRender = null;
+        renderMarkdown(element, text);
+        scrollToBottom();
     });
 }
 
@@ -532,6 +561,20 @@ function renderStage3Content(stage3) {
     note.appendChild(noteLabel);
     note.appendChild(document.createTextNode(stage3.note));
 
+    // Context packing stats (if available)
+    if (stage3.context) {
+        const context = document.createElement('div');
+        context.style.marginTop = '10px';
+        const contextLabel = document.createElement('strong');
+        contextLabel.textContent = 'Context: ';
+        context.appendChild(contextLabel);
+        context.appendChild(document.createTextNode(
+            `${stage3.context.packed_chunks}/${stage3.context.chunks} chunks, ` +
+            `${stage3.context.tokens_before} → ${stage3.context.tokens_after} tokens`
+        ));
+        note.appendChild(context);
+    }
+
     // Final Prompt (if available)
     if (stage3.final_prompt) {
         const promptSection = document.createElement('div');
@@ -0,0 +1,45 @@
+"""
+BatchingQueryEmbedding 的排程 thread：呼叫端被取消後仍要繼續服務其他呼叫
+
+    pytest   # 在 app/ 目錄下執行
+"""
+import asyncio
+import threading
+
+import numpy as np
+
+from mojo_rag.batching import BatchingQueryEmbedding
+
+
+class BlockingEmbedding:
+    """第一次 forward pass 等到 release 才回傳，讓測試在計算期間取消呼叫端"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def embed_queries(self, texts):
+        self.started.set()
+        self.release.wait(timeout=5)
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+
+def test_cancelled_caller_does_not_stop_the_batcher():
+    inner = BlockingEmbedding()
+    batcher = BatchingQueryEmbedding(inner, max_wait_ms=0)
+
+    async def scenario():
+        first = asyncio.ensure_future(batcher.aembed_queries(["被取消的查詢"]))
+        await asyncio.get_running_loop().run_in_executor(None, inner.started.wait, 5)
+        first.cancel()
+        # 排隊中的呼叫也取消：排程 thread 取出時要略過它
+        queued = asyncio.ensure_future(batcher.aembed_queries(["排隊中被取消的查詢"]))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        inner.release.set()
+        return await asyncio.wait_for(batcher.aembed_queries(["下一個查詢"]), timeout=5)
+
+    vectors = asyncio.run(scenario())
+    assert vectors.shape == (1, 4)
+    assert batcher._thread.is_alive()
+    assert batcher.embed_queries(["同步呼叫"]).shape == (1, 4)
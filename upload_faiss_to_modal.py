@@ -4,9 +4,17 @@ Helper script to upload FAISS database to Modal Volume
 This script uploads your local FAISS database to Modal's persistent storage.
 Run this once before deploying your application.
 
+If the database was built with `python -m mojo_rag.ingest` it has a
+manifest.json with per-file checksums; only files whose checksum differs from
+the manifest already on the volume are uploaded, and the upload is verified
+against the manifest. Without a manifest every file is uploaded.
+
 Usage:
     modal run upload_faiss_to_modal.py
 """
+import hashlib
+import json
+
 import modal
 from pathlib import Path
 
@@ -23,11 +31,13 @@ image = modal.Image.debian_slim()
     image=image,
     volumes={"/data": faiss_volume},
 )
-def verify_upload():
+def verify_upload(expected_files=None):
     """
     Verify that the FAISS database was uploaded correctly.
-    Lists all files in the volume.
+    Lists all files in the volume and, when a manifest is given,
+    checks every file's SHA-256 against it.
     """
+    import hashlib
     from pathlib import Path
 
     volume_faiss_path = Path("/data")  # Files are at root of volume
@@ -45,18 +55,56 @@ def verify_upload():
         size_mb = file.stat().st_size / (1024 * 1024)
         print(f"   - {file.name} ({size_mb:.2f} MB)")
 
-    # Check for required files
-    required_files = ["index.faiss", "index.pkl"]
+    # Check for required files (memory-mapped native format or langchain pickle format)
+    if (volume_faiss_path / "store.json").exists():
+        required_files = ["index.faiss", "store.json"] + [
+            f"{column}.{ext}" for column in ("texts", "metadata", "ids") for ext in ("bin", "offsets")
+        ]
+    else:
+        required_files = ["index.faiss", "index.pkl"]
     missing_files = [f for f in required_files if not (volume_faiss_path / f).exists()]
 
     if missing_files:
         print(f"\n⚠️  Warning: Missing required files: {', '.join(missing_files)}")
         return False
 
+    # Check checksums against the build manifest
+    for name, expected in (expected_files or {}).items():
+        path = volume_faiss_path / name
+        if not path.exists():
+            print(f"\n⚠️  Warning: {name} listed in manifest.json is missing")
+            return False
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        if digest != expected["sha256"]:
+            print(f"\n⚠️  Warning: checksum mismatch for {name}")
+            return False
+
     print("\n✅ FAISS database verified successfully!")
     return True
 
 
+def _load_local_manifest(local_faiss_path):
+    """Read manifest.json and make sure it matches the files on disk"""
+    manifest_path = local_faiss_path / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    for name, info in manifest["files"].items():
+        digest = hashlib.sha256((local_faiss_path / name).read_bytes()).hexdigest()
+        if digest != info["sha256"]:
+            raise RuntimeError(f"{name} does not match manifest.json; rebuild with `python -m mojo_rag.ingest`")
+    return manifest
+
+
+def _read_remote_manifest():
+    """manifest.json currently on the volume, or None"""
+    try:
+        data = b"".join(faiss_volume.read_file("/manifest.json"))
+    except (FileNotFoundError, modal.exception.NotFoundError):
+        return None
+    return json.loads(data)
+
+
 @app.local_entrypoint()
 def main():
     """
@@ -80,27 +128,44 @@ def main():
             "Make sure you have built the FAISS index first."
         )
 
-    # List files to upload
-    faiss_files = list(local_faiss_path.glob("*"))
-    print(f"\n📂 Found {len(faiss_files)} files to upload:")
-    for file in faiss_files:
-        if file.is_file():
-            size_mb = file.stat().st_size / (1024 * 1024)
-            print(f"   - {file.name} ({size_mb:.2f} MB)")
+    manifest = _load_local_manifest(local_faiss_path)
+    if manifest is None:
+        # No build manifest: upload every file as before
+        upload_files = [file for file in local_faiss_path.glob("*") if file.is_file()]
+        stale_files = []
+    else:
+        remote_files = (_read_remote_manifest() or {}).get("files", {})
+        local_files = manifest["files"]
+        upload_files = [
+            local_faiss_path / name
+            for name, info in local_files.items()
+            if remote_files.get(name, {}).get("sha256") != info["sha256"]
+        ]
+        # Always refresh manifest.json (the batch is committed to the volume in one go)
+        upload_files.append(local_faiss_path / "manifest.json")
+        stale_files = [name for name in remote_files if name not in local_files]
+        print(f"\n📋 Manifest version {manifest['version']} (index {manifest['index_version']})")
+
+    print(f"\n📂 {len(upload_files)} files to upload:")
+    for file in upload_files:
+        size_mb = file.stat().st_size / (1024 * 1024)
+        print(f"   - {file.relative_to(local_faiss_path).as_posix()} ({size_mb:.2f} MB)")
 
-    # Upload files using batch_upload
     # Upload individual files to the root of the volume (not in a subdirectory)
     print(f"\n⏳ Uploading files...")
-    with faiss_volume.batch_upload() as batch:
-        for file in faiss_files:
-            if file.is_file():
-                # Upload to root of volume: /index.faiss, /index.pkl
-                batch.put_file(str(file), f"/{file.name}")
+    with faiss_volume.batch_upload(force=True) as batch:
+        for file in upload_files:
+            # Upload to root of volume: /index.faiss, /store.json, /shards/menu.faiss, ...
+            batch.put_file(str(file), f"/{file.relative_to(local_faiss_path).as_posix()}")
+
+    for name in stale_files:
+        print(f"🗑️  Removing stale file {name}")
+        faiss_volume.remove_file(f"/{name}")
 
     print("✅ Upload complete!")
 
     # Verify the upload
-    success = verify_upload.remote()
+    success = verify_upload.remote(manifest["files"] if manifest else None)
 
     print("\n" + "=" * 60)
     if success: